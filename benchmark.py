@@ -0,0 +1,225 @@
+# benchmark.py
+# Time training, end of training, unsupervised training, saving and loading, and
+# every classifier of test_classifier.py on deterministic synthetic corpora.
+# e.g. python benchmark.py --sizes 1000,5000,20000 --output bench.json
+# e.g. python benchmark.py --output new.json --baseline bench.json # Flag regressions.
+# e.g. python benchmark.py --corpus 2000 synthetic.txt # Only write a corpus.
+#
+# Each corpus size runs in its own process so that its peak memory is its own.
+
+import os
+import sys
+import json
+import time
+import random
+import codecs
+import resource
+import tempfile
+import platform
+import multiprocessing
+from optparse import OptionParser
+from classifier import Classifier
+from classify_server import percentile
+from test_classifier import CLASSIFIERS
+from train_classifier import TOKENIZER
+
+SIZES = [1000, 5000, 20000]
+SEED = 42
+
+# The share of each corpus held out as unlabeled and test documents, and the most
+# documents unsupervised_training is timed on.
+TEST_FRACTION = 0.2
+MAX_UNSUPERVISED = 400
+
+# Regressions are reported when a time grows by more than this factor and by
+# more than MIN_DIFFERENCE seconds, so timer noise on tiny times is ignored.
+REGRESSION_FACTOR = 1.25
+MIN_DIFFERENCE = 0.001
+
+CLASS_NAMES = ['drug', 'company', 'movie', 'place', 'person']
+CONSONANTS = 'bcdfghjklmnprstvwxz'
+VOWELS = 'aeiouy'
+
+def generate_corpus(number_of_documents, seed=SEED):
+    """Return a list of (class name, text) documents, the same every time for a seed.
+    Each class draws its words from syllables of its own, mostly, so the classes are
+    separable but overlap.
+    """
+    rng = random.Random(seed)
+    syllables = [c + v for c in CONSONANTS for v in VOWELS]
+    class_syllables = {}
+    for class_name in CLASS_NAMES:
+        class_syllables[class_name] = rng.sample(syllables, 20)
+    documents = []
+    for i in xrange(number_of_documents):
+        class_name = rng.choice(CLASS_NAMES)
+        words = []
+        for j in xrange(rng.randint(1, 4)):
+            word = []
+            for k in xrange(rng.randint(1, 4)):
+                if rng.random() < 0.8:
+                    word.append(rng.choice(class_syllables[class_name]))
+                else:
+                    word.append(rng.choice(syllables))
+            words.append(''.join(word).capitalize())
+        documents.append((class_name, u' '.join(words)))
+    return documents
+
+def write_corpus(documents, file_name):
+    """Write the documents in the class-tab-text format of the training files."""
+    with codecs.open(file_name, 'w', 'utf-8') as f:
+        for class_name, text in documents:
+            f.write(u'%s\t%s\n' % (class_name, text))
+
+def peak_memory():
+    """Return the peak resident memory of the process in KB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def timed(results, name, function, *args):
+    """Call the function, recording its seconds and the peak memory after it."""
+    start_time = time.time()
+    value = function(*args)
+    results[name] = {'seconds': time.time() - start_time, 'peak_memory_kb': peak_memory()}
+    return value
+
+def latency_summary(latencies):
+    values = sorted(latencies)
+    total = sum(values)
+    return {
+        'seconds': total,
+        'docs_per_sec': len(values)/total if total > 0 else None,
+        'p50': percentile(values, 0.5),
+        'p90': percentile(values, 0.9),
+        'p99': percentile(values, 0.99),
+        'max': values[-1] if values else None,
+    }
+
+def run_size(size, seed=SEED):
+    """Return the benchmark results of one corpus size."""
+    documents = [(class_name, TOKENIZER.tokens(text)) for class_name, text in generate_corpus(size, seed)]
+    number_of_test = max(1, int(size*TEST_FRACTION))
+    training = documents[number_of_test:]
+    test = [token_list for class_name, token_list in documents[:number_of_test]]
+    results = {'documents': size, 'stages': {}, 'classifiers': {}}
+    stages = results['stages']
+    c = Classifier()
+
+    def train():
+        for class_name, token_list in training:
+            c.train(class_name, token_list)
+    timed(stages, 'train', train)
+    stages['train']['docs_per_sec'] = len(training)/stages['train']['seconds']
+    timed(stages, 'signal_end_of_training', c.signal_end_of_training)
+    unlabeled = test[:MAX_UNSUPERVISED]
+    timed(stages, 'unsupervised_training', c.unsupervised_training, list(unlabeled), 200, 0.5, True, False)
+    stages['unsupervised_training']['documents'] = len(unlabeled)
+
+    handle, file_name = tempfile.mkstemp(suffix='.json')
+    os.close(handle)
+    try:
+        timed(stages, 'save_model', c.save_model, file_name)
+        stages['save_model']['bytes'] = os.path.getsize(file_name)
+        loaded = Classifier()
+        timed(stages, 'load_model', loaded.load_model, file_name)
+        timed(stages, 'save_binary_model', c.save_binary_model, file_name)
+        stages['save_binary_model']['bytes'] = os.path.getsize(file_name)
+        loaded = Classifier()
+        timed(stages, 'load_binary_model', loaded.load_model, file_name)
+        loaded.model_file.close()
+    finally:
+        os.remove(file_name)
+
+    for classifier_name, method_name in CLASSIFIERS:
+        classify = getattr(c, method_name)
+        latencies = []
+        for token_list in test:
+            start_time = time.time()
+            classify(token_list)
+            latencies.append(time.time() - start_time)
+        results['classifiers'][classifier_name] = latency_summary(latencies)
+    results['peak_memory_kb'] = peak_memory()
+    return results
+
+def _run_size_in_process(size, seed, queue):
+    queue.put(run_size(size, seed))
+
+def run_benchmark(sizes=SIZES, seed=SEED, verbose=True):
+    """Return the results of every size, each run in a fresh process."""
+    results = {
+        'seed': seed,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'sizes': {},
+    }
+    for size in sizes:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_run_size_in_process, args=(size, seed, queue))
+        process.start()
+        size_results = queue.get()
+        process.join()
+        results['sizes'][str(size)] = size_results
+        if verbose:
+            print_results(size_results)
+    return results
+
+def print_results(size_results):
+    print "Documents: %d, peak memory: %d KB" % (size_results['documents'], size_results['peak_memory_kb'])
+    for name, stage in sorted(size_results['stages'].iteritems()):
+        print "  %s: %.3f s" % (name, stage['seconds'])
+    for name, _ in CLASSIFIERS:
+        summary = size_results['classifiers'][name]
+        print "  %s: %.1f docs/sec, p50 %.3f ms, p99 %.3f ms" % \
+              (name, summary['docs_per_sec'] or 0, 1000*summary['p50'], 1000*summary['p99'])
+
+def timings(results):
+    """Return {(size, kind, name, metric): seconds} of the times in the results."""
+    times = {}
+    for size, size_results in results['sizes'].iteritems():
+        for name, stage in size_results['stages'].iteritems():
+            times[(size, 'stage', name, 'seconds')] = stage['seconds']
+        for name, summary in size_results['classifiers'].iteritems():
+            for metric in ('seconds', 'p50', 'p99'):
+                times[(size, 'classifier', name, metric)] = summary[metric]
+    return times
+
+def compare(results, baseline, factor=REGRESSION_FACTOR):
+    """Return a list of (size, kind, name, metric, baseline seconds, seconds) of the
+    times that grew by more than the factor.
+    """
+    regressions = []
+    new_times = timings(results)
+    for key, old in sorted(timings(baseline).iteritems()):
+        new = new_times.get(key)
+        if new is not None and new > old*factor and new - old > MIN_DIFFERENCE:
+            regressions.append(key + (old, new))
+    return regressions
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option('--sizes', default=','.join(str(size) for size in SIZES),
+                      help="Comma separated corpus sizes.")
+    parser.add_option('--seed', type='int', default=SEED)
+    parser.add_option('--output', help="Save the results as JSON.")
+    parser.add_option('--baseline', help="Compare against the JSON results of an earlier run.")
+    parser.add_option('--factor', type='float', default=REGRESSION_FACTOR,
+                      help="How much slower a time may get before it's a regression.")
+    parser.add_option('--corpus', type='int', metavar='SIZE',
+                      help="Only write a corpus of SIZE documents to the file argument.")
+    options, args = parser.parse_args()
+    if options.corpus is not None:
+        write_corpus(generate_corpus(options.corpus, options.seed), args[0])
+        sys.exit()
+    sizes = [int(size) for size in options.sizes.split(',')]
+    results = run_benchmark(sizes, options.seed)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, options.factor)
+        for size, kind, name, metric, old, new in regressions:
+            print "Regression (%s documents, %s %s, %s): %.6f s -> %.6f s" % (size, kind, name, metric, old, new)
+        if regressions:
+            sys.exit(1)
+        print "No regressions against", options.baseline
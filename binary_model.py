@@ -0,0 +1,596 @@
+# binary_model.py
+# A compact binary model file that can be memory mapped and used without parsing.
+# e.g. python binary_model.py trained.json trained.bin # Convert a JSON model.
+#
+# Layout, all little-endian:
+#   header: magic, format version, number of sections
+#   section directory: name, offset and length of each section
+#   'strings': the symbol table, symbol i is string i
+#   'unsmoothed', 'smoothed', 'semi-supervised': count tables, see write_model_section
+#   'types', 'semi-supervised-types', 'classes': symbol ids
+# The smoothed section is normally stored as the unsmoothed one plus a virtual
+# zero count JUNK item, and the semi-supervised one as count deltas on top of it.
+#
+# Looking a count up in the map searches the sorted arrays, through numpy views when
+# numpy is available, which is still several times slower than a dict. So
+# Classifier.load_model compiles a mapped model by default, reading every section
+# at once, and the n-gram classifiers look their log probabilities up in dicts.
+
+import mmap
+import struct
+import sys
+import time
+import os.path as path
+from heapq import merge
+from classifier import Classifier, Model, OverlayModel, OverlayTables, SymbolTable, LayeredItems, PRIOR_KEY, np
+
+MAGIC = 'NBCM'
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct('<4sII')
+SECTION_ENTRY = struct.Struct('<24sQQ')
+MODEL_HEADER = struct.Struct('<IiIIQQ')
+INT64 = struct.Struct('<q')
+UINT64 = struct.Struct('<Q')
+UINT32 = struct.Struct('<I')
+
+# Model section flags.
+ADD_JUNK = 1 # Every non-prior context of the base has the junk item with a zero count.
+
+MODEL_SECTIONS = ['unsmoothed', 'smoothed', 'semi-supervised']
+SYMBOL_SECTIONS = ['types', 'semi-supervised-types', 'classes']
+MAX_COUNT = (1 << 32) - 1
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+def _pad(data):
+    return data + '\0'*(_align(len(data)) - len(data))
+
+def is_model_file(file_name):
+    """Return True if the file starts like a binary model file."""
+    with open(file_name, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def _encode(symbol):
+    if isinstance(symbol, unicode):
+        return symbol.encode('utf-8')
+    return symbol
+
+def write_strings_section(symbols):
+    """Return the bytes of the strings section.
+    Layout: number of offsets, offsets into the UTF-8 blob (uint32), a byte per
+    string that is 1 for unicode strings and 0 for byte strings, and the blob.
+    The string types are kept so that str(given) comes out the same as before saving.
+    """
+    strings = symbols.strings[1:]
+    blobs = [_encode(symbol) for symbol in strings]
+    offsets = [0]
+    for blob in blobs:
+        offsets.append(offsets[-1] + len(blob))
+    data = UINT32.pack(len(offsets))
+    data += struct.pack('<%dI' % len(offsets), *offsets)
+    data += ''.join('\1' if isinstance(symbol, unicode) else '\0' for symbol in strings)
+    return data + ''.join(blobs)
+
+def read_strings_section(buf, offset):
+    """Return a SymbolTable with the strings of the section."""
+    count = UINT32.unpack_from(buf, offset)[0]
+    offsets = struct.unpack_from('<%dI' % count, buf, offset + 4)
+    flags_offset = offset + 4 + 4*count
+    start = flags_offset + count - 1
+    symbols = SymbolTable()
+    for i in xrange(count - 1):
+        symbol = buf[start + offsets[i]:start + offsets[i + 1]]
+        if buf[flags_offset + i] == '\1':
+            symbol = symbol.decode('utf-8')
+        symbols.intern(symbol)
+    return symbols
+
+def write_model_section(tables, flags=0, base_index=-1, junk_id=0):
+    """Return the bytes of a model section.
+    tables - {context key: [total, {item id: count}]}, counts are deltas if there is a base.
+    Layout: header, sorted context keys (int64), totals (uint64),
+    item offsets (uint32, one more than the keys), item ids (uint32, sorted
+    within each context) and item counts (uint32).
+    """
+    keys = sorted(tables)
+    totals = []
+    offsets = [0]
+    item_ids = []
+    counts = []
+    for key in keys:
+        total, items = tables[key]
+        totals.append(total)
+        for item_id in sorted(items):
+            count = items[item_id]
+            if count > MAX_COUNT:
+                raise ValueError("Count too large for the binary model format.")
+            item_ids.append(item_id)
+            counts.append(count)
+        offsets.append(len(item_ids))
+    data = MODEL_HEADER.pack(flags, base_index, junk_id, 0, len(keys), len(item_ids))
+    data += struct.pack('<%dq' % len(keys), *keys)
+    data += struct.pack('<%dQ' % len(totals), *totals)
+    data += _pad(struct.pack('<%dI' % len(offsets), *offsets))
+    data += _pad(struct.pack('<%dI' % len(item_ids), *item_ids))
+    data += _pad(struct.pack('<%dI' % len(counts), *counts))
+    return data
+
+def model_section_size(number_of_contexts, number_of_items):
+    """Return the bytes write_model_section takes for tables of this size."""
+    return (MODEL_HEADER.size + 16*number_of_contexts + _align(4*(number_of_contexts + 1)) +
+            2*_align(4*number_of_items))
+
+def _junk_tables(tables, junk_id):
+    """Return the tables with a zero count junk item added to every non-prior context,
+    the way Classifier.signal_end_of_training builds the smoothed model.
+    """
+    result = {}
+    for key, table in tables.iteritems():
+        items = dict(table[1])
+        if key != PRIOR_KEY:
+            items.setdefault(junk_id, 0)
+        result[key] = [table[0], items]
+    return result
+
+def _tables_equal(tables1, tables2):
+    if len(tables1) != len(tables2):
+        return False
+    for key, table in tables1.iteritems():
+        other = tables2.get(key)
+        if other is None or other[0] != table[0] or dict(other[1]) != dict(table[1]):
+            return False
+    return True
+
+def _delta_tables(tables, base_tables):
+    """Return the count increments from base_tables to tables, or None if some count decreased."""
+    if any(key not in tables for key in base_tables):
+        return None
+    delta = {}
+    for key, table in tables.iteritems():
+        base_table = base_tables.get(key, [0, {}])
+        base_items = base_table[1]
+        items = {}
+        for item_id, count in table[1].iteritems():
+            difference = count - base_items.get(item_id, 0)
+            if difference < 0:
+                return None
+            elif difference > 0 or item_id not in base_items:
+                items[item_id] = difference
+        if any(item_id not in table[1] for item_id in base_items):
+            return None
+        if items or table[0] != base_table[0]:
+            delta[key] = [table[0] - base_table[0], items]
+    return delta
+
+def _plain_tables(model):
+    return dict((key, [table[0], dict(table[1])]) for key, table in model.tables.iteritems())
+
+def write_model_file(classifier, file_name):
+    """Write the classifier's models in the binary format."""
+    symbols = classifier.symbols
+    symbol_sections = {}
+    for name, attribute in zip(SYMBOL_SECTIONS, ['types', 'semi_supervised_types', 'classes']):
+        symbol_ids = [symbols.intern(symbol) for symbol in getattr(classifier, attribute)]
+        symbol_sections[name] = UINT32.pack(len(symbol_ids)) + struct.pack('<%dI' % len(symbol_ids), *symbol_ids)
+    junk_id = symbols.intern(classifier.JUNK)
+
+    unsmoothed = _plain_tables(classifier.model)
+    smoothed = _plain_tables(classifier.smoothed_model)
+    semi_supervised = _plain_tables(classifier.semi_supervised_model)
+    model_sections = {'unsmoothed': write_model_section(unsmoothed)}
+    # Store the smoothed and semi supervised models as layers when they allow it.
+    if smoothed and _tables_equal(smoothed, _junk_tables(unsmoothed, junk_id)):
+        model_sections['smoothed'] = write_model_section({}, ADD_JUNK, 1 + MODEL_SECTIONS.index('unsmoothed'), junk_id)
+    else:
+        model_sections['smoothed'] = write_model_section(smoothed)
+    delta = _delta_tables(semi_supervised, smoothed)
+    if smoothed and delta is not None:
+        model_sections['semi-supervised'] = write_model_section(delta, 0, 1 + MODEL_SECTIONS.index('smoothed'))
+    else:
+        model_sections['semi-supervised'] = write_model_section(semi_supervised)
+
+    # The strings go last so that symbols interned above are included.
+    sections = [('strings', write_strings_section(symbols))]
+    sections += [(name, model_sections[name]) for name in MODEL_SECTIONS]
+    sections += [(name, symbol_sections[name]) for name in SYMBOL_SECTIONS]
+    offset = _align(HEADER.size + SECTION_ENTRY.size*len(sections))
+    directory = HEADER.pack(MAGIC, FORMAT_VERSION, len(sections))
+    for name, data in sections:
+        directory += SECTION_ENTRY.pack(name, offset, len(data))
+        offset = _align(offset + len(data))
+    with open(file_name, 'wb') as f_out:
+        f_out.write(_pad(directory))
+        for name, data in sections:
+            f_out.write(_pad(data))
+
+class MappedItems(object):
+    """Read-only {item id: count} view of one context of a model section.
+    id_array, count_array - numpy views of the section's item ids and counts, if
+                            numpy is available, searched instead of unpacking.
+    """
+
+    def __init__(self, buf, ids_offset, counts_offset, start, end, id_array=None, count_array=None):
+        self.buf = buf
+        self.ids_offset = ids_offset
+        self.counts_offset = counts_offset
+        self.start = start
+        self.end = end
+        self.id_array = id_array
+        self.count_array = count_array
+
+    def _find(self, item_id):
+        if self.id_array is not None:
+            i = self.start + int(self.id_array[self.start:self.end].searchsorted(item_id))
+            return i if i < self.end and self.id_array[i] == item_id else -1
+        unpack_from = UINT32.unpack_from
+        buf = self.buf
+        ids_offset = self.ids_offset
+        lo = self.start
+        hi = self.end
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_id = unpack_from(buf, ids_offset + 4*mid)[0]
+            if mid_id < item_id:
+                lo = mid + 1
+            elif mid_id > item_id:
+                hi = mid
+            else:
+                return mid
+        return -1
+
+    def get(self, item_id, default=None):
+        i = self._find(item_id)
+        if i < 0:
+            return default
+        if self.count_array is not None:
+            return int(self.count_array[i])
+        return UINT32.unpack_from(self.buf, self.counts_offset + 4*i)[0]
+
+    def __getitem__(self, item_id):
+        count = self.get(item_id)
+        if count is None:
+            raise KeyError(item_id)
+        return count
+
+    def __contains__(self, item_id):
+        return self._find(item_id) >= 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        length = self.end - self.start
+        return list(struct.unpack_from('<%dI' % length, self.buf, self.ids_offset + 4*self.start))
+
+    def values(self):
+        length = self.end - self.start
+        return list(struct.unpack_from('<%dI' % length, self.buf, self.counts_offset + 4*self.start))
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(zip(self.keys(), self.values()))
+
+class MappedTables(object):
+    """Read-only {context key: [total, items]} view of a model section,
+    optionally layered on top of a base section's tables.
+    """
+
+    def __init__(self, buf, offset, base=None):
+        self.buf = buf
+        flags, self.base_index, junk_id, unused, self.length, number_of_items = MODEL_HEADER.unpack_from(buf, offset)
+        self.base = base
+        self.junk_id = junk_id if flags & ADD_JUNK else None
+        self.keys_offset = offset + MODEL_HEADER.size
+        self.totals_offset = self.keys_offset + 8*self.length
+        self.offsets_offset = self.totals_offset + 8*self.length
+        self.ids_offset = _align(self.offsets_offset + 4*(self.length + 1))
+        self.counts_offset = _align(self.ids_offset + 4*number_of_items)
+        # A lookup unpacking one number at a time in Python is about ten times slower
+        # than in a dict, so with numpy the arrays are searched through views of the map.
+        self.key_array = None
+        if np is not None:
+            self.key_array = np.frombuffer(buf, '<i8', self.length, self.keys_offset)
+            self.total_array = np.frombuffer(buf, '<u8', self.length, self.totals_offset)
+            self.offset_array = np.frombuffer(buf, '<u4', self.length + 1, self.offsets_offset)
+            self.id_array = np.frombuffer(buf, '<u4', number_of_items, self.ids_offset)
+            self.count_array = np.frombuffer(buf, '<u4', number_of_items, self.counts_offset)
+
+    def _find(self, key):
+        if self.key_array is not None:
+            i = int(self.key_array.searchsorted(key))
+            return i if i < self.length and self.key_array[i] == key else -1
+        unpack_from = INT64.unpack_from
+        buf = self.buf
+        keys_offset = self.keys_offset
+        lo = 0
+        hi = self.length
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_key = unpack_from(buf, keys_offset + 8*mid)[0]
+            if mid_key < key:
+                lo = mid + 1
+            elif mid_key > key:
+                hi = mid
+            else:
+                return mid
+        return -1
+
+    def _own_table(self, i):
+        if self.key_array is not None:
+            return [int(self.total_array[i]),
+                    MappedItems(self.buf, self.ids_offset, self.counts_offset, int(self.offset_array[i]),
+                                int(self.offset_array[i + 1]), self.id_array, self.count_array)]
+        total = UINT64.unpack_from(self.buf, self.totals_offset + 8*i)[0]
+        start, end = struct.unpack_from('<II', self.buf, self.offsets_offset + 4*i)
+        return [total, MappedItems(self.buf, self.ids_offset, self.counts_offset, start, end)]
+
+    def get(self, key, default=None):
+        i = self._find(key) if self.length else -1
+        if self.base is None:
+            if i < 0:
+                return default
+            return self._own_table(i)
+        base_table = self.base.get(key)
+        if i < 0 and base_table is None:
+            return default
+        own_table = self._own_table(i) if i >= 0 else [0, None]
+        base_total, base_items = base_table if base_table is not None else (0, None)
+        junk_id = self.junk_id if base_table is not None and key != PRIOR_KEY else None
+        if junk_id is None and own_table[1] is None:
+            return base_table
+        return [base_total + own_table[0], LayeredItems(base_items, own_table[1], junk_id)]
+
+    def __getitem__(self, key):
+        table = self.get(key)
+        if table is None:
+            raise KeyError(key)
+        return table
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def _own_keys(self):
+        if not self.length:
+            return []
+        return list(struct.unpack_from('<%dq' % self.length, self.buf, self.keys_offset))
+
+    def keys(self):
+        if self.base is None:
+            return self._own_keys()
+        keys = []
+        for key in merge(self.base.keys(), self._own_keys()):
+            if not keys or keys[-1] != key:
+                keys.append(key)
+        return keys
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def read_own(self):
+        """Return the section's own tables, without its base's, as plain
+        {context key: [total, {item id: count}]} dicts, unpacking each array at once.
+        """
+        buf = self.buf
+        length = self.length
+        own_tables = {}
+        if length:
+            keys = struct.unpack_from('<%dq' % length, buf, self.keys_offset)
+            totals = struct.unpack_from('<%dQ' % length, buf, self.totals_offset)
+            offsets = struct.unpack_from('<%dI' % (length + 1), buf, self.offsets_offset)
+            item_ids = struct.unpack_from('<%dI' % offsets[-1], buf, self.ids_offset)
+            counts = struct.unpack_from('<%dI' % offsets[-1], buf, self.counts_offset)
+            for i, key in enumerate(keys):
+                start = offsets[i]
+                end = offsets[i + 1]
+                own_tables[key] = [totals[i], dict(zip(item_ids[start:end], counts[start:end]))]
+        return own_tables
+
+    def read(self):
+        """Return the tables, with the base applied, as plain
+        {context key: [total, {item id: count}]} dicts.
+        """
+        own_tables = self.read_own()
+        if self.base is None:
+            return own_tables
+        result = self.base.read()
+        if self.junk_id is not None:
+            for key, table in result.iteritems():
+                if key != PRIOR_KEY:
+                    table[1].setdefault(self.junk_id, 0)
+        for key, (total, items) in own_tables.iteritems():
+            table = result.get(key)
+            if table is None:
+                result[key] = [total, items]
+            else:
+                table[0] += total
+                result_items = table[1]
+                for item_id, count in items.iteritems():
+                    result_items[item_id] = result_items.get(item_id, 0) + count
+        return result
+
+    # Going through every table, e.g. to compile them, reads them all at once
+    # rather than looking each one up.
+    def itervalues(self):
+        return self.read().itervalues()
+
+    def iteritems(self):
+        return self.read().iteritems()
+
+class LazyOverlayModel(OverlayModel):
+    """An OverlayModel whose base is only loaded, by calling load_base(), the first
+    time the overlay reads it.
+    """
+
+    def __init__(self, load_base, symbols, layer, junk_id=None):
+        Model.__init__(self, symbols)
+        self.load_base = load_base
+        self.junk_id = junk_id
+        self.layer = layer
+        self.tables = OverlayTables(self)
+
+    def __getattr__(self, name):
+        # Only called until the base is set.
+        if name != 'base':
+            raise AttributeError(name)
+        self.base = self.load_base()
+        return self.base
+
+class MappedModel(Model):
+    """A read-only Model backed by a section of a memory mapped model file.
+    Use Model.mimic to get a copy that can be trained further.
+    """
+
+    def __init__(self, tables, symbols):
+        Model.__init__(self, symbols)
+        self.tables = tables
+
+    def add_by_key(self, item_id, key, increment=1):
+        raise TypeError("Memory mapped models are read-only.")
+
+class ModelFile(object):
+    """An open, memory mapped binary model file."""
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.file = open(file_name, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, number_of_sections = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a binary model file." % file_name)
+        if version != FORMAT_VERSION:
+            raise ValueError("%s has format version %d, expected %d." % (file_name, version, FORMAT_VERSION))
+        self.section_names = []
+        self.sections = {}
+        for i in xrange(number_of_sections):
+            name, offset, length = SECTION_ENTRY.unpack_from(self.map, HEADER.size + SECTION_ENTRY.size*i)
+            name = name.rstrip('\0')
+            self.section_names.append(name)
+            self.sections[name] = (offset, length)
+        self.symbols = None
+        self.tables = {}
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def get_symbols(self):
+        if self.symbols is None:
+            self.symbols = read_strings_section(self.map, self.sections['strings'][0])
+        return self.symbols
+
+    def get_tables(self, name):
+        """Return the MappedTables of a model section."""
+        tables = self.tables.get(name)
+        if tables is None:
+            offset = self.sections[name][0]
+            base_index = MODEL_HEADER.unpack_from(self.map, offset)[1]
+            base = None
+            if base_index >= 0:
+                base = self.get_tables(self.section_names[base_index])
+            tables = self.tables[name] = MappedTables(self.map, offset, base)
+        return tables
+
+    def get_model(self, name):
+        return MappedModel(self.get_tables(name), self.get_symbols())
+
+    def read_tables(self, name):
+        """Return a model section, with its base applied, as plain
+        {context key: [total, {item id: count}]} dicts.
+        """
+        return self.get_tables(name).read()
+
+    def read_model(self, name):
+        """Return a model section as an ordinary in-memory Model."""
+        model = Model(self.get_symbols())
+        model.tables = self.read_tables(name)
+        return model
+
+    def read_overlay(self, name, get_base):
+        """Return a model section layered on another as a LazyOverlayModel of its own
+        counts over get_base(base section name), called when the overlay first reads
+        its base. Other model sections are read with read_model.
+        """
+        tables = self.get_tables(name)
+        if tables.base is None:
+            return self.read_model(name)
+        base_name = self.section_names[tables.base_index]
+        return LazyOverlayModel(lambda: get_base(base_name), self.get_symbols(), tables.read_own(), tables.junk_id)
+
+    def get_symbol_dict(self, name):
+        """Return a types or classes section as {symbol: True}."""
+        offset = self.sections[name][0]
+        count = UINT32.unpack_from(self.map, offset)[0]
+        strings = self.get_symbols().strings
+        symbol_ids = struct.unpack_from('<%dI' % count, self.map, offset + 4)
+        return dict((strings[symbol_id], True) for symbol_id in symbol_ids)
+
+SECTION_ATTRIBUTES = [
+    ('model', 'unsmoothed'),
+    ('smoothed_model', 'smoothed'),
+    ('semi_supervised_model', 'semi-supervised'),
+    ('types', 'types'),
+    ('semi_supervised_types', 'semi-supervised-types'),
+    ('classes', 'classes'),
+]
+
+def load_model_file(classifier, file_name, lazy=False):
+    """Point the classifier's models at the sections of a binary model file.
+    lazy - Instead, read each section into memory the first time the classifier uses it.
+           A section layered on another only reads its own counts, over the
+           classifier's model of the other section, which is loaded when they are
+           first looked up, the same overlays signal_end_of_training builds.
+    Return the open ModelFile.
+    """
+    model_file = ModelFile(file_name)
+    classifier.symbols = model_file.get_symbols()
+    attributes = dict((name, attribute) for attribute, name in SECTION_ATTRIBUTES)
+    get_base = lambda name: getattr(classifier, attributes[name])
+    for attribute, name in SECTION_ATTRIBUTES:
+        if name in MODEL_SECTIONS:
+            if lazy:
+                loader = lambda name=name: model_file.read_overlay(name, get_base)
+            else:
+                loader = lambda name=name: model_file.get_model(name)
+        else:
+            loader = lambda name=name: model_file.get_symbol_dict(name)
+        if lazy:
+            classifier.set_section_loader(attribute, loader)
+        else:
+            start_time = time.time()
+            setattr(classifier, attribute, loader())
+            classifier.section_load_times[attribute] = time.time() - start_time
+    return model_file
+
+if __name__ == "__main__":
+    json_file, binary_file = sys.argv[1:3]
+    c = Classifier()
+    start_time = time.time()
+    c.load_model(json_file)
+    print "JSON load time: %.3f s" % (time.time() - start_time)
+    write_model_file(c, binary_file)
+    start_time = time.time()
+    c2 = Classifier()
+    c2.load_model(binary_file)
+    print "Binary load time: %.3f s" % (time.time() - start_time)
+    c3 = Classifier()
+    c3.load_model(binary_file, lazy=True)
+    for attribute, name in SECTION_ATTRIBUTES:
+        getattr(c3, attribute)
+        print "Lazy load time (%s): %.3f s" % (name, c3.section_load_times[attribute])
+    print "Size: %d bytes -> %d bytes" % (path.getsize(json_file), path.getsize(binary_file))
@@ -1,26 +1,245 @@
 # classifier.py
 # Its gotten ugly as I've added different ways of classifying :P
 
+import os
 import json
 from math import log
 import codecs
 import sys
 import random
-import copy
+import heapq
+import time
+from bisect import bisect_left, bisect_right
+from array import array
 from ast import literal_eval # Used to parse tuples.
+from collections import OrderedDict
+try:
+    import numpy as np # Only needed for classify_batch.
+except ImportError:
+    np = None
 
-class Model(object):
+# Contexts are packed into a single integer: the symbol ids of the given tuple
+# followed by the length of the tuple in the low bits.
+SYMBOL_BITS = 20
+ORDER_BITS = 2
+MAX_SYMBOL_ID = (1 << SYMBOL_BITS) - 1
+UNKNOWN_ID = 0
+
+def pack_context(ids):
+    """Pack a sequence of at most three symbol ids into a context key."""
+    key = 0
+    for symbol_id in ids:
+        key = (key << SYMBOL_BITS) | symbol_id
+    return (key << ORDER_BITS) | len(ids)
+
+def unpack_context(key):
+    """Return the tuple of symbol ids packed into the context key."""
+    order = key & ((1 << ORDER_BITS) - 1)
+    key >>= ORDER_BITS
+    ids = []
+    for i in xrange(order):
+        ids.append(key & MAX_SYMBOL_ID)
+        key >>= SYMBOL_BITS
+    ids.reverse()
+    return tuple(ids)
+
+PRIOR_KEY = pack_context(())
+
+def copy_items(items):
+    """Return a copy of a table's {item id: count} items that can be changed.
+    Items that can't be listed, see hashed_model.HashedItems, copy themselves.
+    """
+    if hasattr(items, 'copy'):
+        return items.copy()
+    return dict(items)
+
+def prune_tables(tables, min_count=2, min_total=1, junk_id=None, orders=None, reference=None, apply=True):
+    """Remove the items counted fewer than min_count times in a context, then the
+    contexts left with a total below min_total or without items, see Model.prune.
+    reference - Tables whose counts decide instead for the items they have.
+    apply - Only count what would be removed if False.
+    Return the number of items and the number of contexts removed. Items added
+    for junk_id are taken off the items removed.
+    """
+    items_removed = 0
+    contexts_removed = 0
+    order_mask = (1 << ORDER_BITS) - 1
+    for key, (total, items) in list(tables.iteritems()):
+        if key == PRIOR_KEY or (orders is not None and key & order_mask not in orders):
+            continue
+        reference_items = None if reference is None else reference.get(key)
+        if reference_items is None:
+            pruned = [item_id for item_id, count in items.iteritems() if count < min_count and item_id != junk_id]
+        else:
+            reference_items = reference_items[1]
+            pruned = [item_id for item_id, count in items.iteritems()
+                      if reference_items.get(item_id, count) < min_count and item_id != junk_id]
+        if not pruned:
+            if total < min_total:
+                items_removed += len(items)
+                contexts_removed += 1
+                if apply:
+                    del tables[key]
+            continue
+        mass = sum(items[item_id] for item_id in pruned)
+        length = len(items) - len(pruned)
+        if junk_id is None:
+            total -= mass
+        elif junk_id not in items:
+            length += 1
+        if total < min_total or length == 0:
+            items_removed += len(items)
+            contexts_removed += 1
+            if apply:
+                del tables[key]
+            continue
+        items_removed += len(items) - length
+        if apply:
+            for item_id in pruned:
+                del items[item_id]
+            if junk_id is not None:
+                items[junk_id] = items.get(junk_id, 0) + mass
+            tables[key][0] = total
+    return items_removed, contexts_removed
+
+class SymbolTable(object):
+    """Intern tokens and class names to small integer ids.
+    Id 0 is reserved for symbols that were never interned.
+    """
     
     def __init__(self):
-        self.internal_model = {}
+        self.ids = {}
+        self.strings = [None]
+    
+    def __len__(self):
+        return len(self.strings) - 1
+    
+    def intern(self, symbol):
+        """Return the id of the symbol, assigning a new id if needed."""
+        symbol_id = self.ids.get(symbol)
+        if symbol_id is None:
+            symbol_id = len(self.strings)
+            if symbol_id > MAX_SYMBOL_ID:
+                raise ValueError("Too many symbols to pack into a context key.")
+            self.ids[symbol] = symbol_id
+            self.strings.append(symbol)
+        return symbol_id
+    
+    def get_id(self, symbol):
+        """Return the id of the symbol or UNKNOWN_ID if it was never interned."""
+        return self.ids.get(symbol, UNKNOWN_ID)
+    
+    def get_symbol(self, symbol_id):
+        return self.strings[symbol_id]
+
+class Model(object):
+    """Conditional count tables.
+    Each table is keyed by a packed context and holds [total count, {item id: count}].
+    Items and the symbols of the given tuples are interned in the symbol table,
+    which may be shared between models.
+    """
+    
+    def __init__(self, symbols=None):
+        if symbols is None:
+            symbols = SymbolTable()
+        self.symbols = symbols
+        self.tables = {}
+    
+    def _get_internal_model(self):
+        """Return the tables in the old form, keyed by str(given) with item names."""
+        internal_model = {}
+        for key, table in self.tables.iteritems():
+            internal_model[self.get_given_string(key)] = [table[0], self._decode_items(table[1])]
+        return internal_model
+    
+    def _set_internal_model(self, internal_model):
+        self.load_internal_model(internal_model)
+    
+    internal_model = property(_get_internal_model, _set_internal_model)
+    
+    def load_internal_model(self, internal_model, key_cache=None):
+        """Replace the tables with ones given in the form returned by internal_model.
+        key_cache - Optional dict of str(given) to packed keys shared between loads.
+        """
+        if key_cache is None:
+            key_cache = {}
+        self.tables = {}
+        intern = self.symbols.intern
+        for given, table in internal_model.iteritems():
+            key = key_cache.get(given)
+            if key is None:
+                key = key_cache[given] = self.get_context_key(given, True)
+            items = {}
+            for item, count in table[1].iteritems():
+                items[intern(item)] = count
+            self.tables[key] = [table[0], items]
+    
+    def _decode_items(self, items):
+        strings = self.symbols.strings
+        decoded = {}
+        # Added in the order the symbols were first seen, the same as the tables keyed
+        # by name were built, so names come out in the same order and ties between
+        # classes are broken the same way.
+        for item_id in sorted(items):
+            decoded[strings[item_id]] = items[item_id]
+        return decoded
+    
+    def get_context_key(self, given, create=False):
+        """Return the packed key of the given tuple.
+        given - A tuple of symbols, '' for the prior, or the str() of a tuple.
+        create - Intern unseen symbols if True, otherwise return None for them.
+        """
+        if not given:
+            return PRIOR_KEY
+        if not isinstance(given, tuple):
+            given = literal_eval(given)
+        if not create and len(given) == 3:
+            # The trigram context is the common case when classifying.
+            ids = self.symbols.ids
+            class_id = ids.get(given[0])
+            prev_prev_id = ids.get(given[1])
+            prev_id = ids.get(given[2])
+            if class_id is None or prev_prev_id is None or prev_id is None:
+                return None
+            return (((((class_id << SYMBOL_BITS) | prev_prev_id) << SYMBOL_BITS) | prev_id) << ORDER_BITS) | 3
+        key = 0
+        if create:
+            intern = self.symbols.intern
+            for symbol in given:
+                key = (key << SYMBOL_BITS) | intern(symbol)
+        else:
+            ids = self.symbols.ids
+            for symbol in given:
+                symbol_id = ids.get(symbol)
+                if symbol_id is None:
+                    return None
+                key = (key << SYMBOL_BITS) | symbol_id
+        return (key << ORDER_BITS) | len(given)
+    
+    def get_given_string(self, key):
+        """Return the str(given) form of a packed context key."""
+        if key == PRIOR_KEY:
+            return ''
+        strings = self.symbols.strings
+        return str(tuple([strings[symbol_id] for symbol_id in unpack_context(key)]))
+    
+    def _get_table(self, item, given):
+        """Return the table of the given context and the id of the item in it.
+        The table is None if the context is unknown.
+        """
+        key = self.get_context_key(given)
+        if key is None:
+            return None, UNKNOWN_ID
+        return self.tables.get(key), self.symbols.get_id(item)
     
     def __contains__(self, given):
-        return str(given) in self.internal_model
+        key = self.get_context_key(given)
+        return key is not None and key in self.tables
     
     def iteritems(self):
         def f():
-            for k, v in self.internal_model.iteritems():
-                yield k, v[1]
+            for key, table in self.tables.iteritems():
+                yield self.get_given_string(key), self._decode_items(table[1])
         return f()
     
     def add_given(self, item, given, increment=1):
@@ -28,15 +247,33 @@ class Model(object):
         item - The class, word, or otherwise that gets incremented.
         given - The tuple of given information.
         """
-        given_key = str(given)
-        self.internal_model.setdefault(given_key, [0, {}])
-        temp = self.internal_model[given_key]
+        self.add_by_key(self.symbols.intern(item), self.get_context_key(given, True), increment)
+    
+    def add_by_key(self, item_id, key, increment=1):
+        """Same as add_given, but with an interned item and a packed context."""
+        temp = self.tables.get(key)
+        if temp is None:
+            temp = self.tables[key] = [0, {}]
         temp[0] += increment
-        temp[1][item] = temp[1].setdefault(item, 0) + increment
+        items = temp[1]
+        items[item_id] = items.get(item_id, 0) + increment
     
     def get_table(self, given):
-        given_key = str(given)
-        return self.internal_model[given_key]
+        key = self.get_context_key(given)
+        table = None if key is None else self._get_complete_table(key)
+        if table is None:
+            raise KeyError(given)
+        return [table[0], self._decode_items(table[1])]
+    
+    def _get_complete_table(self, key):
+        """Return the table of a packed context, listing every item it counts, or None."""
+        return self.tables.get(key)
+    
+    def get_virtual_junk_id(self, key):
+        """Return the id of an item counted zero times in the context without being
+        listed in its table, see OverlayModel, or None.
+        """
+        return None
     
     def log(self, item, given):
         """Return the numerator and the denominator of the probability as a tuple of logs.
@@ -45,15 +282,14 @@ class Model(object):
         The mods are used to modify the counts for smoothing.
         The slack_var is used if the original item is not found.
         """
-        given_key = str(given)
-        if given_key not in self.internal_model:
+        temp, item_id = self._get_table(item, given)
+        if temp is None:
             return 0, 0
         else:
-            temp = self.internal_model[given_key]
-            if item not in temp[1]:
+            if item_id not in temp[1]:
                 return 0, 0
             else:
-                return log(temp[1][item]), log(temp[0])
+                return log(temp[1][item_id]), log(temp[0])
     
     def smoothed_log(self, item, given, numerator_mod=0, denominator_mod=0, slack_var=None, use_mods_for_junk_given=False):
         """Return the numerator and the denominator of the probability as a tuple of logs.
@@ -62,21 +298,21 @@ class Model(object):
         The mods are used to modify the counts for smoothing.
         The slack_var is used if the original item is not found.
         """
-        given_key = str(given)
-        if given_key not in self.internal_model:
+        temp, item_id = self._get_table(item, given)
+        if temp is None:
             if use_mods_for_junk_given:
                 return log(numerator_mod), log(denominator_mod)
             else:
                 return 0, 0
         else:
-            temp = self.internal_model[given_key]
-            if item not in temp[1]:
-                if slack_var not in temp[1]:
+            if item_id not in temp[1]:
+                slack_id = self.symbols.get_id(slack_var)
+                if slack_id not in temp[1]:
                     return 0, 0
                 else:
-                    return log(temp[1][slack_var] + numerator_mod), log(temp[0] + denominator_mod)
+                    return log(temp[1][slack_id] + numerator_mod), log(temp[0] + denominator_mod)
             else:
-                return log(temp[1][item] + numerator_mod), log(temp[0] + denominator_mod)
+                return log(temp[1][item_id] + numerator_mod), log(temp[0] + denominator_mod)
     
     def joint_log(self, item, given, model):
         """Same as log only takes into account another model's counts."""
@@ -93,83 +329,1450 @@ class Model(object):
         """Return a tuple of the counts of the item in the 
         given context and the total counts of the given context.
         """
-        given_key = str(given)
-        if given_key not in self.internal_model:
+        table, item_id = self._get_table(item, given)
+        if table is None:
             return 0, 0
         else:
-            table = self.internal_model[given_key]
-            if item not in table[1]:
+            if item_id not in table[1]:
                 return 0, table[0]
             else:
-                return table[1][item], table[0]
+                return table[1][item_id], table[0]
     
     def check_sum_to_one(self):
         """Return True if the conditional probability tables sum to one each sum to one."""
-        for given, count_table in self.internal_model.iteritems():
+        for count_table in self.tables.itervalues():
             count = count_table[0]
             items = count_table[1]
             if count == 0:
                 return False
             else:
                 total = 0
-                for item, item_count in items.iteritems():
+                for item_count in items.itervalues():
                     total += item_count
                 if count != total:
                     return False
         return True
     
+    def merge(self, model):
+        """Add the counts of another model to this one and return this model.
+        The other model may have its own symbol table. Its symbols are interned here in
+        id order, so merging the models of consecutive shards in order assigns the same
+        ids as training on the shards one after another.
+        """
+        id_map = None
+        if model.symbols is not self.symbols:
+            intern = self.symbols.intern
+            id_map = [UNKNOWN_ID] + [intern(symbol) for symbol in model.symbols.strings[1:]]
+        tables = self.tables
+        for key, (total, items) in model.tables.iteritems():
+            if id_map is not None:
+                key = pack_context([id_map[symbol_id] for symbol_id in unpack_context(key)])
+                items = dict((id_map[item_id], count) for item_id, count in items.iteritems())
+            table = tables.get(key)
+            if table is None:
+                tables[key] = [total, dict(items)]
+            else:
+                table[0] += total
+                table_items = table[1]
+                for item_id, count in items.iteritems():
+                    table_items[item_id] = table_items.get(item_id, 0) + count
+        return self
+    
+    def subtract(self, model):
+        """Take the counts of another model off this one and return this model, undoing
+        merge. Items and contexts whose counts reach zero are removed. The other model may
+        have its own symbol table.
+        Raise ValueError, without changing anything, if its counts aren't part of these.
+        """
+        id_map = None
+        if model.symbols is not self.symbols:
+            get_id = self.symbols.get_id
+            id_map = [UNKNOWN_ID] + [get_id(symbol) for symbol in model.symbols.strings[1:]]
+        tables = self.tables
+        changes = []
+        for other_key, (total, items) in model.tables.iteritems():
+            key = other_key
+            if id_map is not None:
+                ids = [id_map[symbol_id] for symbol_id in unpack_context(key)]
+                items = dict((id_map[item_id], count) for item_id, count in items.iteritems())
+                key = None if UNKNOWN_ID in ids else pack_context(ids)
+            table = tables.get(key)
+            if table is None or table[0] < total or \
+               any(table[1].get(item_id, 0) < count for item_id, count in items.iteritems()):
+                raise ValueError("The counts given %r aren't part of this model." %
+                                 model.get_given_string(other_key))
+            changes.append((key, table, total, items))
+        for key, table, total, items in changes:
+            table[0] -= total
+            if table[0] == 0:
+                del tables[key]
+                continue
+            table_items = table[1]
+            for item_id, count in items.iteritems():
+                table_items[item_id] -= count
+                if table_items[item_id] == 0 and count:
+                    del table_items[item_id]
+        return self
+    
     def mimic(self, model):
-        """Take and deep copy the contents of the given model."""
-        self.internal_model = copy.deepcopy(model.internal_model)
+        """Take and copy the contents of the given model, sharing its symbol table."""
+        self.symbols = model.symbols
+        self.tables = dict((key, [table[0], dict(table[1])]) for key, table in model.tables.iteritems())
     
     def get_table_iterator(self, given):
         """Return an iterator over the given table's keys."""
-        if given not in self.internal_model:
+        key = self.get_context_key(given)
+        table = None if key is None else self._get_complete_table(key)
+        if table is None:
             return []
         else:
-            return iter(self.internal_model[given][1])
+            return iter(self._decode_items(table[1]))
     
     def get_number_of_tables(self):
-        return len(self.internal_model)
+        return len(self.tables)
+    
+    def get_number_of_entries(self):
+        total_entries = 0
+        for table in self.tables.itervalues():
+            total_entries += len(table[1])
+        return total_entries
+    
+    def prune(self, min_count=2, min_total=1, junk_id=None, orders=None, reference=None):
+        """Remove the items counted fewer than min_count times in a context, then the
+        contexts counted fewer than min_total times. The prior is never pruned.
+        junk_id - Add the counts of the removed items to this item in their context,
+                  otherwise take them off the context's total. Either way every table
+                  still sums to one, see check_sum_to_one.
+        orders - The context lengths to prune, by default all of them.
+        reference - The tables of a model this one's counts were derived from. Its
+                    counts decide for the items it has, so that both models remove
+                    the same ones.
+        Return the number of items and the number of contexts removed.
+        """
+        if not isinstance(self.tables, dict):
+            # Memory mapped tables are read-only, so prune a copy.
+            self.tables = dict((key, [table[0], dict(table[1])]) for key, table in self.tables.iteritems())
+        return prune_tables(self.tables, min_count, min_total, junk_id, orders, reference)
     
     def get_average_table_length(self):
-        total = len(self.internal_model)
+        total = len(self.tables)
         total_entries = 0
-        for i, j in self.internal_model.iteritems():
-            total_entries += len(j[1])
+        for table in self.tables.itervalues():
+            total_entries += len(table[1])
         return float(total_entries)/float(total)
     
     def print_model(self):
         print self.classes
         print self.words
 
+class LayeredItems(object):
+    """Read-only {item id: count} view adding a layer's counts to a base's."""
+    
+    def __init__(self, base_items, items, junk_id=None):
+        self.base_items = base_items
+        self.items = items
+        self.junk_id = junk_id
+    
+    def get(self, item_id, default=None):
+        base_items = self.base_items
+        count = None if base_items is None else base_items.get(item_id)
+        items = self.items
+        if items is not None:
+            delta = items.get(item_id)
+            if delta is not None:
+                count = delta if count is None else count + delta
+        if count is None and item_id == self.junk_id:
+            count = 0
+        return default if count is None else count
+    
+    def __getitem__(self, item_id):
+        count = self.get(item_id)
+        if count is None:
+            raise KeyError(item_id)
+        return count
+    
+    def __contains__(self, item_id):
+        return self.get(item_id) is not None
+    
+    def keys(self):
+        keys = set()
+        if self.base_items is not None:
+            keys.update(self.base_items.keys())
+        if self.items is not None:
+            keys.update(self.items.keys())
+        if self.junk_id is not None:
+            keys.add(self.junk_id)
+        return sorted(keys)
+    
+    def __len__(self):
+        return len(self.keys())
+    
+    def __iter__(self):
+        return iter(self.keys())
+    
+    def iterkeys(self):
+        return iter(self.keys())
+    
+    def itervalues(self):
+        return (self[item_id] for item_id in self.keys())
+    
+    def iteritems(self):
+        return ((item_id, self[item_id]) for item_id in self.keys())
+
+class OverlayTables(object):
+    """The {context key: [total, items]} tables of an OverlayModel.
+    get and [] return the base's table with the layer's increments added through a
+    LayeredItems view, or the stored table of a context only one of them has, so an
+    unchanged base context's items don't list the virtual JUNK item.
+    Iterating materializes it, so the items and values are complete copies.
+    """
+    
+    def __init__(self, overlay):
+        self.overlay = overlay
+    
+    def get(self, key, default=None):
+        overlay = self.overlay
+        delta = overlay.layer.get(key)
+        if delta is None:
+            return overlay.base.tables.get(key, default)
+        # Skip the overlays below that didn't change the context, taking their JUNK item.
+        junk_id = overlay.junk_id
+        base = overlay.base
+        while isinstance(base, OverlayModel) and key not in base.layer:
+            if junk_id is None:
+                junk_id = base.junk_id
+            base = base.base
+        base_table = base.tables.get(key)
+        if base_table is None:
+            return delta
+        if key == PRIOR_KEY:
+            junk_id = None
+        return [base_table[0] + delta[0], LayeredItems(base_table[1], delta[1], junk_id)]
+    
+    def __getitem__(self, key):
+        table = self.get(key)
+        if table is None:
+            raise KeyError(key)
+        return table
+    
+    def __contains__(self, key):
+        return key in self.overlay.layer or key in self.overlay.base.tables
+    
+    def keys(self):
+        keys = list(self.overlay.layer)
+        layer = self.overlay.layer
+        for key in self.overlay.base.tables.iterkeys():
+            if key not in layer:
+                keys.append(key)
+        return keys
+    
+    def iterkeys(self):
+        return iter(self.keys())
+    
+    def __iter__(self):
+        return iter(self.keys())
+    
+    def __len__(self):
+        return len(self.keys())
+    
+    def iteritems(self):
+        overlay = self.overlay
+        for key in self.keys():
+            yield key, overlay._get_complete_table(key)
+    
+    def itervalues(self):
+        for key, table in self.iteritems():
+            yield table
+
+class OverlayModel(Model):
+    """A copy-on-write view of another model's counts.
+    Updates are kept in the layer as each context's increments over the base,
+    [total increment, {item id: count increment}], and lookups add them to the
+    base's counts, so the layer only holds the counts that changed and the base is
+    never modified.
+    junk_id - Count this item zero times in every context of the base but the prior
+              without storing it, the way signal_end_of_training adds JUNK.
+    """
+    
+    def __init__(self, base, junk_id=None):
+        Model.__init__(self, base.symbols)
+        self.base = base
+        self.junk_id = junk_id
+        self.layer = {}
+        self.tables = OverlayTables(self)
+    
+    def get_virtual_junk_id(self, key):
+        if key == PRIOR_KEY:
+            return None
+        if self.junk_id is not None and key in self.base.tables:
+            return self.junk_id
+        return self.base.get_virtual_junk_id(key)
+    
+    def _get_complete_table(self, key):
+        base_table = self.base._get_complete_table(key)
+        delta = self.layer.get(key)
+        if base_table is None:
+            return delta
+        junk_id = self.junk_id if key != PRIOR_KEY else None
+        if delta is None and (junk_id is None or junk_id in base_table[1]):
+            return base_table
+        total = base_table[0]
+        items = copy_items(base_table[1])
+        if junk_id is not None and junk_id not in items:
+            items[junk_id] = 0
+        if delta is not None:
+            total += delta[0]
+            for item_id, count in delta[1].iteritems():
+                items[item_id] = items.get(item_id, 0) + count
+        return [total, items]
+    
+    def _get_table(self, item, given):
+        table, item_id = Model._get_table(self, item, given)
+        if table is not None and item_id not in table[1]:
+            # The virtual JUNK item may be looked up as the slack variable.
+            table = self._get_complete_table(self.get_context_key(given))
+        return table, item_id
+    
+    def add_by_key(self, item_id, key, increment=1):
+        temp = self.layer.get(key)
+        if temp is None:
+            temp = self.layer[key] = [0, {}]
+        temp[0] += increment
+        items = temp[1]
+        items[item_id] = items.get(item_id, 0) + increment
+    
+    def mimic(self, model):
+        raise TypeError("An overlay model can't take another model's contents.")
+    
+    def prune(self, min_count=2, min_total=1, junk_id=None, orders=None, reference=None):
+        """Prune the changed counts, see Model.prune. The base is pruned on its own.
+        A changed context that would be removed as a whole drops its changes instead,
+        leaving the base's table.
+        """
+        removed = [key for key in self.layer
+                   if prune_tables({key: self._get_complete_table(key)}, min_count, min_total,
+                                   junk_id, orders, reference, False)[1]]
+        for key in removed:
+            del self.layer[key]
+        # The increments are decided on the same way as the base's counts, by the
+        # reference's counts or their own, and their removed mass moves to junk_id too.
+        items_removed, contexts_removed = prune_tables(self.layer, min_count, 0, junk_id, orders, reference)
+        return items_removed, contexts_removed + len(removed)
+    
+    def detach(self):
+        """Copy the rest of the base's counts into the layer so that later changes
+        to the base no longer show through.
+        """
+        self.layer = dict((key, [table[0], dict(table[1])]) for key, table in self.tables.iteritems())
+        self.base = Model(self.symbols)
+        self.junk_id = None
+
+# How CompiledModel.quantize can round log probabilities.
+FLOAT16 = 'float16'
+UINT8 = 'uint8'
+UINT16 = 'uint16'
+CODEBOOK_SIZES = {UINT8: 256, UINT16: 65536}
+CODEBOOK_ITERATIONS = 8
+
+def build_codebook(values, size, iterations=CODEBOOK_ITERATIONS):
+    """Return a sorted list of at most size values to round the values to, fitted by
+    Lloyd's algorithm starting from evenly spaced quantiles.
+    """
+    distinct = sorted(set(values))
+    if len(distinct) <= size:
+        return distinct
+    ordered = sorted(values)
+    codebook = sorted(set(ordered[(2*i + 1)*len(ordered)//(2*size)] for i in xrange(size)))
+    for iteration in xrange(iterations):
+        boundaries = get_boundaries(codebook)
+        sums = [0.0]*len(codebook)
+        counts = [0]*len(codebook)
+        for value in ordered:
+            i = bisect_right(boundaries, value)
+            sums[i] += value
+            counts[i] += 1
+        codebook = sorted(set(sums[i]/counts[i] if counts[i] else codebook[i] for i in xrange(len(codebook))))
+    return codebook
+
+def get_boundaries(codebook):
+    """Return the midpoints between consecutive values of a sorted codebook. A value
+    rounds to codebook[bisect_right(boundaries, value)].
+    """
+    return [(a + b)/2 for a, b in zip(codebook, codebook[1:])]
+
+class QuantizedLogs(object):
+    """The logs of one context of a quantized CompiledModel, read like the dict of
+    {item id: (log numerator, log denominator)} they replace. The item ids are kept
+    sorted in one array and their codes, indices into the shared list of codebook
+    pairs, in another of one or two bytes each.
+    """
+    __slots__ = ('ids', 'codes', 'pairs')
+    
+    def __init__(self, logs, get_code, typecode, pairs):
+        ids = sorted(logs)
+        self.ids = array('i', ids)
+        self.codes = array(typecode, [get_code(logs[item_id][0] - logs[item_id][1]) for item_id in ids])
+        self.pairs = pairs
+    
+    def get(self, item_id, default=None):
+        ids = self.ids
+        i = bisect_left(ids, item_id)
+        if i < len(ids) and ids[i] == item_id:
+            return self.pairs[self.codes[i]]
+        return default
+    
+    def __getitem__(self, item_id):
+        logs = self.get(item_id)
+        if logs is None:
+            raise KeyError(item_id)
+        return logs
+    
+    def __contains__(self, item_id):
+        return self.get(item_id) is not None
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    def __iter__(self):
+        return iter(self.ids)
+    
+    def itervalues(self):
+        pairs = self.pairs
+        return (pairs[code] for code in self.codes)
+    
+    def iteritems(self):
+        pairs = self.pairs
+        return ((item_id, pairs[code]) for item_id, code in zip(self.ids, self.codes))
+
+class CompiledModel(object):
+    """Read-only smoothed log probabilities precomputed from a Model.
+    Each context maps to ({item id: (log numerator, log denominator)}, fallback)
+    where fallback is the slack variable's logs, or 0, 0 if it has none.
+    The prior table is compiled without mods, the same way the classifiers use it.
+    """
+    
+    def __init__(self, model, numerator_mod=0, denominator_mod=0, slack_var=None, use_mods_for_junk_given=False):
+        self.symbols = model.symbols
+        self.tables = {}
+        self.prior = {}
+        # Keep the order that get_table_iterator('') returns classes in.
+        self.class_names = list(model.get_table_iterator(''))
+        self.class_ids = [self.symbols.get_id(class_name) for class_name in self.class_names]
+        if use_mods_for_junk_given:
+            self.unseen = (log(numerator_mod), log(denominator_mod))
+        else:
+            self.unseen = (0, 0)
+        slack_id = self.symbols.get_id(slack_var)
+        for key, table in model.tables.iteritems():
+            total, items = table
+            logs = {}
+            if key == PRIOR_KEY:
+                log_total = log(total)
+                for item_id, count in items.iteritems():
+                    self.prior[item_id] = (log(count), log_total)
+                continue
+            log_total = log(total + denominator_mod)
+            for item_id, count in items.iteritems():
+                logs[item_id] = (log(count + numerator_mod), log_total)
+            self.tables[key] = (logs, logs.get(slack_id, (0, 0)))
+        # The values log probabilities are rounded to, see quantize.
+        self.quantization = None
+        self.codebook = None
+    
+    def quantize(self, mode):
+        """Round every log probability but the prior's to one of a codebook of values
+        shared by all the contexts. Each context's logs become QuantizedLogs, which
+        store an item as its id and a one or two byte code and read it back as the
+        codebook's (log probability, 0) pair, so the scoring engines sum it as before.
+        mode - FLOAT16 to round to half precision, which needs numpy, or UINT8 or
+               UINT16 for a codebook of at most 256 or 65536 values fitted to the model's.
+        """
+        values = [numerator - denominator for logs, fallback in self.tables.itervalues()
+                  for numerator, denominator in logs.itervalues()]
+        if mode == FLOAT16:
+            if np is None:
+                raise ValueError("Rounding to float16 needs numpy.")
+            rounded = dict(zip(values, np.array(values).astype(np.float16).astype(float).tolist()))
+            codebook = sorted(set(rounded.itervalues()))
+            codes = dict((value, code) for code, value in enumerate(codebook))
+            get_code = lambda value: codes[rounded[value]]
+        elif mode in CODEBOOK_SIZES:
+            codebook = build_codebook(values, CODEBOOK_SIZES[mode])
+            boundaries = get_boundaries(codebook)
+            get_code = lambda value: bisect_right(boundaries, value)
+        else:
+            raise ValueError("Unknown quantization %r." % (mode,))
+        typecode = 'B' if len(codebook) <= 256 else 'H'
+        pairs = [(value, 0.0) for value in codebook]
+        for key, (logs, fallback) in self.tables.items():
+            # A missing slack variable adds nothing and stays that way.
+            if fallback != (0, 0):
+                fallback = pairs[get_code(fallback[0] - fallback[1])]
+            self.tables[key] = (QuantizedLogs(logs, get_code, typecode, pairs), fallback)
+        self.quantization = mode
+        self.codebook = codebook
+    
+    def smoothed_log_by_key(self, item_id, key):
+        """Return the logs of the numerator and denominator for an interned item and packed context."""
+        table = self.tables.get(key)
+        if table is None:
+            return self.unseen
+        return table[0].get(item_id, table[1])
+    
+    def smoothed_log(self, item, given):
+        """Same as Model.smoothed_log with the mods and slack variable the model was compiled with."""
+        symbols = self.symbols
+        if not given:
+            return self.prior.get(symbols.get_id(item), (0, 0))
+        key = pack_context([symbols.get_id(symbol) for symbol in given])
+        return self.smoothed_log_by_key(symbols.get_id(item), key)
+
+# Scoring engine configuration.
+UNSMOOTHED = 'unsmoothed'
+SMOOTHED = 'smoothed'
+SEMI_SUPERVISED = 'semi-supervised'
+NO_SMOOTHING = 'none'
+PLUS_ONE = 'plus-one'
+TYPES = 'types'
+SEMI_SUPERVISED_TYPES = 'semi-supervised-types'
+
+MODEL_ATTRIBUTES = {
+    UNSMOOTHED: 'model',
+    SMOOTHED: 'smoothed_model',
+    SEMI_SUPERVISED: 'semi_supervised_model',
+}
+TYPES_ATTRIBUTES = {
+    TYPES: 'types',
+    SEMI_SUPERVISED_TYPES: 'semi_supervised_types',
+}
+
+# The scoring engine configuration (order, smoothing, model, use_prior, types)
+# behind each of the classifier's n-gram classify methods.
+SCORING_METHODS = {
+    'classify': (0, NO_SMOOTHING, UNSMOOTHED, True, None),
+    'classify_plus_one': (0, PLUS_ONE, SMOOTHED, True, None),
+    'classify_prev_token': (1, NO_SMOOTHING, UNSMOOTHED, True, None),
+    'classify_prev_token_plus_one': (1, PLUS_ONE, SMOOTHED, True, None),
+    'classify_prev_prev_token': (2, NO_SMOOTHING, UNSMOOTHED, True, None),
+    'classify_prev_prev_token_plus_one': (2, PLUS_ONE, SMOOTHED, True, None),
+    'classify_add_hoc': (2, PLUS_ONE, SMOOTHED, False, None),
+    'classify_prev_prev_token_plus_one_special': (2, PLUS_ONE, SEMI_SUPERVISED, True, TYPES),
+    'classify_semi_supervised': (2, PLUS_ONE, SEMI_SUPERVISED, True, None),
+}
+
+class ScoringEngine(object):
+    """Score every class of a classifier's model in one pass over a document.
+    The document's n-grams are extracted once and shared by all the classes.
+    order - The number of previous tokens in each context: 0, 1 or 2.
+    smoothing - NO_SMOOTHING or PLUS_ONE.
+    model - UNSMOOTHED, SMOOTHED or SEMI_SUPERVISED.
+    use_prior - Whether the class prior is part of the score.
+    types - TYPES or SEMI_SUPERVISED_TYPES, the type count plus one smoothing uses.
+            Defaults to the types that go with the model.
+    """
+    
+    def __init__(self, classifier, order=2, smoothing=PLUS_ONE, model=SMOOTHED, use_prior=True, types=None):
+        if order not in (0, 1, 2):
+            raise ValueError("Order must be 0, 1 or 2, not %r." % (order,))
+        if smoothing not in (NO_SMOOTHING, PLUS_ONE):
+            raise ValueError("Unknown smoothing %r." % (smoothing,))
+        if model not in MODEL_ATTRIBUTES:
+            raise ValueError("Unknown model %r." % (model,))
+        if types is None:
+            types = SEMI_SUPERVISED_TYPES if model == SEMI_SUPERVISED else TYPES
+        if types not in TYPES_ATTRIBUTES:
+            raise ValueError("Unknown types %r." % (types,))
+        self.classifier = classifier
+        self.order = order
+        self.smoothing = smoothing
+        self.model = model
+        self.use_prior = use_prior
+        self.types = types
+        # The engine's ScoreCache, see Classifier.enable_score_cache.
+        self.cache = None
+    
+    def get_model(self):
+        return getattr(self.classifier, MODEL_ATTRIBUTES[self.model])
+    
+    def get_compiled_model(self):
+        """Return the classifier's compiled model if it matches this configuration, otherwise None."""
+        if self.smoothing == NO_SMOOTHING:
+            return self.classifier.compiled_model if self.model == UNSMOOTHED else None
+        if self.model == SMOOTHED and self.types == TYPES:
+            return self.classifier.compiled_smoothed_model
+        if self.model == SEMI_SUPERVISED and self.types == SEMI_SUPERVISED_TYPES:
+            return self.classifier.compiled_semi_supervised_model
+        return None
+    
+    def compile(self):
+        """Return a compiled model for this configuration, the classifier's if it has a matching one."""
+        compiled_model = self.get_compiled_model()
+        if compiled_model is not None:
+            return compiled_model
+        model = self.get_model()
+        if self.smoothing == PLUS_ONE:
+            number_of_types = len(getattr(self.classifier, TYPES_ATTRIBUTES[self.types]))
+            return CompiledModel(model, 1, number_of_types, self.classifier.JUNK, True)
+        return CompiledModel(model)
+    
+    def get_ngrams(self, token_list):
+        """Return the document as a list of (context suffix, token id) pairs.
+        The suffix packs the previous token ids; the context key of a class is
+        ((class_id << order*SYMBOL_BITS | suffix) << ORDER_BITS) | order + 1.
+        """
+        ids = self.classifier.symbols.ids
+        return self.get_ngrams_by_id([ids.get(token, UNKNOWN_ID) for token in token_list])
+    
+    def get_ngrams_by_id(self, token_ids):
+        """Same as get_ngrams, but for the ids of the tokens, e.g. from tokenizer.Tokenizer.token_ids."""
+        prev_prev_id = prev_id = self.classifier.symbols.get_id(self.classifier.START)
+        order = self.order
+        ngrams = []
+        for token_id in token_ids:
+            if order == 2:
+                ngrams.append(((prev_prev_id << SYMBOL_BITS) | prev_id, token_id))
+            elif order == 1:
+                ngrams.append((prev_id, token_id))
+            else:
+                ngrams.append((0, token_id))
+            prev_prev_id = prev_id
+            prev_id = token_id
+        return ngrams
+    
+    def score(self, token_list):
+        """Return a list of (class name, log probability) for every class, in the
+        order the model's class table is iterated in.
+        """
+        if self.cache is not None:
+            return self.cache.score(token_list)
+        return self.score_ngrams(self.get_ngrams(token_list))
+    
+    def score_ngrams(self, ngrams):
+        """Same as score, but for n-grams from get_ngrams."""
+        compiled_model = self.get_compiled_model()
+        if compiled_model is not None:
+            class_names = compiled_model.class_names
+            class_ids = compiled_model.class_ids
+            prior = compiled_model.prior
+        else:
+            model = self.get_model()
+            class_names = list(model.get_table_iterator(''))
+            class_ids = [model.symbols.get_id(class_name) for class_name in class_names]
+            prior = self._get_prior(model)
+        shift = self.order*SYMBOL_BITS
+        scores = []
+        for class_name, class_id in zip(class_names, class_ids):
+            if self.use_prior:
+                total1, total2 = prior[class_id]
+            else:
+                total1, total2 = 0, 0
+            prefix = class_id << shift
+            if compiled_model is not None:
+                total1, total2 = self._sum_compiled(compiled_model, prefix, ngrams, total1, total2)
+            elif self.smoothing == PLUS_ONE:
+                total1, total2 = self._sum_plus_one(model, prefix, ngrams, total1, total2)
+            else:
+                total1, total2 = self._sum_unsmoothed(model, prefix, ngrams, total1, total2)
+            scores.append((class_name, total1 - total2))
+        return scores
+    
+    def sum_class(self, class_id, ngrams, total1=0, total2=0):
+        """Add the logs of the numerators and denominators of the n-grams from get_ngrams,
+        in the context of one class, to total1 and total2 and return the two sums.
+        """
+        prefix = class_id << (self.order*SYMBOL_BITS)
+        compiled_model = self.get_compiled_model()
+        if compiled_model is not None:
+            return self._sum_compiled(compiled_model, prefix, ngrams, total1, total2)
+        elif self.smoothing == PLUS_ONE:
+            return self._sum_plus_one(self.get_model(), prefix, ngrams, total1, total2)
+        else:
+            return self._sum_unsmoothed(self.get_model(), prefix, ngrams, total1, total2)
+    
+    def classify(self, token_list):
+        """Return the most probable class name and its log probability.
+        Ties go to the class scored last.
+        """
+        return self._get_most_probable(self.score(token_list))
+    
+    def classify_ngrams(self, ngrams):
+        """Same as classify, but for n-grams from get_ngrams."""
+        return self._get_most_probable(self.score_ngrams(ngrams))
+    
+    def _get_most_probable(self, scores):
+        max_class = "No Class"
+        max_log_prob = -sys.float_info.max
+        for class_name, total in scores:
+            # Check for better class found.
+            if total >= max_log_prob:
+                max_log_prob = total
+                max_class = class_name
+        return max_class, max_log_prob
+    
+    def _get_prior(self, model):
+        """Return {class id: (log count, log total)} of the model's class table."""
+        prior = {}
+        table = model.tables.get(PRIOR_KEY)
+        if table is not None:
+            log_total = log(table[0])
+            for class_id, count in table[1].iteritems():
+                prior[class_id] = (log(count), log_total)
+        return prior
+    
+    def _sum_compiled(self, compiled_model, prefix, ngrams, total1, total2):
+        if compiled_model.quantization is not None:
+            return self._sum_quantized(compiled_model, prefix, ngrams, total1, total2)
+        tables = compiled_model.tables
+        unseen = compiled_model.unseen
+        tag = self.order + 1
+        for suffix, token_id in ngrams:
+            table = tables.get(((prefix | suffix) << ORDER_BITS) | tag)
+            if table is None:
+                temp1, temp2 = unseen
+            else:
+                temp1, temp2 = table[0].get(token_id, table[1])
+            total1 += temp1
+            total2 += temp2
+        return total1, total2
+    
+    def _sum_quantized(self, compiled_model, prefix, ngrams, total1, total2):
+        """Same sums as _sum_compiled with the lookup of QuantizedLogs.get inlined."""
+        tables = compiled_model.tables
+        unseen = compiled_model.unseen
+        tag = self.order + 1
+        for suffix, token_id in ngrams:
+            table = tables.get(((prefix | suffix) << ORDER_BITS) | tag)
+            if table is None:
+                temp1, temp2 = unseen
+            else:
+                logs = table[0]
+                ids = logs.ids
+                i = bisect_left(ids, token_id)
+                if i < len(ids) and ids[i] == token_id:
+                    temp1, temp2 = logs.pairs[logs.codes[i]]
+                else:
+                    temp1, temp2 = table[1]
+            total1 += temp1
+            total2 += temp2
+        return total1, total2
+    
+    def _sum_plus_one(self, model, prefix, ngrams, total1, total2):
+        """Same sums as Model.smoothed_log(token, given, 1, len(types), JUNK, True)."""
+        tables = model.tables
+        tag = self.order + 1
+        junk_id = model.symbols.get_id(self.classifier.JUNK)
+        number_of_types = len(getattr(self.classifier, TYPES_ATTRIBUTES[self.types]))
+        for suffix, token_id in ngrams:
+            key = ((prefix | suffix) << ORDER_BITS) | tag
+            table = tables.get(key)
+            if table is None:
+                total1 += log(1)
+                total2 += log(number_of_types)
+            else:
+                items = table[1]
+                count = items.get(token_id)
+                if count is None:
+                    count = items.get(junk_id)
+                    if count is None:
+                        if model.get_virtual_junk_id(key) != junk_id:
+                            continue
+                        count = 0
+                total1 += log(count + 1)
+                total2 += log(table[0] + number_of_types)
+        return total1, total2
+    
+    def _sum_unsmoothed(self, model, prefix, ngrams, total1, total2):
+        """Same sums as Model.log(token, given)."""
+        tables = model.tables
+        tag = self.order + 1
+        for suffix, token_id in ngrams:
+            table = tables.get(((prefix | suffix) << ORDER_BITS) | tag)
+            if table is not None:
+                count = table[1].get(token_id)
+                if count is not None:
+                    total1 += log(count)
+                    total2 += log(table[0])
+        return total1, total2
+
+class BatchTables(object):
+    """Dense class by n-gram matrix of log probabilities for scoring many documents at once.
+    There is a column for every (context suffix, token id) pair seen with any class,
+    a fallback column per suffix for tokens unseen in it, and one column for unseen suffixes.
+    Requires numpy.
+    """
+    
+    def __init__(self, compiled_model, order, use_prior=True):
+        if np is None:
+            raise ImportError("Batch classification requires numpy.")
+        self.order = order
+        self.class_names = list(compiled_model.class_names)
+        class_index = dict((class_id, i) for i, class_id in enumerate(compiled_model.class_ids))
+        tag = order + 1
+        suffix_mask = (1 << (order*SYMBOL_BITS)) - 1
+        class_shift = ORDER_BITS + order*SYMBOL_BITS
+        # Assign the columns.
+        self.pair_columns = {}
+        self.suffix_columns = {}
+        contexts = []
+        for key, table in compiled_model.tables.iteritems():
+            if key & ((1 << ORDER_BITS) - 1) != tag:
+                continue
+            i = class_index.get(key >> class_shift)
+            if i is None:
+                continue
+            suffix = (key >> ORDER_BITS) & suffix_mask
+            if suffix not in self.suffix_columns:
+                self.suffix_columns[suffix] = len(self.suffix_columns)
+            contexts.append((i, suffix, table))
+        number_of_columns = len(self.suffix_columns)
+        for i, suffix, table in contexts:
+            for token_id in table[0]:
+                pair = (suffix, token_id)
+                if pair not in self.pair_columns:
+                    self.pair_columns[pair] = number_of_columns
+                    number_of_columns += 1
+        self.unseen_column = number_of_columns
+        number_of_columns += 1
+        # Fill them in, every class starts out with the unseen context value.
+        columns_of_suffix = dict((suffix, [column]) for suffix, column in self.suffix_columns.iteritems())
+        for (suffix, token_id), column in self.pair_columns.iteritems():
+            columns_of_suffix[suffix].append(column)
+        unseen1, unseen2 = compiled_model.unseen
+        self.matrix = np.empty((len(self.class_names), number_of_columns))
+        self.matrix.fill(unseen1 - unseen2)
+        for i, suffix, table in contexts:
+            fallback1, fallback2 = table[1]
+            self.matrix[i, columns_of_suffix[suffix]] = fallback1 - fallback2
+            pair_columns = self.pair_columns
+            columns = [pair_columns[(suffix, token_id)] for token_id in table[0]]
+            values = [logs[0] - logs[1] for logs in table[0].itervalues()]
+            self.matrix[i, columns] = values
+        self.prior = np.zeros(len(self.class_names))
+        if use_prior:
+            for i, class_id in enumerate(compiled_model.class_ids):
+                prior1, prior2 = compiled_model.prior[class_id]
+                self.prior[i] = prior1 - prior2
+    
+    def encode(self, ngrams):
+        """Return the column of each (suffix, token id) pair from ScoringEngine.get_ngrams."""
+        pair_columns = self.pair_columns
+        suffix_columns = self.suffix_columns
+        unseen_column = self.unseen_column
+        columns = []
+        for pair in ngrams:
+            column = pair_columns.get(pair)
+            if column is None:
+                column = suffix_columns.get(pair[0], unseen_column)
+            columns.append(column)
+        return columns
+    
+    def score(self, list_of_ngrams):
+        """Return a documents by classes array of log probabilities."""
+        columns = []
+        document_index = []
+        for i, ngrams in enumerate(list_of_ngrams):
+            encoded = self.encode(ngrams)
+            columns.extend(encoded)
+            document_index.extend([i]*len(encoded))
+        number_of_documents = len(list_of_ngrams)
+        scores = np.empty((number_of_documents, len(self.class_names)))
+        gathered = self.matrix[:, np.array(columns, dtype=np.intp)]
+        document_index = np.array(document_index, dtype=np.intp)
+        for i in xrange(len(self.class_names)):
+            scores[:, i] = np.bincount(document_index, weights=gathered[i], minlength=number_of_documents)
+        scores += self.prior
+        return scores
+
+# Tokens every class is scored on before the classes are ordered for BoundedScorer.
+PROBE_TOKENS = 4
+# Tokens scored between checks of a class against the bound.
+CHECK_INTERVAL = 16
+
+class BoundedScorer(object):
+    """Find the k most probable classes of a document by branch and bound.
+    Every class is scored on the first PROBE_TOKENS tokens, then the classes are
+    finished one at a time, most promising first. Every CHECK_INTERVAL tokens, a
+    class is dropped if its score so far plus an upper bound on the rest of the
+    document falls below the k-th best finished score. The bound of a token is the maximum log probability
+    of it in its context over all the classes, precomputed from the compiled model.
+    The scores of the classes that are finished are the engine's, bit for bit.
+    """
+    
+    def __init__(self, engine):
+        self.engine = engine
+        self.compiled_model = compiled_model = engine.compile()
+        self.class_names = list(compiled_model.class_names)
+        self.class_ids = list(compiled_model.class_ids)
+        order = engine.order
+        tag = order + 1
+        suffix_mask = (1 << (order*SYMBOL_BITS)) - 1
+        class_shift = ORDER_BITS + order*SYMBOL_BITS
+        class_ids = set(self.class_ids)
+        unseen_value = compiled_model.unseen[0] - compiled_model.unseen[1]
+        # The maxima over the classes of each suffix's fallback, including the unseen
+        # value if some class has no table for the suffix, and of each (suffix, token).
+        fallback_max = {}
+        suffix_counts = {}
+        ngram_max = {}
+        for key, (logs, fallback) in compiled_model.tables.iteritems():
+            if key & ((1 << ORDER_BITS) - 1) != tag or (key >> class_shift) not in class_ids:
+                continue
+            suffix = (key >> ORDER_BITS) & suffix_mask
+            suffix_counts[suffix] = suffix_counts.get(suffix, 0) + 1
+            value = fallback[0] - fallback[1]
+            if value > fallback_max.get(suffix, value - 1):
+                fallback_max[suffix] = value
+            prefix = suffix << SYMBOL_BITS
+            for item_id, (numerator, denominator) in logs.iteritems():
+                value = numerator - denominator
+                if value > ngram_max.get(prefix | item_id, value - 1):
+                    ngram_max[prefix | item_id] = value
+        for suffix, count in suffix_counts.iteritems():
+            if count < len(class_ids):
+                fallback_max[suffix] = max(fallback_max[suffix], unseen_value)
+        for ngram, value in ngram_max.iteritems():
+            ngram_max[ngram] = max(value, fallback_max[ngram >> SYMBOL_BITS])
+        self.ngram_bounds = ngram_max
+        self.suffix_bounds = fallback_max
+        self.unseen_value = unseen_value
+    
+    def bound(self, suffix, token_id):
+        """Return an upper bound of the log probability of the token in the suffix's
+        context for every class.
+        """
+        bound = self.ngram_bounds.get((suffix << SYMBOL_BITS) | token_id)
+        if bound is None:
+            bound = self.suffix_bounds.get(suffix, self.unseen_value)
+        return bound
+    
+    def _get_remaining_bounds(self, ngrams):
+        """Return the list of upper bounds of the sums of the log probabilities from
+        each position to the end, and the sum of the bounds' magnitudes.
+        """
+        ngram_bounds = self.ngram_bounds
+        suffix_bounds = self.suffix_bounds
+        unseen_value = self.unseen_value
+        remaining = [0.0]*(len(ngrams) + 1)
+        magnitude = 0.0
+        for i in xrange(len(ngrams) - 1, -1, -1):
+            suffix, token_id = ngrams[i]
+            bound = ngram_bounds.get((suffix << SYMBOL_BITS) | token_id)
+            if bound is None:
+                bound = suffix_bounds.get(suffix, unseen_value)
+            remaining[i] = remaining[i + 1] + bound
+            magnitude += abs(bound)
+        return remaining, magnitude
+    
+    def top_k(self, ngrams, k=1, stats=None):
+        """Return the k most probable (class name, log probability) of the n-grams from
+        get_ngrams, best first, with ties in the order classify breaks them.
+        stats - A dict whose 'documents', 'classes', 'classes_pruned', 'tokens' and
+                'tokens_pruned' counts are incremented. Tokens count once per class.
+        """
+        engine = self.engine
+        compiled_model = self.compiled_model
+        class_ids = self.class_ids
+        length = len(ngrams)
+        if length <= PROBE_TOKENS + CHECK_INTERVAL:
+            # Too short for the checks to pay for the bounds, so every class is scored.
+            probe = length
+        else:
+            probe = PROBE_TOKENS
+            remaining, magnitude = self._get_remaining_bounds(ngrams)
+        shift = engine.order*SYMBOL_BITS
+        partial = []
+        for class_id in class_ids:
+            if engine.use_prior:
+                total1, total2 = compiled_model.prior[class_id]
+            else:
+                total1, total2 = 0, 0
+            partial.append(engine._sum_compiled(compiled_model, class_id << shift, ngrams[:probe], total1, total2))
+        classes_pruned = tokens_pruned = 0
+        # Min heap of the k best (score, class index) finished so far.
+        best = []
+        for i in sorted(xrange(len(class_ids)), key=lambda i: partial[i][0] - partial[i][1], reverse=True):
+            total1, total2 = partial[i]
+            if probe == length or len(best) < k:
+                total1, total2 = engine._sum_compiled(compiled_model, class_ids[i] << shift, ngrams[probe:], total1, total2)
+            else:
+                # Slack for the bounds being summed in a different order than the scores.
+                threshold = best[0][0] - 1e-9*(1.0 + abs(best[0][0]) + magnitude)
+                position = probe
+                if total1 - total2 + remaining[position] < threshold:
+                    classes_pruned += 1
+                    tokens_pruned += length - position
+                    continue
+                prefix = class_ids[i] << shift
+                while position < length:
+                    end = min(length, position + CHECK_INTERVAL)
+                    total1, total2 = engine._sum_compiled(compiled_model, prefix, ngrams[position:end], total1, total2)
+                    position = end
+                    if total1 - total2 + remaining[position] < threshold:
+                        break
+                if position < length:
+                    classes_pruned += 1
+                    tokens_pruned += length - position
+                    continue
+            # Ties go to the class scored last, so the later index is the larger entry.
+            heapq.heappush(best, (total1 - total2, i))
+            if len(best) > k:
+                heapq.heappop(best)
+        if stats is not None:
+            stats['documents'] = stats.get('documents', 0) + 1
+            stats['classes'] = stats.get('classes', 0) + len(class_ids)
+            stats['classes_pruned'] = stats.get('classes_pruned', 0) + classes_pruned
+            stats['tokens'] = stats.get('tokens', 0) + length*len(class_ids)
+            stats['tokens_pruned'] = stats.get('tokens_pruned', 0) + tokens_pruned
+        return [(self.class_names[i], score) for score, i in sorted(best, reverse=True)]
+
+class SelfTrainingQueue(object):
+    """The unlabeled documents of a sub-batch with their cached per-class scores,
+    kept in a heap per class so that the most probable document can be found
+    without rescoring the whole sub-batch after every semi supervised update.
+    Scores are those of classify_prev_prev_token_plus_one_special. Only the
+    documents sharing a context with the one just trained on get rescored, for the
+    class trained on; everything is rescored if the types or classes change.
+    """
+    
+    def __init__(self, classifier, documents):
+        self.classifier = classifier
+        self.engine = classifier.get_scoring_engine(*SCORING_METHODS['classify_prev_prev_token_plus_one_special'])
+        self.documents = documents
+        self.remaining = set(xrange(len(documents)))
+        self.ngrams = [self.engine.get_ngrams(token_list) for token_list in documents]
+        self._rescore_all()
+    
+    def __len__(self):
+        return len(self.remaining)
+    
+    def _get_state(self):
+        """Return what, if changed, invalidates every cached score."""
+        model = self.engine.get_model()
+        prior_table = model.tables.get(PRIOR_KEY, [0, {}])
+        return len(self.classifier.types), len(model.symbols), len(prior_table[1])
+    
+    def _rescore_all(self):
+        model = self.engine.get_model()
+        if self._get_state()[1] != getattr(self, 'state', (None, None))[1]:
+            # New symbols may be in the documents.
+            self.ngrams = [self.engine.get_ngrams(token_list) for token_list in self.documents]
+        self.class_ids = list(model.tables.get(PRIOR_KEY, [0, {}])[1])
+        self.heaps = dict((class_id, []) for class_id in self.class_ids)
+        self.versions = {}
+        self.magnitude = 0.0
+        self.index = {}
+        for position in self.remaining:
+            for suffix, token_id in self.ngrams[position]:
+                self.index.setdefault(suffix, set()).add(position)
+            for class_id in self.class_ids:
+                self._rescore(position, class_id)
+        self.state = self._get_state()
+    
+    def _rescore(self, position, class_id):
+        total1, total2 = self.engine.sum_class(class_id, self.ngrams[position])
+        version = self.versions.get((position, class_id), 0) + 1
+        self.versions[(position, class_id)] = version
+        self.magnitude = max(self.magnitude, total1 + total2)
+        heapq.heappush(self.heaps[class_id], (total2 - total1, position, version))
+    
+    def _pop_valid(self, class_id):
+        """Pop stale entries off the class's heap and return the top valid one or None."""
+        heap = self.heaps[class_id]
+        while heap:
+            negative_value, position, version = heap[0]
+            if position in self.remaining and self.versions[(position, class_id)] == version:
+                return heap[0]
+            heapq.heappop(heap)
+        return None
+    
+    def pop_most_probable(self):
+        """Remove the document classify_prev_prev_token_plus_one_special is most sure of.
+        Return its position and class, chosen exactly as the exhaustive search does.
+        """
+        model = self.engine.get_model()
+        prior = self.engine._get_prior(model)
+        # Find the best approximate score, cached token sums plus the current prior.
+        best = None
+        prior_magnitude = 0.0
+        for class_id in self.class_ids:
+            prior1, prior2 = prior[class_id]
+            prior_magnitude = max(prior_magnitude, prior1 + prior2)
+            top = self._pop_valid(class_id)
+            if top is not None and (best is None or prior1 - prior2 - top[0] > best):
+                best = prior1 - prior2 - top[0]
+        # The cached sums are added in a different order than the exact scores, so
+        # every document within rounding error of the best is rescored exactly.
+        candidates = set()
+        if best is not None:
+            margin = 1e-9*(1.0 + self.magnitude + prior_magnitude)
+            for class_id in self.class_ids:
+                prior1, prior2 = prior[class_id]
+                threshold = best - margin - (prior1 - prior2)
+                heap = self.heaps[class_id]
+                popped = []
+                while True:
+                    top = self._pop_valid(class_id)
+                    if top is None or -top[0] < threshold:
+                        break
+                    popped.append(heapq.heappop(heap))
+                    candidates.add(top[1])
+                for entry in popped:
+                    heapq.heappush(heap, entry)
+        max_class = 'No Class'
+        max_class_log = -sys.float_info.max
+        max_class_index = min(self.remaining)
+        for position in sorted(candidates):
+            c, log_c = self.engine.classify(self.documents[position])
+            if log_c > max_class_log:
+                max_class_log = log_c
+                max_class = c
+                max_class_index = position
+        self.remaining.remove(max_class_index)
+        return max_class_index, max_class
+    
+    def update(self, position, class_name):
+        """Rescore after the document at position was trained on as class_name."""
+        if self._get_state() != self.state:
+            self._rescore_all()
+            return
+        class_id = self.engine.get_model().symbols.get_id(class_name)
+        affected = set()
+        for suffix, token_id in self.ngrams[position]:
+            affected.update(self.index[suffix])
+        for other in affected & self.remaining:
+            self._rescore(other, class_id)
+
+class ScoreCache(object):
+    """Cached ScoringEngine.score results for documents that repeat or share prefixes.
+    A trie over token ids holds every class's (log numerator, log denominator) sums
+    after the prefixes seen so far, every checkpoint_interval tokens and at the end
+    of each document. A new document resumes from the deepest sums on its path.
+    The two previous tokens are the last two on the path, so the rest scores as if
+    from the start and the results are the same bit for bit. On top of the trie,
+    an LRU cache holds the results of whole token lists.
+    max_nodes - The trie is emptied when it would grow past this many nodes.
+    max_results - The number of whole documents the LRU cache holds.
+    max_depth - Only prefixes up to this many tokens are added to the trie.
+    checkpoint_interval - The number of tokens between the sums stored in the trie.
+    """
+    
+    def __init__(self, engine, max_nodes=100000, max_results=10000, max_depth=64, checkpoint_interval=4):
+        self.engine = engine
+        self.max_nodes = max_nodes
+        self.max_results = max_results
+        self.max_depth = max_depth
+        self.checkpoint_interval = checkpoint_interval
+        self.stats = dict.fromkeys(['hits', 'misses', 'prefix_hits', 'tokens_reused',
+                                    'tokens_scored', 'evictions', 'flushes', 'invalidations'], 0)
+        self.clear()
+    
+    def clear(self):
+        """Forget everything, e.g. because the model changed."""
+        # Trie nodes are [{token id: child node}, sums or None].
+        self.root = None
+        self.number_of_nodes = 0
+        self.results = OrderedDict()
+    
+    def invalidate(self):
+        if self.root is not None or self.results:
+            self.stats['invalidations'] += 1
+        self.clear()
+    
+    def _new_root(self):
+        """Return the trie's root, holding each class's prior sums."""
+        engine = self.engine
+        compiled_model = engine.get_compiled_model()
+        if compiled_model is not None:
+            class_names = compiled_model.class_names
+            class_ids = compiled_model.class_ids
+            prior = compiled_model.prior
+        else:
+            model = engine.get_model()
+            class_names = list(model.get_table_iterator(''))
+            class_ids = [model.symbols.get_id(class_name) for class_name in class_names]
+            prior = engine._get_prior(model)
+        self.class_names = class_names
+        self.class_ids = class_ids
+        if engine.use_prior:
+            sums = [prior[class_id] for class_id in class_ids]
+        else:
+            sums = [(0, 0)]*len(class_ids)
+        self.root = [{}, sums]
+        self.number_of_nodes = 1
+    
+    def score(self, token_list):
+        """Same as ScoringEngine.score."""
+        key = tuple(token_list)
+        scores = self.results.pop(key, None)
+        if scores is not None:
+            self.stats['hits'] += 1
+            self.results[key] = scores
+            return list(scores)
+        self.stats['misses'] += 1
+        scores = self._score_ngrams(self.engine.get_ngrams(token_list))
+        self.results[key] = scores
+        if len(self.results) > self.max_results:
+            self.results.popitem(last=False)
+            self.stats['evictions'] += 1
+        return list(scores)
+    
+    def _score_ngrams(self, ngrams):
+        if self.root is None:
+            self._new_root()
+        # Find the deepest sums on the document's path.
+        node = self.root
+        depth = 0
+        sums = node[1]
+        path = [node]
+        for suffix, token_id in ngrams:
+            node = node[0].get(token_id)
+            if node is None:
+                break
+            path.append(node)
+            if node[1] is not None:
+                depth = len(path) - 1
+                sums = node[1]
+        if depth:
+            self.stats['prefix_hits'] += 1
+            self.stats['tokens_reused'] += depth
+        self.stats['tokens_scored'] += len(ngrams) - depth
+        sum_class = self.engine.sum_class
+        class_ids = self.class_ids
+        length = len(ngrams)
+        # Score the rest a checkpoint at a time, storing the sums in the trie.
+        limit = min(length, self.max_depth)
+        position = depth
+        while position < length:
+            if position < limit:
+                end = min(limit, position - position % self.checkpoint_interval + self.checkpoint_interval)
+            else:
+                end = length
+            segment = ngrams[position:end]
+            sums = [sum_class(class_id, segment, total1, total2)
+                    for class_id, (total1, total2) in zip(class_ids, sums)]
+            position = end
+            if end <= limit:
+                self._store(path, ngrams, end, sums)
+        return [(class_name, total1 - total2) for class_name, (total1, total2) in zip(self.class_names, sums)]
+    
+    def _store(self, path, ngrams, depth, sums):
+        """Store the sums of the first depth n-grams, adding the trie nodes on the way."""
+        if self.number_of_nodes + depth + 1 - len(path) > self.max_nodes:
+            # Start over rather than track the use of every node.
+            self.stats['flushes'] += 1
+            sums_root = self.root[1]
+            self.root = [{}, sums_root]
+            self.number_of_nodes = 1
+            path[:] = [self.root]
+        while len(path) <= depth:
+            children = path[-1][0]
+            token_id = ngrams[len(path) - 1][1]
+            node = children.get(token_id)
+            if node is None:
+                node = children[token_id] = [{}, None]
+                self.number_of_nodes += 1
+            path.append(node)
+        path[depth][1] = sums
+
+class ClassificationSession(object):
+    """Running scores of a document that arrives a token at a time, see
+    Classifier.start_session. Each token adds its log probabilities to every class's
+    sums, so a token costs the same however long the document is. The sums are added
+    in the same order as the engine's, so the result matches classifying the whole
+    token list at once.
+    engine - The ScoringEngine of the classify method.
+    threshold - Decide as soon as the leader is ahead of every other class by this
+                much log probability. None to never decide early.
+    """
+    
+    def __init__(self, engine, threshold=None):
+        self.engine = engine
+        self.threshold = threshold
+        model = engine.get_model()
+        self.class_names = list(model.get_table_iterator(''))
+        self.class_ids = [model.symbols.get_id(class_name) for class_name in self.class_names]
+        if engine.use_prior:
+            prior = engine._get_prior(model)
+            self.totals = [prior[class_id] for class_id in self.class_ids]
+        else:
+            self.totals = [(0, 0)]*len(self.class_ids)
+        self.prev_prev_id = self.prev_id = engine.classifier.symbols.get_id(engine.classifier.START)
+        self.number_of_tokens = 0
+        # The class decided on once the margin reached the threshold, otherwise None.
+        self.decision = None
+    
+    def append(self, token):
+        """Score one more token and return the current leader and its margin."""
+        token_id = self.engine.classifier.symbols.get_id(token)
+        order = self.engine.order
+        if order == 2:
+            ngrams = [((self.prev_prev_id << SYMBOL_BITS) | self.prev_id, token_id)]
+        elif order == 1:
+            ngrams = [(self.prev_id, token_id)]
+        else:
+            ngrams = [(0, token_id)]
+        self.prev_prev_id = self.prev_id
+        self.prev_id = token_id
+        self.number_of_tokens += 1
+        sum_class = self.engine.sum_class
+        totals = self.totals
+        for i, class_id in enumerate(self.class_ids):
+            totals[i] = sum_class(class_id, ngrams, *totals[i])
+        leader, margin = self.get_leader()
+        if self.decision is None and self.threshold is not None and margin >= self.threshold:
+            self.decision = leader
+        return leader, margin
+    
+    def extend(self, token_list):
+        """Score the tokens in turn and return the leader and margin after the last."""
+        result = self.get_leader()
+        for token in token_list:
+            result = self.append(token)
+        return result
+    
+    def get_scores(self):
+        """Return a list of (class name, log probability) of the tokens so far."""
+        return [(class_name, total1 - total2) for class_name, (total1, total2) in zip(self.class_names, self.totals)]
+    
+    def classify(self):
+        """Return the most probable class name and its log probability, the same as
+        the engine's classify of the tokens so far.
+        """
+        max_class = "No Class"
+        max_log_prob = -sys.float_info.max
+        for class_name, total in self.get_scores():
+            if total >= max_log_prob:
+                max_log_prob = total
+                max_class = class_name
+        return max_class, max_log_prob
+    
+    def get_leader(self):
+        """Return the most probable class name and how much more log probability it
+        has than the next best class, infinite if there is no other class.
+        """
+        max_class, max_log_prob = self.classify()
+        runner_up = -float('inf')
+        for class_name, total in self.get_scores():
+            if class_name != max_class and total > runner_up:
+                runner_up = total
+        return max_class, max_log_prob - runner_up
+
+class LazySection(object):
+    """A Classifier attribute that can be loaded from the model file the first time
+    it is used, see Classifier.load_model. Once loaded the value is an ordinary
+    instance attribute, so later accesses cost nothing extra.
+    """
+    
+    def __init__(self, name):
+        self.name = name
+    
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        loader = instance._section_loaders.pop(self.name, None)
+        if loader is None:
+            raise AttributeError(self.name)
+        start_time = time.time()
+        value = loader()
+        instance.section_load_times[self.name] = time.time() - start_time
+        setattr(instance, self.name, value)
+        if instance.instrumentation is not None:
+            instance._instrument_models()
+        return value
+
 class Classifier(object):
     
     START = "__start__"
     JUNK = "__junk__"
     
+    # Sections of the model file that load_model can load on first use.
+    model = LazySection('model')
+    smoothed_model = LazySection('smoothed_model')
+    semi_supervised_model = LazySection('semi_supervised_model')
+    types = LazySection('types')
+    semi_supervised_types = LazySection('semi_supervised_types')
+    classes = LazySection('classes')
+    
     def __init__(self):
+        # Loaders of sections not loaded yet and the seconds each section took to load.
+        self._section_loaders = {}
+        self.section_load_times = {}
+        
         self.classes = {}
+        self.symbols = SymbolTable()
         
-        self.model = Model()
-        self.smoothed_model = Model()
+        self.model = Model(self.symbols)
+        self.smoothed_model = Model(self.symbols)
         self.types = {}
         
-        self.semi_supervised_model = Model()
+        self.semi_supervised_model = Model(self.symbols)
         self.semi_supervised_types = {}
+        
+        # Read-only log probability tables, see compile_models.
+        self.compiled_model = None
+        self.compiled_smoothed_model = None
+        self.compiled_semi_supervised_model = None
+        
+        self.scoring_engines = {}
+        self.batch_tables = {}
+        self.bounded_scorers = {}
+        # Counts of the work classify_top_k did and skipped, see BoundedScorer.top_k.
+        self.pruning_stats = {}
+        # The limits of the score caches if they are enabled, see enable_score_cache.
+        self.score_cache_limits = None
+        # The lookup counts and classify timings if they are enabled, see enable_instrumentation.
+        self.instrumentation = None
+        
+        # The open binary_model.ModelFile when a binary model is loaded.
+        self.model_file = None
+    
+    def _discard_compiled_models(self):
+        self.compiled_model = None
+        self.compiled_smoothed_model = None
+        self.compiled_semi_supervised_model = None
+        self.batch_tables = {}
+        self.bounded_scorers = {}
+        self._invalidate_score_caches()
+    
+    def _detach_overlays(self):
+        """Keep the smoothed model's counts from changing with the supervised model's."""
+        # A lazy smoothed model may not be loaded yet. If it is an overlay on the
+        # supervised counts, see binary_model.load_model_file, it is loaded now.
+        smoothed_model = self.__dict__.get('smoothed_model')
+        if smoothed_model is None and 'smoothed_model' in self._section_loaders:
+            smoothed_model = self.smoothed_model
+        if isinstance(smoothed_model, OverlayModel) and smoothed_model.base is self.model:
+            smoothed_model.detach()
     
     def _train_model(self, model, class_name, token_list, start_symbol):
         """Internal use."""
-        model.add_given(class_name, '')
-        prev_prev_token = start_symbol
-        prev_token = start_symbol
+        if model is self.model:
+            self._detach_overlays()
+        number_of_types = len(self.types)
+        intern = model.symbols.intern
+        class_id = intern(class_name)
+        model.add_by_key(class_id, PRIOR_KEY)
+        # Contexts of increasing order share the class id as their leading symbol.
+        class_key = class_id << SYMBOL_BITS
+        prev_prev_id = prev_id = intern(start_symbol)
         for token in token_list:
-            model.add_given(token, (class_name,))
-            model.add_given(token, (class_name, prev_token))
-            model.add_given(token, (class_name, prev_prev_token, prev_token))
-            prev_prev_token = prev_token
-            prev_token = token
+            token_id = intern(token)
+            model.add_by_key(token_id, (class_id << ORDER_BITS) | 1)
+            model.add_by_key(token_id, (((class_key | prev_id) << ORDER_BITS) | 2))
+            model.add_by_key(token_id, (((((class_key | prev_prev_id) << SYMBOL_BITS) | prev_id) << ORDER_BITS) | 3))
+            prev_prev_id = prev_id
+            prev_id = token_id
             self.types[token] = True
+        # The compiled plus one tables depend on the smoothed counts and the number of types.
+        if model is self.smoothed_model or model is self.semi_supervised_model or \
+           len(self.types) != number_of_types:
+            self._discard_compiled_models()
+        else:
+            # The unsmoothed tables, batch tables and bounds are built from the counts of every model.
+            self.compiled_model = None
+            self.batch_tables = {}
+            self.bounded_scorers = {}
+            self._invalidate_score_caches()
     
     def train(self, class_name, token_list):
         """Train the model.
@@ -179,42 +1782,182 @@ class Classifier(object):
         self.classes[class_name] = True
         self._train_model(self.model, class_name, token_list, self.START)
     
-    def signal_end_of_training(self):
-        """Required to get the smoothed models to work properly."""
-        self.smoothed_model.mimic(self.model)
-        for given, table in self.smoothed_model.iteritems():
-            if given != '':
-                self.smoothed_model.add_given(self.JUNK, given, 0)
+    def merge(self, classifier):
+        """Add the supervised training of another classifier, trained on other documents,
+        to this one. Call before signal_end_of_training.
+        """
+        self._detach_overlays()
+        self.classes.update(classifier.classes)
+        self.types.update(classifier.types)
+        self.model.merge(classifier.model)
+        self._discard_compiled_models()
+    
+    def subtract(self, classifier):
+        """Take the supervised training of another classifier, trained on some of the
+        same documents, off this one, undoing merge. Classes and types only those
+        documents had are removed. Call before signal_end_of_training.
+        """
+        self._detach_overlays()
+        self.model.subtract(classifier.model)
+        tables = self.model.tables
+        get_id = self.symbols.get_id
+        prior = tables.get(PRIOR_KEY)
+        class_ids = [] if prior is None else list(prior[1])
+        for class_name in classifier.classes:
+            if get_id(class_name) not in class_ids:
+                self.classes.pop(class_name, None)
+        # Every token is counted in the context of its class alone.
+        class_tables = [tables[(class_id << ORDER_BITS) | 1][1] for class_id in class_ids
+                        if (class_id << ORDER_BITS) | 1 in tables]
+        for token in classifier.types:
+            token_id = get_id(token)
+            if token != self.JUNK and not any(token_id in items for items in class_tables):
+                self.types.pop(token, None)
+        self._discard_compiled_models()
+    
+    def signal_end_of_training(self, compile_models=False):
+        """Required to get the smoothed models to work properly.
+        compile_models - Also precompute the smoothed log probabilities, see compile_models.
+        """
+        # Both are overlays on the supervised counts: the smoothed model adds a
+        # zero JUNK count to every context and the semi supervised model holds
+        # the tables changed by unsupervised_training.
+        junk_id = self.symbols.intern(self.JUNK)
+        self.smoothed_model = OverlayModel(self.model, junk_id)
         self.types[self.JUNK] = True
-        self.semi_supervised_model.mimic(self.smoothed_model)
-        self.semi_supervised_types = copy.deepcopy(self.types)
-    
-    def unsupervised_training(self, batch):
-        throw_out_percent = 0.5
-        sub_batch_size = 200
-        batch_count = 0
-        while len(batch) > 0:
-            batch_count += 1
-            sub_batch = batch[:sub_batch_size]
-            batch = batch[sub_batch_size:]
-            print "Subbatch:", batch_count
-            print "Subbatch Size:", len(sub_batch)
-            sub_batch_threshold = len(sub_batch)*throw_out_percent
-            while len(sub_batch) > sub_batch_threshold:
-                max_class = 'No Class'
-                max_class_log = -sys.float_info.max
-                max_class_index = 0
-                # Find largest class log probability
-                for i, token_list in enumerate(sub_batch):
-                    c, log_c = self.classify_prev_prev_token_plus_one_special(token_list)
-                    if log_c > max_class_log:
-                        max_class_log = log_c
-                        max_class = c
-                        max_class_index = i
-                # Train on most probable
-                self._train_model(self.semi_supervised_model, max_class, sub_batch[max_class_index], self.START)
-                del sub_batch[max_class_index]
-                        
+        self.semi_supervised_model = OverlayModel(self.smoothed_model)
+        self.semi_supervised_types = dict(self.types)
+        self._discard_compiled_models()
+        if self.instrumentation is not None:
+            self._instrument_models()
+        if compile_models:
+            self.compile_models()
+    
+    def compile_models(self, quantization=None, models=None):
+        """Precompute the log probabilities used by the n-gram classifiers, unsmoothed,
+        smoothed and semi supervised, so each token costs one table lookup.
+        Any further training discards the compiled models.
+        quantization - Round the plus one log probabilities to save memory, see
+                       CompiledModel.quantize.
+        models - Compile only these of UNSMOOTHED, SMOOTHED and SEMI_SUPERVISED.
+        """
+        if models is None:
+            models = MODEL_ATTRIBUTES
+        self._discard_compiled_models()
+        if UNSMOOTHED in models:
+            self.compiled_model = CompiledModel(self.model)
+        if SMOOTHED in models:
+            self.compiled_smoothed_model = CompiledModel(self.smoothed_model, 1, len(self.types), self.JUNK, True)
+            if quantization is not None:
+                self.compiled_smoothed_model.quantize(quantization)
+        if SEMI_SUPERVISED in models:
+            self.compiled_semi_supervised_model = CompiledModel(self.semi_supervised_model, 1, len(self.semi_supervised_types), self.JUNK, True)
+            if quantization is not None:
+                self.compiled_semi_supervised_model.quantize(quantization)
+    
+    def unsupervised_training(self, batch, sub_batch_size=200, throw_out_percent=0.5, incremental=True, verbose=True,
+                              checkpoint_file=None, checkpoint_interval=10):
+        """Self-train the semi supervised model on unlabeled documents.
+        Each sub-batch is classified and the document the model is most sure of is
+        trained on, repeatedly, until throw_out_percent of the sub-batch is left.
+        batch - A list of token lists.
+        sub_batch_size - The number of documents considered at a time.
+        throw_out_percent - The fraction of each sub-batch that is not trained on.
+        incremental - Keep cached scores in a SelfTrainingQueue instead of
+                      rescoring every document after each update; the result is the same.
+        verbose - Print progress.
+        checkpoint_file - Append the documents trained on to this file every
+                          checkpoint_interval sub-batches, and first resume from the last
+                          checkpoint in it. Resuming with the classifier as it was before
+                          self-training and the same batch gives the same semi supervised
+                          model as a run that wasn't interrupted.
+        """
+        log_file = None
+        start = 0
+        if checkpoint_file is not None:
+            log_file, start = self._open_self_training_log(checkpoint_file, batch, sub_batch_size, throw_out_percent)
+            if verbose and start > 0:
+                print "Resumed at document:", start
+        try:
+            # The (document index, class name) of each document trained on since the last checkpoint.
+            trained = []
+            batch_count = start//sub_batch_size
+            for offset in xrange(start, len(batch), sub_batch_size):
+                batch_count += 1
+                sub_batch = batch[offset:offset + sub_batch_size]
+                if verbose:
+                    print "Subbatch:", batch_count
+                    print "Subbatch Size:", len(sub_batch)
+                sub_batch_threshold = len(sub_batch)*throw_out_percent
+                if incremental:
+                    queue = SelfTrainingQueue(self, sub_batch)
+                    while len(queue) > sub_batch_threshold:
+                        max_class_index, max_class = queue.pop_most_probable()
+                        self._train_model(self.semi_supervised_model, max_class, sub_batch[max_class_index], self.START)
+                        queue.update(max_class_index, max_class)
+                        trained.append((offset + max_class_index, max_class))
+                else:
+                    indexes = range(offset, offset + len(sub_batch))
+                    while len(sub_batch) > sub_batch_threshold:
+                        max_class = 'No Class'
+                        max_class_log = -sys.float_info.max
+                        max_class_index = 0
+                        # Find largest class log probability
+                        for i, token_list in enumerate(sub_batch):
+                            c, log_c = self.classify_prev_prev_token_plus_one_special(token_list)
+                            if log_c > max_class_log:
+                                max_class_log = log_c
+                                max_class = c
+                                max_class_index = i
+                        # Train on most probable
+                        self._train_model(self.semi_supervised_model, max_class, sub_batch[max_class_index], self.START)
+                        trained.append((indexes[max_class_index], max_class))
+                        del sub_batch[max_class_index]
+                        del indexes[max_class_index]
+                if log_file is not None and \
+                   (batch_count % checkpoint_interval == 0 or offset + sub_batch_size >= len(batch)):
+                    log_file.write(json.dumps({'cursor': min(offset + sub_batch_size, len(batch)),
+                                               'trained': trained}) + '\n')
+                    log_file.flush()
+                    os.fsync(log_file.fileno())
+                    trained = []
+        finally:
+            if log_file is not None:
+                log_file.close()
+    
+    def _open_self_training_log(self, file_name, batch, sub_batch_size, throw_out_percent):
+        """Train the semi supervised model on the documents of every complete checkpoint
+        in the file and return it opened to append the next checkpoint, with the index
+        of the first document not covered yet.
+        The first line describes the run and each other line is a checkpoint of the form
+        {"cursor": index of the next document, "trained": [[document index, class name], ...]}.
+        """
+        prior = self.semi_supervised_model.tables.get(PRIOR_KEY, [0])[0]
+        header = {'documents': len(batch), 'sub_batch_size': sub_batch_size,
+                  'throw_out_percent': throw_out_percent, 'prior': prior}
+        cursor = 0
+        end = 0
+        if os.path.exists(file_name):
+            with open(file_name, 'rb') as f:
+                for line in f:
+                    # A line cut short by a crash while it was written is dropped.
+                    if not line.endswith('\n'):
+                        break
+                    record = json.loads(line)
+                    if end == 0:
+                        if record != header:
+                            raise ValueError("The checkpoints in %r are of another self-training run." % (file_name,))
+                    else:
+                        for index, class_name in record['trained']:
+                            self._train_model(self.semi_supervised_model, class_name, batch[index], self.START)
+                        cursor = record['cursor']
+                    end += len(line)
+        f = open(file_name, 'r+b' if end > 0 else 'wb')
+        f.seek(end)
+        f.truncate()
+        if end == 0:
+            f.write(json.dumps(header) + '\n')
+        return f, cursor
     
     def print_model(self):
         self.model.print_model()
@@ -230,26 +1973,270 @@ class Classifier(object):
             temp['classes'] = self.classes
             f_out.write(json.dumps(temp))
     
-    def load_model(self, file_name):
+    def use_hashed_model(self, width=None, depth=None):
+        """Keep the supervised counts in a count-min sketch of a fixed size instead of
+        dicts that grow with the vocabulary, see hashed_model.HashedModel. Counts may be
+        overestimated and the model can't be saved. Call before training.
+        width, depth - The size of the sketch, by default hashed_model's.
+        """
+        import hashed_model
+        if self.model.tables:
+            raise ValueError("Call use_hashed_model before training.")
+        self.model = hashed_model.HashedModel(self.symbols, width, depth)
+        self._discard_compiled_models()
+    
+    def save_binary_model(self, file_name):
+        """Save the models in the memory mappable format of binary_model.py."""
+        import binary_model
+        binary_model.write_model_file(self, file_name)
+    
+    def load_model(self, file_name, compile_models=None, lazy=False):
+        """Load a model saved with save_model or save_binary_model.
+        Binary models are memory mapped and used read-only without parsing.
+        compile_models - Also precompute the log probabilities, see compile_models.
+                         By default only memory mapped models are compiled, as looking
+                         counts up in the map is about ten times slower than in dicts.
+        lazy - Load each section of a binary model into memory the first time it is used.
+               A layered section loads the sections under it when it first needs them.
+               JSON models have to be parsed whole, so they are always loaded eagerly.
+        The seconds each section took to load are kept in section_load_times.
+        """
+        import binary_model
+        self.section_load_times = {}
+        if binary_model.is_model_file(file_name):
+            self.model_file = binary_model.load_model_file(self, file_name, lazy)
+            self._discard_compiled_models()
+            if self.instrumentation is not None:
+                self._instrument_models()
+            if compile_models or (compile_models is None and not lazy):
+                start_time = time.time()
+                self.compile_models()
+                self.section_load_times['compile'] = time.time() - start_time
+            return
         with codecs.open(file_name, 'r', 'utf-8') as f_in:
+            start_time = time.time()
             temp = json.loads(f_in.read())
-            self.model.internal_model = temp['unsmoothed']
-            self.smoothed_model.internal_model = temp['smoothed']
+            self.section_load_times['json'] = time.time() - start_time
+            key_cache = {}
+            for attribute, section in [('model', 'unsmoothed'), ('smoothed_model', 'smoothed'),
+                                       ('semi_supervised_model', 'semi-supervised')]:
+                start_time = time.time()
+                model = Model(self.symbols)
+                model.load_internal_model(temp[section], key_cache)
+                setattr(self, attribute, model)
+                self.section_load_times[attribute] = time.time() - start_time
             self.types = temp['types']
-            self.semi_supervised_model.internal_model = temp['semi-supervised']
             self.semi_supervised_types = temp['semi-supervised-types']
             self.classes = temp['classes']
+        self._section_loaders = {}
+        self._discard_compiled_models()
+        if self.instrumentation is not None:
+            self._instrument_models()
+        if compile_models:
+            self.compile_models()
+    
+    def set_section_loader(self, attribute, loader):
+        """Load the attribute by calling loader() the first time it is used."""
+        self.__dict__.pop(attribute, None)
+        self._section_loaders[attribute] = loader
+    
+    def prune_models(self, min_count=2, min_total=1, max_bytes=None, orders=None, fold_into_junk=True):
+        """Shrink the models by removing rare items and contexts, see Model.prune.
+        min_count - Remove the items counted fewer times than this in a context.
+        min_total - Remove the contexts counted fewer times than this.
+        max_bytes - Instead raise min_count as little as needed for the supervised counts
+                    to take at most this many bytes in a binary model file. They are
+                    nearly all of it, the smoothed model is stored as a layer on them.
+        orders - The context lengths to prune, by default all of them but the prior.
+        fold_into_junk - Count the removed items as JUNK, so smoothed lookups of them
+                         fall back to their mass, rather than take them off the totals.
+        Return a dict of the min_count used and the items and contexts removed from
+        the supervised model.
+        """
+        junk_id = self.symbols.intern(self.JUNK) if fold_into_junk else None
+        if max_bytes is not None:
+            min_count = self._get_prune_threshold(max_bytes, min_count, min_total, junk_id, orders)
+        # The supervised counts decide for every model, so the smoothed and semi
+        # supervised counts stay increments of them, see binary_model._delta_tables.
+        # Overlays only hold their changed counts, the rest is pruned with the base.
+        for model in (self.semi_supervised_model, self.smoothed_model):
+            if model is not self.model:
+                model.prune(min_count, min_total, junk_id, orders, self.model.tables)
+        items_removed, contexts_removed = self.model.prune(min_count, min_total, junk_id, orders)
+        self._discard_compiled_models()
+        return {
+            'min_count': min_count,
+            'items_removed': items_removed,
+            'contexts_removed': contexts_removed,
+        }
+    
+    def _get_prune_threshold(self, max_bytes, min_count, min_total, junk_id, orders):
+        """Return the smallest min_count from min_count up that fits the supervised
+        counts into max_bytes of a binary model file.
+        """
+        import binary_model
+        tables = self.model.tables
+        number_of_contexts = len(tables)
+        number_of_entries = self.model.get_number_of_entries()
+        def fits(threshold):
+            items_removed, contexts_removed = prune_tables(tables, threshold, min_total, junk_id, orders, apply=False)
+            return binary_model.model_section_size(number_of_contexts - contexts_removed,
+                                                   number_of_entries - items_removed) <= max_bytes
+        high = 1 + max(count for table in tables.itervalues() for count in table[1].itervalues())
+        if not fits(high):
+            raise ValueError("The model can't be pruned to %d bytes." % max_bytes)
+        # Raising the threshold only ever removes more, so search for the smallest.
+        low = min_count
+        while low < high:
+            middle = (low + high)//2
+            if fits(middle):
+                high = middle
+            else:
+                low = middle + 1
+        return low
     
     def check_model(self):
-        """Check that the model is not broken."""
-        return self.model.check_sum_to_one() and self.smoothed_model.check_sum_to_one() and \
-               self.semi_supervised_model.check_sum_to_one()
+        """Check that the model is not broken.
+        Only the class priors can be checked when the counts are hashed, see
+        use_hashed_model, as the other tables can't be listed.
+        """
+        import hashed_model
+        if isinstance(self.model, hashed_model.HashedModel):
+            def check_sum_to_one(model):
+                prior = model.tables.get(PRIOR_KEY)
+                return prior is None or prior[0] == sum(prior[1].itervalues())
+        else:
+            check_sum_to_one = lambda model: model.check_sum_to_one()
+        return check_sum_to_one(self.model) and check_sum_to_one(self.smoothed_model) and \
+               check_sum_to_one(self.semi_supervised_model)
     
     def print_stats(self):
         """Print out basic statistics."""
         print "Number of tables:", self.model.get_number_of_tables()
         print "Average table length:", self.model.get_average_table_length()
     
+    def get_scoring_engine(self, order=2, smoothing=PLUS_ONE, model=SMOOTHED, use_prior=True, types=None):
+        """Return the scoring engine with the given configuration, see ScoringEngine."""
+        config = (order, smoothing, model, use_prior, types)
+        engine = self.scoring_engines.get(config)
+        if engine is None:
+            engine = self.scoring_engines[config] = ScoringEngine(self, *config)
+            if self.score_cache_limits is not None:
+                engine.cache = ScoreCache(engine, **self.score_cache_limits)
+            if self.instrumentation is not None:
+                self.instrumentation.instrument_engine(engine)
+        return engine
+    
+    def enable_score_cache(self, max_nodes=100000, max_results=10000, max_depth=64, checkpoint_interval=4):
+        """Cache the scores of the n-gram classify methods, see ScoreCache.
+        Each scoring engine gets its own cache with these limits. Training or loading
+        a model empties them.
+        """
+        self.score_cache_limits = dict(max_nodes=max_nodes, max_results=max_results,
+                                       max_depth=max_depth, checkpoint_interval=checkpoint_interval)
+        for engine in self.scoring_engines.itervalues():
+            engine.cache = ScoreCache(engine, **self.score_cache_limits)
+    
+    def disable_score_cache(self):
+        self.score_cache_limits = None
+        for engine in self.scoring_engines.itervalues():
+            engine.cache = None
+    
+    def get_score_cache_stats(self):
+        """Return the hit and miss counts of every engine's cache, keyed by its configuration."""
+        stats = {}
+        for config, engine in self.scoring_engines.iteritems():
+            if engine.cache is not None:
+                stats[config] = dict(engine.cache.stats)
+        return stats
+    
+    def _invalidate_score_caches(self):
+        if self.score_cache_limits is not None:
+            for engine in self.scoring_engines.itervalues():
+                engine.cache.invalidate()
+    
+    def enable_instrumentation(self, log_interval=None, log_file=None):
+        """Count model lookups by outcome and context length and time every classify
+        method, see instrumentation.py. Counting is done on the side, so scores don't change.
+        log_interval - Write a summary line to log_file, stderr by default, at most this
+                       often, in seconds. None to never log.
+        """
+        import instrumentation
+        self.disable_instrumentation()
+        self.instrumentation = instrumentation.Instrumentation(self, log_interval, log_file)
+        self.instrumentation.attach()
+    
+    def disable_instrumentation(self):
+        """Remove the instrumentation so nothing is counted or timed any more."""
+        if self.instrumentation is not None:
+            self.instrumentation.detach()
+            self.instrumentation = None
+    
+    def get_instrumentation_stats(self):
+        """Return the lookup counts and classify timings, or None if they are disabled."""
+        if self.instrumentation is None:
+            return None
+        return self.instrumentation.stats()
+    
+    def _instrument_models(self):
+        # Lazy models are instrumented when they are loaded.
+        for attribute in ('model', 'smoothed_model', 'semi_supervised_model'):
+            if attribute in self.__dict__:
+                self.instrumentation.instrument_model(self.__dict__[attribute])
+    
+    def score(self, token_list, order=2, smoothing=PLUS_ONE, model=SMOOTHED, use_prior=True, types=None):
+        """Return a list of (class name, log probability) for every class, see ScoringEngine."""
+        return self.get_scoring_engine(order, smoothing, model, use_prior, types).score(token_list)
+    
+    def classify_batch(self, list_of_token_lists, method='classify_prev_prev_token_plus_one'):
+        """Classify many documents at once with numpy.
+        list_of_token_lists - The token lists of the documents.
+        method - The name of the n-gram classify method to match, see SCORING_METHODS.
+        Return the list of predicted class names, a documents by classes array of
+        log probabilities and the list of class names for the columns of the array.
+        The scores match the scalar method's up to floating point rounding.
+        """
+        if method not in SCORING_METHODS:
+            raise ValueError("No batch version of %r." % (method,))
+        engine = self.get_scoring_engine(*SCORING_METHODS[method])
+        tables = self.batch_tables.get(method)
+        if tables is None:
+            tables = self.batch_tables[method] = BatchTables(engine.compile(), engine.order, engine.use_prior)
+        scores = tables.score([engine.get_ngrams(token_list) for token_list in list_of_token_lists])
+        class_names = tables.class_names
+        if not class_names:
+            return ["No Class"]*len(list_of_token_lists), scores, class_names
+        # Ties go to the last class, the same as the scalar methods.
+        last = len(class_names) - 1
+        best = last - np.argmax(scores[:, ::-1], axis=1)
+        return [class_names[i] for i in best], scores, class_names
+    
+    def classify_top_k(self, token_list, k=1, method='classify_prev_prev_token_plus_one'):
+        """Return the k most probable (class name, log probability) of the document, best
+        first, pruning classes that can't make the top k, see BoundedScorer.
+        method - The name of the n-gram classify method to match, see SCORING_METHODS.
+        The first class is the one the method returns. How much was pruned is added
+        up in pruning_stats.
+        """
+        if method not in SCORING_METHODS:
+            raise ValueError("No top k version of %r." % (method,))
+        scorer = self.bounded_scorers.get(method)
+        if scorer is None:
+            engine = self.get_scoring_engine(*SCORING_METHODS[method])
+            scorer = self.bounded_scorers[method] = BoundedScorer(engine)
+        return scorer.top_k(scorer.engine.get_ngrams(token_list), k, self.pruning_stats)
+    
+    def start_session(self, method='classify_prev_prev_token_plus_one', threshold=None):
+        """Return a ClassificationSession that classifies a document as its tokens
+        are appended, the same way as method classifies it whole.
+        method - The name of an n-gram classify method, see SCORING_METHODS.
+        threshold - Decide once the leader is this much log probability ahead, see
+                    ClassificationSession.decision.
+        """
+        if method not in SCORING_METHODS:
+            raise ValueError("No session for %r." % (method,))
+        return ClassificationSession(self.get_scoring_engine(*SCORING_METHODS[method]), threshold)
+    
     def classify_random(self, token_list, seed=42):
         """Use reservoir sampling to classify the token list with a seed of zero."""
         random.seed(seed)
@@ -283,252 +2270,123 @@ class Classifier(object):
         token_list - A list of tokens used to classify the document.
         Return the most probable class name.
         """
-        max_class = "No Class"
-        max_log_prob = -sys.float_info.max
-        for class_name in self.model.get_table_iterator(''):
-            total1, total2 = self.model.log(class_name, '')
-            for token in token_list:
-                temp1, temp2 = self.model.log(token, (class_name,))
-                total1 += temp1
-                total2 += temp2
-            total = total1 - total2
-            # Check for better class found.
-            if total >= max_log_prob:
-                max_log_prob = total
-                max_class = class_name
-        return max_class
-        
+        return self.get_scoring_engine(0, NO_SMOOTHING, UNSMOOTHED).classify(token_list)[0]
+
     def classify_plus_one(self, token_list):
         """Same as classify, but with plus one smoothing."""
-        max_class = "No Class"
-        max_log_prob = -sys.float_info.max
-        for class_name in self.smoothed_model.get_table_iterator(''):
-            total1, total2 = self.smoothed_model.smoothed_log(class_name, '')
-            for token in token_list:
-                temp1, temp2 = self.smoothed_model.smoothed_log(token, (class_name,), 1, len(self.types), self.JUNK, True)
-                total1 += temp1
-                total2 += temp2
-            total = total1 - total2
-            # Check for better class found.
-            if total >= max_log_prob:
-                max_log_prob = total
-                max_class = class_name
-        return max_class
+        return self.get_scoring_engine(0, PLUS_ONE, SMOOTHED).classify(token_list)[0]
     
     def classify_prev_token(self, token_list):
         """Classify the given words with no smoothing and one previous token.
         token_list - A list of tokens used to classify the document.
         Return the most probable class name.
         """
-        max_class = "No Class"
-        max_log_prob = -sys.float_info.max
-        for class_name in self.model.get_table_iterator(''):
-            prev_token = self.START
-            total1, total2 = self.model.log(class_name, '')
-            for token in token_list:
-                temp1, temp2 = self.model.log(token, (class_name, prev_token))
-                prev_token = token
-                total1 += temp1
-                total2 += temp2
-            total = total1 - total2
-            # Check for better class found.
-            if total >= max_log_prob:
-                max_log_prob = total
-                max_class = class_name
-        return max_class
+        return self.get_scoring_engine(1, NO_SMOOTHING, UNSMOOTHED).classify(token_list)[0]
     
     def classify_prev_token_plus_one(self, token_list):
         """Classify the given words with plus one smoothing and one previous token.
         token_list - A list of tokens used to classify the document.
         Return the most probable class name.
         """
-        max_class = "No Class"
-        max_log_prob = -sys.float_info.max
-        for class_name in self.smoothed_model.get_table_iterator(''):
-            prev_token = self.START
-            total1, total2 = self.smoothed_model.smoothed_log(class_name, '')
-            for token in token_list:
-                temp1, temp2 = self.smoothed_model.smoothed_log(token, (class_name, prev_token), 1, len(self.types), self.JUNK, True)
-                prev_token = token
-                total1 += temp1
-                total2 += temp2
-            total = total1 - total2
-            # Check for better class found.
-            if total >= max_log_prob:
-                max_log_prob = total
-                max_class = class_name
-        return max_class
+        return self.get_scoring_engine(1, PLUS_ONE, SMOOTHED).classify(token_list)[0]
     
     def classify_prev_prev_token(self, token_list):
         """Classify the given words with no smoothing and two previous token.
         token_list - A list of tokens used to classify the document.
         Return the most probable class name.
         """
-        max_class = "No Class"
-        max_log_prob = -sys.float_info.max
-        for class_name in self.model.get_table_iterator(''):
-            prev_prev_token = self.START
-            prev_token = self.START
-            total1, total2 = self.model.log(class_name, '')
-            for token in token_list:
-                temp1, temp2 = self.model.log(token, (class_name, prev_prev_token, prev_token))
-                prev_prev_token = prev_token
-                prev_token = token
-                total1 += temp1
-                total2 += temp2
-            total = total1 - total2
-            # Check for better class found.
-            if total >= max_log_prob:
-                max_log_prob = total
-                max_class = class_name
-        return max_class
+        return self.get_scoring_engine(2, NO_SMOOTHING, UNSMOOTHED).classify(token_list)[0]
     
     def classify_prev_prev_token_plus_one(self, token_list):
         """Classify the given words with plus one smoothing and two previous token.
         token_list - A list of tokens used to classify the document.
         Return the most probable class name.
         """
-        max_class = "No Class"
-        max_log_prob = -sys.float_info.max
-        for class_name in self.smoothed_model.get_table_iterator(''):
-            prev_prev_token = self.START
-            prev_token = self.START
-            total1, total2 = self.smoothed_model.smoothed_log(class_name, '')
-            for token in token_list:
-                temp1, temp2 = self.smoothed_model.smoothed_log(token, (class_name, prev_prev_token, prev_token), 1, len(self.types), self.JUNK, True)
-                prev_prev_token = prev_token
-                prev_token = token
-                total1 += temp1
-                total2 += temp2
-            total = total1 - total2
-            # Check for better class found.
-            if total >= max_log_prob:
-                max_log_prob = total
-                max_class = class_name
-        return max_class
-        
+        return self.get_scoring_engine(2, PLUS_ONE, SMOOTHED).classify(token_list)[0]
+    
     def classify_add_hoc(self, token_list):
         """Classify the given words with plus one smoothing and two previous token.
         token_list - A list of tokens used to classify the document.
         Return the most probable class name.
         """
-        max_class = "No Class"
-        max_log_prob = -sys.float_info.max
-        for class_name in self.smoothed_model.get_table_iterator(''):
-            prev_prev_token = self.START
-            prev_token = self.START
-            total1, total2 = 0, 0
-            for token in token_list:
-                temp1, temp2 = self.smoothed_model.smoothed_log(token, (class_name, prev_prev_token, prev_token), 1, len(self.types), self.JUNK, True)
-                prev_prev_token = prev_token
-                prev_token = token
-                total1 += temp1
-                total2 += temp2
-            total = total1 - total2
-            # Check for better class found.
-            if total >= max_log_prob:
-                max_log_prob = total
-                max_class = class_name
-        return max_class
+        return self.get_scoring_engine(2, PLUS_ONE, SMOOTHED, False).classify(token_list)[0]
     
     def classify_prev_prev_token_plus_one_special(self, token_list):
         """Classify the given words with plus one smoothing and two previous token.
         token_list - A list of tokens used to classify the document.
         Return the most probable class name.
         """
+        return self.get_scoring_engine(2, PLUS_ONE, SEMI_SUPERVISED, True, TYPES).classify(token_list)
+    
+    def _classify_assume_seen(self, token_list, order):
+        """Shared by the assume seen classifiers.
+        Each class is scored as if the document had also been trained on as that class:
+        the document's own n-gram counts are added to the unsmoothed counts.
+        order - The number of previous tokens in each context: 0, 1 or 2.
+        Return the most probable class name.
+        """
+        # The document's n-gram counts are the same for every class, count them once.
+        ngrams = self.get_scoring_engine(order, NO_SMOOTHING, UNSMOOTHED).get_ngrams(token_list)
+        ngram_counts = {}
+        context_counts = {}
+        contexts = []
+        prev_prev_token = self.START
+        prev_token = self.START
+        for token in token_list:
+            context = (prev_prev_token, prev_token)[2 - order:]
+            contexts.append((context, token))
+            ngram_counts[(context, token)] = ngram_counts.get((context, token), 0) + 1
+            context_counts[context] = context_counts.get(context, 0) + 1
+            prev_prev_token = prev_token
+            prev_token = token
+        document_counts = [(suffix, token_id, ngram_counts[ngram], context_counts[ngram[0]])
+                           for (suffix, token_id), ngram in zip(ngrams, contexts)]
+        
+        tables = self.model.tables
+        prior_table = tables.get(PRIOR_KEY, [0, {}])
+        tag = order + 1
         max_class = "No Class"
         max_log_prob = -sys.float_info.max
-        for class_name in self.semi_supervised_model.get_table_iterator(''):
-            prev_prev_token = self.START
-            prev_token = self.START
-            total1, total2 = self.semi_supervised_model.smoothed_log(class_name, '')
-            for token in token_list:
-                temp1, temp2 = self.semi_supervised_model.smoothed_log(token, (class_name, prev_prev_token, prev_token), 1, len(self.types), self.JUNK, True)
-                prev_prev_token = prev_token
-                prev_token = token
-                total1 += temp1
-                total2 += temp2
+        for class_name in self.model.get_table_iterator(''):
+            class_id = self.symbols.get_id(class_name)
+            prefix = class_id << (order*SYMBOL_BITS)
+            total1 = log(prior_table[1].get(class_id, 0) + 1)
+            total2 = log(prior_table[0] + 1)
+            for suffix, token_id, ngram_count, context_count in document_counts:
+                table = tables.get(((prefix | suffix) << ORDER_BITS) | tag)
+                if table is None:
+                    total1 += log(ngram_count)
+                    total2 += log(context_count)
+                else:
+                    total1 += log(table[1].get(token_id, 0) + ngram_count)
+                    total2 += log(table[0] + context_count)
             total = total1 - total2
             # Check for better class found.
             if total >= max_log_prob:
                 max_log_prob = total
                 max_class = class_name
-        return max_class, max_log_prob
+        return max_class
     
     def classify_assume_seen(self, token_list):
         """Classify the given words assuming that the words are part of the training data for each class.
         token_list - A list of tokens used to classify the document.
         Return the most probable class name.
         """
-        max_class = "No Class"
-        max_log_prob = -sys.float_info.max
-        for class_name in self.model.get_table_iterator(''):
-            temp_model = Model()
-            self._train_model(temp_model, class_name, token_list, self.START)
-            
-            total1, total2 = self.model.joint_log(class_name, '', temp_model)
-            for token in token_list:
-                temp1, temp2 = self.model.joint_log(token, (class_name,), temp_model)
-                total1 += temp1
-                total2 += temp2
-            total = total1 - total2
-            # Check for better class found.
-            if total >= max_log_prob:
-                max_log_prob = total
-                max_class = class_name
-        return max_class
+        return self._classify_assume_seen(token_list, 0)
     
     def classify_assume_seen_prev(self, token_list):
         """Classify the given words assuming that the words are part of the training data for each class using prev word.
         token_list - A list of tokens used to classify the document.
         Return the most probable class name.
         """
-        max_class = "No Class"
-        max_log_prob = -sys.float_info.max
-        for class_name in self.model.get_table_iterator(''):
-            temp_model = Model()
-            self._train_model(temp_model, class_name, token_list, self.START)
-            
-            total1, total2 = self.model.joint_log(class_name, '', temp_model)
-            prev_token = self.START
-            for token in token_list:
-                temp1, temp2 = self.model.joint_log(token, (class_name, prev_token), temp_model)
-                prev_token = token
-                total1 += temp1
-                total2 += temp2
-            total = total1 - total2
-            # Check for better class found.
-            if total >= max_log_prob:
-                max_log_prob = total
-                max_class = class_name
-        return max_class
+        return self._classify_assume_seen(token_list, 1)
     
     def classify_assume_seen_prev_prev(self, token_list):
         """Classify the given words assuming that the words are part of the training data for each class using two prev word.
         token_list - A list of tokens used to classify the document.
         Return the most probable class name.
         """
-        max_class = "No Class"
-        max_log_prob = -sys.float_info.max
-        for class_name in self.model.get_table_iterator(''):
-            temp_model = Model()
-            self._train_model(temp_model, class_name, token_list, self.START)
-            
-            total1, total2 = self.model.joint_log(class_name, '', temp_model)
-            prev_prev_token = self.START
-            prev_token = self.START
-            for token in token_list:
-                temp1, temp2 = self.model.joint_log(token, (class_name, prev_prev_token, prev_token), temp_model)
-                prev_prev_token = prev_token
-                prev_token = token
-                total1 += temp1
-                total2 += temp2
-            total = total1 - total2
-            # Check for better class found.
-            if total >= max_log_prob:
-                max_log_prob = total
-                max_class = class_name
-        return max_class
+        return self._classify_assume_seen(token_list, 2)
     
     def classify_semi_supervised(self, token_list):
         """Classify the given words using a semi supervised model,
@@ -536,23 +2394,4 @@ class Classifier(object):
         token_list - A list of tokens used to classify the document.
         Return the most probable class name.
         """
-        
-        max_class = "No Class"
-        max_log_prob = -sys.float_info.max
-        for class_name in self.semi_supervised_model.get_table_iterator(''):
-            total1, total2 = self.semi_supervised_model.smoothed_log(class_name, '')
-            prev_prev_token = self.START
-            prev_token = self.START
-            for token in token_list:
-                given = (class_name, prev_prev_token, prev_token)
-                temp1, temp2 = self.semi_supervised_model.smoothed_log(token, given, 1, len(self.semi_supervised_types), self.JUNK, True)
-                total1 += temp1
-                total2 += temp2
-                prev_prev_token = prev_token
-                prev_token = token
-            total = total1 - total2
-            # Check for better class found.
-            if total >= max_log_prob:
-                max_log_prob = total
-                max_class = class_name
-        return max_class
+        return self.get_scoring_engine(2, PLUS_ONE, SEMI_SUPERVISED).classify(token_list)[0]
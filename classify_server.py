@@ -0,0 +1,288 @@
+# classify_server.py
+# Load a trained model once and answer queries on it, one JSON object per line.
+# e.g. python classify_server.py # Answer requests on stdin, responses on stdout.
+# e.g. python classify_server.py classifier.sock # Listen on a Unix socket instead.
+#
+# Requests are answered in order, so clients can send several before reading any
+# responses. Each response has the request's "id", if it had one, and either
+# the result or "error".
+#   {"op": "classify", "text": "...", "method": "classify_semi_supervised"}
+#       -> {"class": ...}, plus "log" for classify_prev_prev_token_plus_one_special
+#   {"op": "scores", "tokens": [...], "method": "classify_add_hoc"}
+#       -> {"scores": [[class, log probability], ...]}
+#   {"op": "log", "item": "w", "given": ["movie", "s", "a"]}
+#       -> {"log": [num, den], "smoothed_log": [num, den], "semi_supervised_log": [num, den]}
+#   {"op": "table", "given": ["movie", "s", "a"]} -> {"table": [total, {item: count}]}
+#   {"op": "stats"} -> {"latency": {op: {"count": n, "p50": s, "p90": s, "p99": s, "max": s}}}
+# Documents are given either as "text", tokenized the way the model was trained, or
+# as a list of "tokens". An empty "given" is the class prior.
+
+import os
+import os.path as path
+import sys
+import json
+import time
+import socket
+import threading
+import SocketServer
+from collections import deque
+from classifier import Classifier, SCORING_METHODS
+from train_classifier import TOKENIZER, TRAINING_FILE_OUTPUT, TRAINING_BINARY_OUTPUT
+
+SERVER_SOCKET = 'classifier.sock'
+
+# Methods the classify request can call.
+CLASSIFY_METHODS = set(SCORING_METHODS) | set([
+    'classify_random',
+    'classify_greedy',
+    'classify_assume_seen',
+    'classify_assume_seen_prev',
+    'classify_assume_seen_prev_prev',
+])
+DEFAULT_METHOD = 'classify_prev_prev_token_plus_one'
+
+# Latencies kept per request type for the percentiles.
+LATENCY_WINDOW = 10000
+
+def load_classifier():
+    """Return a classifier with the trained model, the binary one if it exists."""
+    c = Classifier()
+    if path.exists(TRAINING_BINARY_OUTPUT):
+        c.load_model(TRAINING_BINARY_OUTPUT, compile_models=True)
+    else:
+        c.load_model(TRAINING_FILE_OUTPUT, compile_models=True)
+    return c
+
+def percentile(sorted_values, fraction):
+    """Return the nearest rank percentile of a sorted list."""
+    if not sorted_values:
+        return None
+    rank = int(fraction*len(sorted_values) + 0.5)
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+class LatencyStats(object):
+    """The most recent request latencies of each request type."""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self.latencies = {}
+        self.counts = {}
+
+    def record(self, op, seconds):
+        latencies = self.latencies.get(op)
+        if latencies is None:
+            latencies = self.latencies[op] = deque(maxlen=self.window)
+        latencies.append(seconds)
+        self.counts[op] = self.counts.get(op, 0) + 1
+
+    def report(self):
+        """Return {op: {"count": n, "p50": s, "p90": s, "p99": s, "max": s}}."""
+        report = {}
+        for op, latencies in self.latencies.iteritems():
+            values = sorted(latencies)
+            report[op] = {
+                'count': self.counts[op],
+                'p50': percentile(values, 0.5),
+                'p90': percentile(values, 0.9),
+                'p99': percentile(values, 0.99),
+                'max': values[-1],
+            }
+        return report
+
+    def print_report(self, out=sys.stderr):
+        for op, stats in sorted(self.report().iteritems()):
+            out.write("Latency (%s): %d requests, p50 %.3f ms, p90 %.3f ms, p99 %.3f ms, max %.3f ms\n" %
+                      (op, stats['count'], 1000*stats['p50'], 1000*stats['p90'], 1000*stats['p99'],
+                       1000*stats['max']))
+
+class ClassificationServer(object):
+    """Answer requests on one loaded classifier, see the top of the file.
+    handle is serialized with a lock, so one server can be shared between connections.
+    """
+
+    def __init__(self, classifier):
+        self.classifier = classifier
+        self.stats = LatencyStats()
+        self.lock = threading.Lock()
+
+    def _get_tokens(self, request):
+        if 'tokens' in request:
+            return request['tokens']
+        return TOKENIZER.tokens(request['text'])
+
+    def _get_given(self, request):
+        given = request.get('given') or ''
+        if given:
+            given = tuple(given)
+        return given
+
+    def _classify(self, request):
+        method = request.get('method', DEFAULT_METHOD)
+        if method not in CLASSIFY_METHODS:
+            raise ValueError("Unknown classify method %r." % (method,))
+        result = getattr(self.classifier, method)(self._get_tokens(request))
+        if isinstance(result, tuple):
+            return {'class': result[0], 'log': result[1]}
+        return {'class': result}
+
+    def _scores(self, request):
+        method = request.get('method', DEFAULT_METHOD)
+        if method not in SCORING_METHODS:
+            raise ValueError("No per class scores for %r." % (method,))
+        engine = self.classifier.get_scoring_engine(*SCORING_METHODS[method])
+        return {'scores': engine.score(self._get_tokens(request))}
+
+    def _log(self, request):
+        c = self.classifier
+        item = request['item']
+        given = self._get_given(request)
+        return {
+            'log': c.model.log(item, given),
+            'smoothed_log': c.smoothed_model.smoothed_log(item, given, 1, len(c.types), c.JUNK, True),
+            'semi_supervised_log': c.semi_supervised_model.smoothed_log(
+                item, given, 1, len(c.semi_supervised_types), c.JUNK, True),
+        }
+
+    def _table(self, request):
+        given = self._get_given(request)
+        try:
+            return {'table': self.classifier.smoothed_model.get_table(given)}
+        except KeyError:
+            raise KeyError("No table for the given %r." % (given,))
+
+    def _stats(self, request):
+        return {'latency': self.stats.report()}
+
+    OPS = {
+        'classify': _classify,
+        'scores': _scores,
+        'log': _log,
+        'table': _table,
+        'stats': _stats,
+    }
+
+    def handle(self, request):
+        """Return the response to a decoded request."""
+        start_time = time.time()
+        op = None
+        try:
+            if not isinstance(request, dict):
+                raise ValueError("A request must be a JSON object.")
+            op = request.get('op')
+            handler = self.OPS.get(op)
+            if handler is None:
+                raise ValueError("Unknown op %r." % (op,))
+            with self.lock:
+                response = handler(self, request)
+        except Exception as e:
+            response = {'error': "%s: %s" % (type(e).__name__, e)}
+        if isinstance(request, dict) and 'id' in request:
+            response['id'] = request['id']
+        with self.lock:
+            self.stats.record(op if op in self.OPS else 'invalid', time.time() - start_time)
+        return response
+
+    def handle_line(self, line):
+        """Return the JSON line answering a JSON line request."""
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            # Still answered and counted, so the responses stay in step with the requests.
+            request = None
+            response = self.handle(request)
+            response['error'] = "ValueError: %s" % (e,)
+            return json.dumps(response) + '\n'
+        return json.dumps(self.handle(request)) + '\n'
+
+    def serve_stream(self, f_in, f_out):
+        """Answer the request lines of f_in on f_out until the end of f_in."""
+        while True:
+            line = f_in.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            f_out.write(self.handle_line(line))
+            f_out.flush()
+
+class _StreamHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        self.server.classification_server.serve_stream(self.rfile, self.wfile)
+
+class UnixSocketServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Serve a ClassificationServer to every connection of a Unix socket."""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, classification_server):
+        if path.exists(socket_path):
+            os.remove(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path, _StreamHandler)
+        self.classification_server = classification_server
+
+class ServerClient(object):
+    """A connection to a classify_server.py listening on a Unix socket."""
+
+    def __init__(self, socket_path=SERVER_SOCKET):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(socket_path)
+        self.f_in = self.socket.makefile('rb')
+
+    def close(self):
+        self.f_in.close()
+        self.socket.close()
+
+    def pipeline(self, requests):
+        """Send all the requests before reading any response and return the responses.
+        The requests are written from another thread, so that the server never
+        blocks on responses that aren't being read.
+        """
+        data = ''.join(json.dumps(request) + '\n' for request in requests)
+        writer = threading.Thread(target=self.socket.sendall, args=(data,))
+        writer.start()
+        responses = []
+        for i in xrange(len(requests)):
+            line = self.f_in.readline()
+            if not line:
+                raise IOError("The server closed the connection.")
+            responses.append(json.loads(line))
+        writer.join()
+        return responses
+
+    def request(self, op, **arguments):
+        """Send one request and return its response, raising on errors."""
+        arguments['op'] = op
+        response = self.pipeline([arguments])[0]
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response
+
+def connect(socket_path=SERVER_SOCKET):
+    """Return a ServerClient if a server is listening on the socket, otherwise None."""
+    if not path.exists(socket_path):
+        return None
+    try:
+        return ServerClient(socket_path)
+    except socket.error:
+        return None
+
+if __name__ == "__main__":
+    start_time = time.time()
+    server = ClassificationServer(load_classifier())
+    sys.stderr.write("Model loaded in %.3f s\n" % (time.time() - start_time))
+    try:
+        if len(sys.argv) > 1:
+            socket_server = UnixSocketServer(sys.argv[1], server)
+            sys.stderr.write("Listening on %s\n" % sys.argv[1])
+            try:
+                socket_server.serve_forever()
+            finally:
+                socket_server.server_close()
+                os.remove(sys.argv[1])
+        else:
+            server.serve_stream(sys.stdin, sys.stdout)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stats.print_report()
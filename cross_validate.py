@@ -0,0 +1,162 @@
+# cross_validate.py
+# k-fold cross-validation of every classifier of test_classifier.py.
+# e.g. python cross_validate.py # 10 folds of the training file.
+# e.g. python cross_validate.py --folds 5 --retrain assignment2/pnp-validate.txt # Also time retraining.
+#
+# The counts of each fold are trained once and merged into the full model. Each
+# fold is then evaluated on the full model minus its own counts, which are merged
+# back afterwards, instead of retraining on the other folds. Subtracting keeps the
+# symbols, so every document is also turned into n-grams once for all the folds.
+
+import time
+from math import sqrt
+from optparse import OptionParser
+from classifier import Classifier, SCORING_METHODS, SMOOTHED
+from test_classifier import CLASSIFIERS, read_test_data
+from train_classifier import TRAINING_FILE
+
+FOLDS = 10
+
+def get_folds(number_of_documents, k):
+    """Return the document indices of each of k folds, every k-th document in each."""
+    return [range(i, number_of_documents, k) for i in xrange(k)]
+
+def train_folds(test_data, actual_class, folds):
+    """Return a classifier trained on every document and one trained on each fold."""
+    c = Classifier()
+    fold_classifiers = []
+    for fold in folds:
+        fold_classifier = Classifier()
+        for i in fold:
+            fold_classifier.train(actual_class[i], test_data[i])
+        c.merge(fold_classifier)
+        fold_classifiers.append(fold_classifier)
+    return c, fold_classifiers
+
+def get_view(c):
+    """Return a classifier ready to classify with c's counts, sharing them.
+    c itself is left without smoothed models, so its counts can keep changing.
+    """
+    view = Classifier()
+    view.symbols = c.symbols
+    view.model = c.model
+    view.types = dict(c.types)
+    view.classes = dict(c.classes)
+    view.signal_end_of_training()
+    # The smoothed model serves most of the n-gram classifiers, enough to pay for compiling it.
+    view.compile_models(models=[SMOOTHED])
+    return view
+
+def get_ngrams(c, test_data):
+    """Return {order: the n-grams of every document} of the n-gram classifiers.
+    They stay valid while c's symbols do, across subtracting and merging counts.
+    """
+    ngrams = {}
+    for config in SCORING_METHODS.itervalues():
+        order = config[0]
+        if order not in ngrams:
+            engine = c.get_scoring_engine(*config)
+            ngrams[order] = [engine.get_ngrams(token_list) for token_list in test_data]
+    return ngrams
+
+def evaluate_fold(c, fold, test_data, actual_class, classifiers=CLASSIFIERS, ngrams=None):
+    """Return {classifier name: accuracy} of the fold's documents, classified by every
+    classifier in one pass over them.
+    ngrams - The documents' n-grams from get_ngrams with c's symbols, scored instead of
+             the token lists by the n-gram classifiers.
+    """
+    correct = dict((name, 0) for name, method_name in classifiers)
+    methods = []
+    for name, method_name in classifiers:
+        if ngrams is not None and method_name in SCORING_METHODS:
+            engine = c.get_scoring_engine(*SCORING_METHODS[method_name])
+            methods.append((name, engine.classify_ngrams, ngrams[engine.order]))
+        else:
+            methods.append((name, getattr(c, method_name), None))
+    for i in fold:
+        token_list = test_data[i]
+        for name, classify, documents in methods:
+            if documents is not None:
+                class_name = classify(documents[i])[0]
+            else:
+                class_name = classify(token_list)
+            if class_name == actual_class[i]:
+                correct[name] += 1
+    return dict((name, float(count)/len(fold)) for name, count in correct.iteritems())
+
+def cross_validate(test_data, actual_class, k=FOLDS, classifiers=CLASSIFIERS, verbose=True):
+    """Return {classifier name: [accuracy of each fold]}, subtracting each fold's counts
+    from the full model in turn.
+    """
+    folds = get_folds(len(test_data), k)
+    start_time = time.time()
+    c, fold_classifiers = train_folds(test_data, actual_class, folds)
+    ngrams = get_ngrams(c, test_data)
+    if verbose:
+        print "Training: %.3f s" % (time.time() - start_time)
+    accuracies = dict((name, []) for name, method_name in classifiers)
+    for fold, fold_classifier in zip(folds, fold_classifiers):
+        start_time = time.time()
+        c.subtract(fold_classifier)
+        subtract_time = time.time() - start_time
+        start_time = time.time()
+        for name, accuracy in evaluate_fold(get_view(c), fold, test_data, actual_class, classifiers, ngrams).iteritems():
+            accuracies[name].append(accuracy)
+        evaluate_time = time.time() - start_time
+        c.merge(fold_classifier)
+        if verbose:
+            print "Fold %d: %d documents, subtract %.3f s, classify %.3f s" % \
+                  (len(accuracies[classifiers[0][0]]), len(fold), subtract_time, evaluate_time)
+    return accuracies
+
+def cross_validate_by_retraining(test_data, actual_class, k=FOLDS, classifiers=CLASSIFIERS, verbose=True):
+    """Same as cross_validate, but retrain on the other folds for each fold."""
+    folds = get_folds(len(test_data), k)
+    accuracies = dict((name, []) for name, method_name in classifiers)
+    for j, fold in enumerate(folds):
+        start_time = time.time()
+        c = Classifier()
+        for other_fold in folds[:j] + folds[j + 1:]:
+            for i in other_fold:
+                c.train(actual_class[i], test_data[i])
+        c.signal_end_of_training()
+        training_time = time.time() - start_time
+        for name, accuracy in evaluate_fold(c, fold, test_data, actual_class, classifiers).iteritems():
+            accuracies[name].append(accuracy)
+        if verbose:
+            print "Fold %d: %d documents, retrain %.3f s" % (j + 1, len(fold), training_time)
+    return accuracies
+
+def summarize(values):
+    """Return the mean and the sample variance of the values."""
+    mean = sum(values)/len(values)
+    if len(values) < 2:
+        return mean, 0.0
+    return mean, sum((value - mean)**2 for value in values)/(len(values) - 1)
+
+def print_accuracies(accuracies, classifiers=CLASSIFIERS):
+    for name, method_name in classifiers:
+        mean, variance = summarize(accuracies[name])
+        print "Accuracy (%s): mean %.4f, variance %.6f, std dev %.4f" % (name, mean, variance, sqrt(variance))
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [options] [labeled file]")
+    parser.add_option('--folds', type='int', default=FOLDS)
+    parser.add_option('--retrain', action='store_true',
+                      help="Also cross-validate by retraining, to compare the results and the time.")
+    options, args = parser.parse_args()
+    file_name = args[0] if args else TRAINING_FILE
+    test_data, actual_class = read_test_data(file_name)
+    print "Documents: %d, folds: %d" % (len(test_data), options.folds)
+
+    start_time = time.time()
+    accuracies = cross_validate(test_data, actual_class, options.folds)
+    print "Cross-validation: %.3f s" % (time.time() - start_time)
+    print_accuracies(accuracies)
+    if options.retrain:
+        start_time = time.time()
+        retrained = cross_validate_by_retraining(test_data, actual_class, options.folds)
+        print "Cross-validation by retraining: %.3f s" % (time.time() - start_time)
+        for name, method_name in CLASSIFIERS:
+            if retrained[name] != accuracies[name]:
+                print "Accuracies differ (%s): %s != %s" % (name, retrained[name], accuracies[name])
@@ -0,0 +1,233 @@
+# hashed_model.py
+# Count tables kept in a count-min sketch of fixed size, see Classifier.use_hashed_model.
+# e.g. python hashed_model.py # Compare sketch sizes against the exact counts on the pnp data.
+# e.g. python hashed_model.py train.txt test.txt 4096,65536
+#
+# Every (context, item) count and every context total is a cell in each row of the
+# sketch, picked by hashing the pair. Updates are conservative: only the cells below
+# the new estimate are raised. An estimate is the smallest of its cells, so counts
+# are never underestimated and only overestimated by collisions.
+
+import sys
+import time
+import random
+from array import array
+from classifier import Classifier, Model, PRIOR_KEY, SYMBOL_BITS, UNKNOWN_ID
+from test_classifier import read_test_data
+from train_classifier import TRAINING_FILE, TEST_FILE
+
+WIDTH = 1 << 20
+DEPTH = 4
+SEED = 42
+
+# A Mersenne prime above every (context key, item id) pair, for the row hashes.
+HASH_PRIME = (1 << 89) - 1
+
+# Counts are 32 bit cells.
+MAX_COUNT = (1 << 32) - 1
+
+class HashedItems(object):
+    """{item id: count} view of one context of a HashedModel.
+    Counts set on it are kept in the view, so that a copy can be changed the way
+    OverlayModel completes its copies of a base's tables.
+    """
+
+    def __init__(self, model, key, counts=None):
+        self.model = model
+        self.key = key
+        self.counts = counts if counts is not None else {}
+
+    def get(self, item_id, default=None):
+        count = self.counts.get(item_id)
+        if count is not None:
+            return count
+        if item_id == UNKNOWN_ID:
+            # The total is kept as the count of the unknown item.
+            return default
+        count = self.model.estimate(self.key, item_id)
+        return default if count == 0 else count
+
+    def __getitem__(self, item_id):
+        count = self.get(item_id)
+        if count is None:
+            raise KeyError(item_id)
+        return count
+
+    def __contains__(self, item_id):
+        return self.get(item_id) is not None
+
+    def __setitem__(self, item_id, count):
+        self.counts[item_id] = count
+
+    def copy(self):
+        return HashedItems(self.model, self.key, dict(self.counts))
+
+    def __iter__(self):
+        raise TypeError("The items of hashed counts can't be listed.")
+
+    keys = iterkeys = itervalues = iteritems = __iter__
+
+class HashedTables(object):
+    """The {context key: [total, items]} tables of a HashedModel. Tables can be looked
+    up but not listed. A context with no counts has no table.
+    """
+
+    def __init__(self, model):
+        self.model = model
+
+    def get(self, key, default=None):
+        if key == PRIOR_KEY:
+            return self.model.prior if self.model.prior[0] else default
+        total = self.model.estimate(key, UNKNOWN_ID)
+        if total == 0:
+            return default
+        return [total, HashedItems(self.model, key)]
+
+    def __getitem__(self, key):
+        table = self.get(key)
+        if table is None:
+            raise KeyError(key)
+        return table
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __nonzero__(self):
+        return self.model.prior[0] > 0
+
+    def __iter__(self):
+        raise TypeError("The tables of hashed counts can't be listed.")
+
+    __len__ = keys = iterkeys = itervalues = iteritems = __iter__
+
+class HashedModel(Model):
+    """A Model whose counts take a fixed width*depth*4 bytes however many contexts
+    and items are trained, apart from the class prior, which is kept exactly.
+    Lookups work the same as a Model's, but the tables can't be listed, so the model
+    can't be saved, compiled, pruned or merged, and Classifier.check_model only checks
+    the class prior.
+    width - The cells in each row of the sketch.
+    depth - The rows, each with its own cell for a pair.
+    """
+
+    def __init__(self, symbols=None, width=None, depth=None, seed=SEED):
+        Model.__init__(self, symbols)
+        self.width = width if width is not None else WIDTH
+        self.depth = depth if depth is not None else DEPTH
+        rng = random.Random(seed)
+        self.hash_a = rng.randint(1, HASH_PRIME - 1)
+        self.hash_b = rng.randint(0, HASH_PRIME - 1)
+        self.cells = array('I', [0])*(self.width*self.depth)
+        self.prior = [0, {}]
+        self.tables = HashedTables(self)
+
+    def _get_cells(self, key, item_id):
+        """Return the index of the pair's cell in each row."""
+        # One universal hash is split in two, and row i uses the first plus i times the second.
+        h = (self.hash_a*((key << SYMBOL_BITS) | item_id) + self.hash_b) % HASH_PRIME
+        h1 = h >> 44
+        h2 = (h & 0xFFFFFFFFFFF) | 1
+        width = self.width
+        return [row*width + (h1 + row*h2) % width for row in xrange(self.depth)]
+
+    def estimate(self, key, item_id):
+        """Return the estimated count of the item in the context, its total for UNKNOWN_ID."""
+        cells = self.cells
+        return min(cells[i] for i in self._get_cells(key, item_id))
+
+    def _add(self, key, item_id, increment):
+        cells = self.cells
+        indexes = self._get_cells(key, item_id)
+        count = min(cells[i] for i in indexes) + increment
+        if count > MAX_COUNT:
+            raise ValueError("Count too large for a hashed model.")
+        for i in indexes:
+            if cells[i] < count:
+                cells[i] = count
+
+    def add_by_key(self, item_id, key, increment=1):
+        if key == PRIOR_KEY:
+            self.prior[0] += increment
+            items = self.prior[1]
+            items[item_id] = items.get(item_id, 0) + increment
+        else:
+            self._add(key, item_id, increment)
+            self._add(key, UNKNOWN_ID, increment)
+
+    def get_size(self):
+        """Return the bytes the sketch takes."""
+        return self.cells.itemsize*len(self.cells)
+
+    def check_sum_to_one(self):
+        """Only the exact prior can be checked."""
+        return self.prior[0] == sum(self.prior[1].itervalues())
+
+    def mimic(self, model):
+        raise TypeError("A hashed model can't take another model's contents.")
+
+def get_model_size(model):
+    """Return roughly the bytes of a Model's tables: the dicts, lists and counts."""
+    size = sys.getsizeof(model.tables)
+    for key, table in model.tables.iteritems():
+        size += sys.getsizeof(key) + sys.getsizeof(table) + sys.getsizeof(table[0]) + sys.getsizeof(table[1])
+        for count in table[1].itervalues():
+            size += sys.getsizeof(count)
+    return size
+
+# The classifiers compared, all of them read the hashed counts.
+METHODS = [
+    'classify',
+    'classify_plus_one',
+    'classify_prev_token_plus_one',
+    'classify_prev_prev_token_plus_one',
+]
+
+def train(c, test_data, actual_class):
+    for token_list, class_name in zip(test_data, actual_class):
+        c.train(class_name, token_list)
+    c.signal_end_of_training()
+
+def predict(c, test_data):
+    return dict((method, [getattr(c, method)(token_list) for token_list in test_data]) for method in METHODS)
+
+def accuracy(predicted, actual_class):
+    return float(sum(1 for p, a in zip(predicted, actual_class) if p == a))/len(actual_class)
+
+if __name__ == "__main__":
+    train_file = sys.argv[1] if len(sys.argv) > 1 else TRAINING_FILE
+    test_file = sys.argv[2] if len(sys.argv) > 2 else TEST_FILE
+    widths = [1 << 12, 1 << 14, 1 << 16, 1 << 18]
+    if len(sys.argv) > 3:
+        widths = [int(width) for width in sys.argv[3].split(',')]
+    train_data, train_class = read_test_data(train_file)
+    test_data, actual_class = read_test_data(test_file)
+
+    exact = Classifier()
+    start_time = time.time()
+    train(exact, train_data, train_class)
+    train_time = time.time() - start_time
+    start_time = time.time()
+    expected = predict(exact, test_data)
+    test_time = time.time() - start_time
+    print "Exact: %d contexts, %d entries, about %d bytes, train %.3f s, classify %.3f s" % \
+          (exact.model.get_number_of_tables(), exact.model.get_number_of_entries(),
+           get_model_size(exact.model), train_time, test_time)
+    for method in METHODS:
+        print "  %s: %.4f" % (method, accuracy(expected[method], actual_class))
+
+    for width in widths:
+        c = Classifier()
+        c.use_hashed_model(width, DEPTH)
+        start_time = time.time()
+        train(c, train_data, train_class)
+        train_time = time.time() - start_time
+        start_time = time.time()
+        predicted = predict(c, test_data)
+        test_time = time.time() - start_time
+        print "Hashed (width %d, depth %d): %d bytes, train %.3f s, classify %.3f s" % \
+              (width, DEPTH, c.model.get_size(), train_time, test_time)
+        for method in METHODS:
+            agreement = accuracy(predicted[method], expected[method])
+            print "  %s: %.4f (%+.4f), agrees with exact %.4f" % \
+                  (method, accuracy(predicted[method], actual_class),
+                   accuracy(predicted[method], actual_class) - accuracy(expected[method], actual_class), agreement)
@@ -0,0 +1,219 @@
+# instrumentation.py
+# Optional counters and timers for a Classifier, see Classifier.enable_instrumentation.
+#
+# Nothing here runs unless instrumentation is enabled: enabling it shadows the
+# methods being measured with counting versions on the instances, and disabling it
+# removes them, so the classes themselves are never slowed down.
+#
+# Lookups are counted by the length of their context (0 for the class prior, 1 for
+# the class alone, up to 3 for the class and two previous tokens) and by outcome:
+#   hit - The item is in the context's table.
+#   junk - It isn't, and the JUNK slack variable's count is used instead.
+#   miss - Neither is in the table.
+#   unseen - There is no table for the context.
+# The assume seen classifiers look up every n-gram of the document for every class
+# in the unsmoothed model and have no slack variable, so they only hit or miss.
+
+import sys
+import time
+from classifier import Classifier, CompiledModel, ORDER_BITS, SYMBOL_BITS, NO_SMOOTHING, UNSMOOTHED
+
+OUTCOMES = ('hit', 'junk', 'miss', 'unseen')
+
+# Scoring engine methods that sum the log probabilities of n-grams.
+SUM_METHODS = ('_sum_compiled', '_sum_plus_one', '_sum_unsmoothed')
+
+# Model methods that look up one item in one context.
+LOOKUP_METHODS = ('log', 'smoothed_log')
+
+def get_classify_methods():
+    """Return the names of the Classifier methods that are timed."""
+    return sorted(name for name in dir(Classifier) if name.startswith('classify'))
+
+class Instrumentation(object):
+    """Lookup counts and classify call times of one classifier.
+    log_interval - Write a summary line to log_file at most this often, in seconds,
+                   after a classify call. None to never log.
+    """
+
+    def __init__(self, classifier, log_interval=None, log_file=None):
+        self.classifier = classifier
+        self.log_interval = log_interval
+        self.log_file = log_file if log_file is not None else sys.stderr
+        self.reset()
+        self.instrumented = []
+
+    def reset(self):
+        """Zero the counts and times."""
+        # {context length: {outcome: count}}
+        self.lookups = {}
+        # {method name: [calls, seconds, slowest call in seconds]}
+        self.methods = {}
+        self.last_log_time = time.time()
+
+    def _count(self, order, outcome):
+        counts = self.lookups.get(order)
+        if counts is None:
+            counts = self.lookups[order] = dict.fromkeys(OUTCOMES, 0)
+        counts[outcome] += 1
+
+    def _shadow(self, instance, name, function):
+        """Set an instance attribute that shadows the class's method until detach."""
+        setattr(instance, name, function)
+        self.instrumented.append((instance, name))
+
+    def attach(self):
+        """Instrument the classifier, its models and its scoring engines.
+        The classifier's instrumentation has to be this already.
+        """
+        c = self.classifier
+        for name in get_classify_methods():
+            self._shadow(c, name, self._timed(name, getattr(c, name)))
+        self._shadow(c, '_classify_assume_seen', self._counted_assume_seen(c._classify_assume_seen))
+        for engine in c.scoring_engines.itervalues():
+            self.instrument_engine(engine)
+        c._instrument_models()
+
+    def detach(self):
+        """Remove everything attach and the instrument methods added."""
+        for instance, name in self.instrumented:
+            if name in instance.__dict__:
+                delattr(instance, name)
+        self.instrumented = []
+
+    def instrument_engine(self, engine):
+        for name in SUM_METHODS:
+            self._shadow(engine, name, self._counted_sum(engine, getattr(engine, name)))
+
+    def instrument_model(self, model):
+        for name in LOOKUP_METHODS:
+            if name not in model.__dict__:
+                self._shadow(model, name, self._counted_lookup(model, getattr(model, name)))
+
+    def _timed(self, name, method):
+        def timed(*args, **kwargs):
+            start_time = time.time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                seconds = time.time() - start_time
+                timing = self.methods.get(name)
+                if timing is None:
+                    timing = self.methods[name] = [0, 0.0, 0.0]
+                timing[0] += 1
+                timing[1] += seconds
+                if seconds > timing[2]:
+                    timing[2] = seconds
+                if self.log_interval is not None and start_time - self.last_log_time >= self.log_interval:
+                    self.log()
+        return timed
+
+    def _counted_sum(self, engine, method):
+        """Return a version of a scoring engine's sum method that also counts lookups."""
+        classifier = self.classifier
+        order = engine.order + 1
+        counts = dict.fromkeys(OUTCOMES, 0)
+        def counted_sum(model, prefix, ngrams, total1, total2):
+            junk_id = classifier.symbols.get_id(classifier.JUNK)
+            tables = model.tables
+            # Compiled tables are (logs, fallback), count tables are [total, items].
+            item_index = 0 if isinstance(model, CompiledModel) else 1
+            plus_one = method.__name__ != '_sum_unsmoothed'
+            for suffix, token_id in ngrams:
+                key = ((prefix | suffix) << ORDER_BITS) | order
+                table = tables.get(key)
+                if table is None:
+                    counts['unseen'] += 1
+                elif token_id in table[item_index]:
+                    counts['hit'] += 1
+                elif plus_one and (junk_id in table[item_index] or
+                                   (item_index and model.get_virtual_junk_id(key) == junk_id)):
+                    counts['junk'] += 1
+                else:
+                    counts['miss'] += 1
+            totals = self.lookups.get(order)
+            if totals is None:
+                totals = self.lookups[order] = dict.fromkeys(OUTCOMES, 0)
+            for outcome in OUTCOMES:
+                totals[outcome] += counts[outcome]
+                counts[outcome] = 0
+            return method(model, prefix, ngrams, total1, total2)
+        return counted_sum
+
+    def _counted_assume_seen(self, method):
+        """Return a version of Classifier._classify_assume_seen that also counts its
+        lookups, one per class and n-gram of the document.
+        """
+        classifier = self.classifier
+        def counted_assume_seen(token_list, order):
+            ngrams = classifier.get_scoring_engine(order, NO_SMOOTHING, UNSMOOTHED).get_ngrams(token_list)
+            model = classifier.model
+            tables = model.tables
+            tag = order + 1
+            counts = dict.fromkeys(OUTCOMES, 0)
+            for class_name in model.get_table_iterator(''):
+                prefix = classifier.symbols.get_id(class_name) << (order*SYMBOL_BITS)
+                for suffix, token_id in ngrams:
+                    table = tables.get(((prefix | suffix) << ORDER_BITS) | tag)
+                    if table is None:
+                        counts['unseen'] += 1
+                    elif token_id in table[1]:
+                        counts['hit'] += 1
+                    else:
+                        counts['miss'] += 1
+            totals = self.lookups.get(tag)
+            if totals is None:
+                totals = self.lookups[tag] = dict.fromkeys(OUTCOMES, 0)
+            for outcome in OUTCOMES:
+                totals[outcome] += counts[outcome]
+            return method(token_list, order)
+        return counted_assume_seen
+
+    def _counted_lookup(self, model, method):
+        """Return a version of Model.log or smoothed_log that also counts the lookup."""
+        smoothed = method.__name__ == 'smoothed_log'
+        def counted_lookup(item, given, *args, **kwargs):
+            table, item_id = model._get_table(item, given)
+            if table is None:
+                outcome = 'unseen'
+            elif item_id in table[1]:
+                outcome = 'hit'
+            elif smoothed and model.symbols.get_id(args[2] if len(args) > 2 else kwargs.get('slack_var')) in table[1]:
+                outcome = 'junk'
+            else:
+                outcome = 'miss'
+            self._count(len(given), outcome)
+            return method(item, given, *args, **kwargs)
+        return counted_lookup
+
+    def stats(self):
+        """Return the counts and times as a dict of plain values."""
+        lookups = {}
+        for order, counts in self.lookups.iteritems():
+            lookups[order] = dict(counts)
+            lookups[order]['total'] = sum(counts.itervalues())
+        methods = {}
+        for name, (calls, seconds, slowest) in self.methods.iteritems():
+            methods[name] = {
+                'calls': calls,
+                'seconds': seconds,
+                'mean_seconds': seconds/calls,
+                'max_seconds': slowest,
+            }
+        return {'lookups': lookups, 'methods': methods}
+
+    def log_line(self):
+        """Return a one line summary of the stats."""
+        parts = []
+        for name, (calls, seconds, slowest) in sorted(self.methods.iteritems()):
+            parts.append("%s %d calls %.3f ms/call" % (name, calls, 1000*seconds/calls))
+        for order, counts in sorted(self.lookups.iteritems()):
+            total = sum(counts.itervalues())
+            parts.append("order %d %d lookups %s" % (order, total, ' '.join(
+                "%s %.1f%%" % (outcome, 100.0*counts[outcome]/total) for outcome in OUTCOMES)))
+        return "Instrumentation: " + "; ".join(parts)
+
+    def log(self):
+        self.log_file.write(self.log_line() + '\n')
+        self.log_file.flush()
+        self.last_log_time = time.time()
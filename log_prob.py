@@ -2,6 +2,7 @@
 # simple command line utility 
 # e.g. python log_prob.py movie "" # Gets the log probability of a movie, log(P(c=movie))
 # e.g. python lob_prob.py w movie s a # Gets the log of P(w_i=w|c=movie, w_i-2=s, w_i-1=a)
+# Asks a running classify_server.py on SERVER_SOCKET if there is one instead of loading the model.
 
 import os.path as path
 import re
@@ -10,12 +11,11 @@ import json
 import sys
 from classifier import Classifier
 from collections import OrderedDict
-from train_classifier import token_iterator, TOKEN_PATTERN, TEST_FILE, TRAINING_FILE_OUTPUT
+from classify_server import connect
+from train_classifier import TEST_FILE, TRAINING_FILE_OUTPUT, TRAINING_BINARY_OUTPUT
 
 
 if __name__ == "__main__":
-    c = Classifier()
-    c.load_model(TRAINING_FILE_OUTPUT)
     item = unicode(sys.argv[1], 'utf-8')
     given_list = sys.argv[2:]
     for i, v in enumerate(given_list):
@@ -23,6 +23,25 @@ if __name__ == "__main__":
     given = tuple(given_list)
     if given[0] == '':
         given = ''
+    client = connect()
+    if client is not None:
+        print "Token:", item, "Given:", given
+        response = client.request('log', item=item, given=list(given))
+        n, d = response['log']
+        print n-d, "(Raw Log)"
+        n, d = response['smoothed_log']
+        print n-d, "(Smoothed Log)"
+        n, d = response['semi_supervised_log']
+        print n-d, "(Semi Supervised Log)"
+        print client.request('table', given=list(given))['table']
+        client.close()
+        sys.exit()
+    c = Classifier()
+    # Only the sections used below are read from the binary model.
+    if path.exists(TRAINING_BINARY_OUTPUT):
+        c.load_model(TRAINING_BINARY_OUTPUT, lazy=True)
+    else:
+        c.load_model(TRAINING_FILE_OUTPUT)
     print "Token:", item, "Given:", given
     n, d = c.model.log(item, given)
     print n-d, "(Raw Log)"
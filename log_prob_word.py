@@ -6,14 +6,24 @@ import json
 import sys
 from classifier import Classifier
 from collections import OrderedDict
-from train_classifier import token_iterator, TOKEN_PATTERN, TEST_FILE, TRAINING_FILE_OUTPUT
+from classify_server import connect
+from train_classifier import TOKENIZER, TEST_FILE, TRAINING_FILE_OUTPUT, TRAINING_BINARY_OUTPUT
 
 
 if __name__ == "__main__":
-    c = Classifier()
-    c.load_model(TRAINING_FILE_OUTPUT)
     item = unicode(sys.argv[1], 'utf-8')
-    tokens = []
-    for token in token_iterator(item, TOKEN_PATTERN):
-        tokens.append(token)
+    # Ask a running classify_server.py if there is one instead of loading the model.
+    client = connect()
+    if client is not None:
+        response = client.request('classify', text=item, method='classify_prev_prev_token_plus_one_special')
+        print "Smooth Log Prob (two token):", (response['class'], response['log'])
+        client.close()
+        sys.exit()
+    c = Classifier()
+    # Only the sections used below are read from the binary model.
+    if path.exists(TRAINING_BINARY_OUTPUT):
+        c.load_model(TRAINING_BINARY_OUTPUT, lazy=True)
+    else:
+        c.load_model(TRAINING_FILE_OUTPUT)
+    tokens = TOKENIZER.tokens(item)
     print "Smooth Log Prob (two token):", c.classify_prev_prev_token_plus_one_special(tokens)
@@ -0,0 +1,265 @@
+# micro_batcher.py
+# Classify documents submitted from many threads in micro-batches.
+# e.g. python micro_batcher.py # Compare 64 client threads classifying inline and batched.
+# e.g. python micro_batcher.py 256 32 0.002 # Clients, batch size and max wait in seconds.
+#
+# submit returns a ClassificationFuture right away. Worker threads take requests off
+# a bounded queue, up to max_batch_size of them or as many as arrive within max_wait
+# of the first, and classify them together with Classifier.classify_batch, or one by
+# one without numpy. A future's callbacks run on the worker thread, so an event loop
+# can hand the result over to itself from one.
+
+import sys
+import time
+import Queue
+import threading
+from classifier import SCORING_METHODS, np
+from classify_server import LatencyStats, load_classifier
+from test_classifier import read_test_data
+from train_classifier import TEST_FILE
+
+MAX_BATCH_SIZE = 64
+MAX_WAIT = 0.005
+MAX_QUEUE = 1024
+
+class ClassificationFuture(object):
+    """The (class name, [(class name, log probability), ...]) of a submitted document,
+    once its batch has been classified.
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the result and return it, or raise the batch's exception."""
+        if not self._done.wait(timeout):
+            raise RuntimeError("Timed out waiting for the classification.")
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError("Timed out waiting for the classification.")
+        return self._exception
+
+    def add_done_callback(self, callback):
+        """Call callback(future) once the future is done, right away if it already is."""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _finish(self, result, exception):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._done.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exception):
+        self._finish(None, exception)
+
+class MicroBatcher(object):
+    """Classify the documents submitted from any thread in batches.
+    method - The name of the n-gram classify method to match, see SCORING_METHODS.
+    max_batch_size - The most documents classified together.
+    max_wait - The most seconds a batch waits for more documents after its first.
+    max_queue - The most documents waiting. submit blocks, or raises Queue.Full,
+                while the queue is full.
+    workers - The number of threads classifying batches.
+    """
+
+    def __init__(self, classifier, method='classify_prev_prev_token_plus_one', max_batch_size=MAX_BATCH_SIZE,
+                 max_wait=MAX_WAIT, max_queue=MAX_QUEUE, workers=1):
+        if method not in SCORING_METHODS:
+            raise ValueError("No batch version of %r." % (method,))
+        self.classifier = classifier
+        self.method = method
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = Queue.Queue(max_queue)
+        # Latencies of 'queue', the wait of each document before its batch started,
+        # and 'batch', the time each batch took to classify.
+        self.stats = LatencyStats()
+        self.batch_sizes = {}
+        self.rejected = 0
+        self.max_queue_depth = 0
+        self.lock = threading.Lock()
+        # The scores and compiled tables are built once before any worker needs them.
+        if np is not None:
+            classifier.classify_batch([[]], method)
+        self.threads = [threading.Thread(target=self._work) for i in xrange(workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, token_list, block=True, timeout=None):
+        """Queue a document and return its ClassificationFuture.
+        block, timeout - What to do while the queue is full, as for Queue.put.
+        """
+        future = ClassificationFuture()
+        try:
+            self.queue.put((token_list, future, time.time()), block, timeout)
+        except Queue.Full:
+            with self.lock:
+                self.rejected += 1
+            raise
+        depth = self.queue.qsize()
+        with self.lock:
+            if depth > self.max_queue_depth:
+                self.max_queue_depth = depth
+        return future
+
+    def classify(self, token_list):
+        """Submit a document and wait for its result."""
+        return self.submit(token_list).result()
+
+    def close(self):
+        """Classify what is queued, then stop the workers."""
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _next_batch(self):
+        """Return the next batch of requests and whether this worker got its stop."""
+        request = self.queue.get()
+        if request is None:
+            return [], True
+        batch = [request]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    request = self.queue.get(True, remaining)
+                else:
+                    request = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            if request is None:
+                # Putting the stop back could block on a full queue, so the worker
+                # stops after this batch instead.
+                return batch, True
+            batch.append(request)
+        return batch, False
+
+    def _classify_batch(self, token_lists):
+        """Return (class name, scores) of each document."""
+        if np is not None:
+            predicted, scores, class_names = self.classifier.classify_batch(token_lists, self.method)
+            return [(class_name, zip(class_names, row.tolist())) for class_name, row in zip(predicted, scores)]
+        engine = self.classifier.get_scoring_engine(*SCORING_METHODS[self.method])
+        results = []
+        for token_list in token_lists:
+            scores = engine.score(token_list)
+            max_class = "No Class"
+            max_log_prob = -sys.float_info.max
+            for class_name, total in scores:
+                if total >= max_log_prob:
+                    max_log_prob = total
+                    max_class = class_name
+            results.append((max_class, scores))
+        return results
+
+    def _work(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self._next_batch()
+            if not batch:
+                return
+            start_time = time.time()
+            try:
+                results = self._classify_batch([token_list for token_list, future, submit_time in batch])
+                exception = None
+            except Exception as e:
+                exception = e
+            end_time = time.time()
+            with self.lock:
+                self.stats.record('batch', end_time - start_time)
+                for token_list, future, submit_time in batch:
+                    self.stats.record('queue', start_time - submit_time)
+                self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+            for i, (token_list, future, submit_time) in enumerate(batch):
+                if exception is None:
+                    future.set_result(results[i])
+                else:
+                    future.set_exception(exception)
+
+    def report(self):
+        """Return the batch fill, queueing delay and batch latency metrics."""
+        with self.lock:
+            batches = sum(self.batch_sizes.itervalues())
+            documents = sum(size*count for size, count in self.batch_sizes.iteritems())
+            return {
+                'batches': batches,
+                'documents': documents,
+                'mean_batch_size': float(documents)/batches if batches else None,
+                'mean_fill': float(documents)/(batches*self.max_batch_size) if batches else None,
+                'batch_sizes': dict(self.batch_sizes),
+                'rejected': self.rejected,
+                'max_queue_depth': self.max_queue_depth,
+                'latency': self.stats.report(),
+            }
+
+def run_clients(classify, documents, number_of_clients):
+    """Classify the documents from number_of_clients threads at once and return the
+    results in document order and the seconds it took.
+    """
+    results = [None]*len(documents)
+    def client(start):
+        for i in xrange(start, len(documents), number_of_clients):
+            results[i] = classify(documents[i])
+    threads = [threading.Thread(target=client, args=(i,)) for i in xrange(number_of_clients)]
+    start_time = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.time() - start_time
+
+if __name__ == "__main__":
+    number_of_clients = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    max_batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else MAX_BATCH_SIZE
+    max_wait = float(sys.argv[3]) if len(sys.argv) > 3 else MAX_WAIT
+    test_file = sys.argv[4] if len(sys.argv) > 4 else TEST_FILE
+    method = 'classify_prev_prev_token_plus_one'
+    c = load_classifier()
+    documents, actual_class = read_test_data(test_file)
+    print "Documents: %d, clients: %d" % (len(documents), number_of_clients)
+
+    # Calls from many threads are serialized the same way a server's lock does.
+    lock = threading.Lock()
+    def classify_inline(token_list):
+        with lock:
+            return getattr(c, method)(token_list)
+    expected, inline_time = run_clients(classify_inline, documents, number_of_clients)
+    print "Inline: %.3f s, %.1f docs/sec" % (inline_time, len(documents)/inline_time)
+
+    batcher = MicroBatcher(c, method, max_batch_size, max_wait)
+    results, batched_time = run_clients(batcher.classify, documents, number_of_clients)
+    batcher.close()
+    print "Batched: %.3f s, %.1f docs/sec" % (batched_time, len(documents)/batched_time)
+    agreement = sum(1 for (class_name, scores), expected_class in zip(results, expected)
+                    if class_name == expected_class)
+    print "Agrees with inline: %d of %d" % (agreement, len(documents))
+    report = batcher.report()
+    print "Batches: %d, mean size %.1f of %d (%.1f%% full), max queue depth %d" % \
+          (report['batches'], report['mean_batch_size'], max_batch_size, 100*report['mean_fill'],
+           report['max_queue_depth'])
+    batcher.stats.print_report(sys.stdout)
@@ -0,0 +1,103 @@
+# prune_model.py
+# Prune the trained model at several count thresholds and report the size and
+# held-out accuracy of each, see Classifier.prune_models.
+# e.g. python prune_model.py # Thresholds 1 (unpruned), 2, 3, 5 and 10 on the validation file.
+# e.g. python prune_model.py --thresholds 2 --output pruned.bin # Also save the pruned model.
+# e.g. python prune_model.py --max-bytes 2000000 --output pruned.bin # Fit a size instead.
+
+import os
+import time
+import tempfile
+import os.path as path
+from optparse import OptionParser
+from classifier import Classifier
+from test_classifier import read_test_data
+from train_classifier import VALIDATE_FILE, TRAINING_FILE_OUTPUT, TRAINING_BINARY_OUTPUT
+
+THRESHOLDS = [1, 2, 3, 5, 10]
+
+# The classifiers whose accuracy is reported, all of them read the pruned counts.
+METHODS = [
+    'classify_plus_one',
+    'classify_prev_token_plus_one',
+    'classify_prev_prev_token_plus_one',
+    'classify_semi_supervised',
+]
+
+def load_classifier(file_name):
+    c = Classifier()
+    c.load_model(file_name)
+    return c
+
+def accuracy(c, method, test_data, actual_class):
+    classify = getattr(c, method)
+    correct = 0
+    for token_list, class_name in zip(test_data, actual_class):
+        if classify(token_list) == class_name:
+            correct += 1
+    return float(correct)/len(test_data)
+
+def measure(c, test_data, actual_class):
+    """Return the size and accuracy of the classifier's models."""
+    handle, file_name = tempfile.mkstemp(suffix='.bin')
+    os.close(handle)
+    try:
+        c.save_binary_model(file_name)
+        file_size = path.getsize(file_name)
+    finally:
+        os.remove(file_name)
+    result = {
+        'contexts': c.model.get_number_of_tables(),
+        'entries': c.model.get_number_of_entries(),
+        'bytes': file_size,
+        'sums_to_one': c.check_model(),
+        'accuracy': {},
+    }
+    c.compile_models()
+    for method in METHODS:
+        result['accuracy'][method] = accuracy(c, method, test_data, actual_class)
+    return result
+
+def print_result(name, result, baseline):
+    print "%s: %d contexts, %d entries, %d bytes (%.1f%%), sums to one: %s" % \
+          (name, result['contexts'], result['entries'], result['bytes'],
+           100.0*result['bytes']/baseline['bytes'], result['sums_to_one'])
+    for method in METHODS:
+        print "  %s: %.4f (%+.4f)" % (method, result['accuracy'][method],
+                                      result['accuracy'][method] - baseline['accuracy'][method])
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option('--model', help="The model to prune, by default the trained one.")
+    parser.add_option('--held-out', default=VALIDATE_FILE, help="The labeled file accuracy is measured on.")
+    parser.add_option('--thresholds', default=','.join(str(t) for t in THRESHOLDS),
+                      help="Comma separated min_count values to try.")
+    parser.add_option('--min-total', type='int', default=1, help="Also remove contexts counted fewer times.")
+    parser.add_option('--max-bytes', type='int', help="Prune to this size instead of by threshold.")
+    parser.add_option('--no-junk', action='store_true',
+                      help="Take pruned counts off the totals instead of counting them as JUNK.")
+    parser.add_option('--output', help="Save the last pruned model in the binary format.")
+    options, args = parser.parse_args()
+    model_file = options.model
+    if model_file is None:
+        model_file = TRAINING_BINARY_OUTPUT if path.exists(TRAINING_BINARY_OUTPUT) else TRAINING_FILE_OUTPUT
+    test_data, actual_class = read_test_data(options.held_out)
+    print "Held-out documents:", len(test_data)
+
+    baseline = measure(load_classifier(model_file), test_data, actual_class)
+    print_result("Unpruned", baseline, baseline)
+    runs = [dict(min_count=1, max_bytes=options.max_bytes)]
+    if options.max_bytes is None:
+        runs = [dict(min_count=int(t)) for t in options.thresholds.split(',')]
+    for run in runs:
+        c = load_classifier(model_file)
+        start_time = time.time()
+        stats = c.prune_models(min_total=options.min_total, fold_into_junk=not options.no_junk, **run)
+        seconds = time.time() - start_time
+        result = measure(c, test_data, actual_class)
+        print_result("min_count %d (%.3f s, %d items and %d contexts removed)" %
+                     (stats['min_count'], seconds, stats['items_removed'], stats['contexts_removed']),
+                     result, baseline)
+    if options.output:
+        c.save_binary_model(options.output)
+        print "Saved", options.output
@@ -0,0 +1,105 @@
+# quantize_model.py
+# Compare the plus one classifiers with quantized compiled log probabilities against
+# exact ones: memory, speed and how often they agree, see CompiledModel.quantize.
+# e.g. python quantize_model.py # The trained model on the validation file.
+# e.g. python quantize_model.py --quantizations uint8 --held-out assignment2/pnp-test.txt
+
+import sys
+import time
+import os.path as path
+from optparse import OptionParser
+from classifier import Classifier, FLOAT16, UINT8, UINT16
+from test_classifier import read_test_data
+from train_classifier import VALIDATE_FILE, TRAINING_FILE_OUTPUT, TRAINING_BINARY_OUTPUT
+
+QUANTIZATIONS = [FLOAT16, UINT16, UINT8]
+
+# The classifiers that read the compiled models.
+METHODS = [
+    'classify_plus_one',
+    'classify_prev_token_plus_one',
+    'classify_prev_prev_token_plus_one',
+    'classify_semi_supervised',
+]
+
+def get_size(obj, seen):
+    """Return the bytes of obj and the dicts, tuples, lists, arrays and numbers it
+    holds, and of the slots of objects such as QuantizedLogs, counting each object
+    once however often it is shared.
+    """
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += get_size(key, seen) + get_size(value, seen)
+    elif isinstance(obj, (tuple, list)):
+        for value in obj:
+            size += get_size(value, seen)
+    elif hasattr(obj, '__slots__'):
+        for name in obj.__slots__:
+            size += get_size(getattr(obj, name), seen)
+    return size
+
+def get_compiled_size(c):
+    """Return the bytes of the classifier's compiled tables."""
+    seen = set()
+    return sum(get_size(compiled_model.tables, seen)
+               for compiled_model in (c.compiled_smoothed_model, c.compiled_semi_supervised_model))
+
+def measure(c, test_data, actual_class):
+    """Return the size, speed and predictions of the classifier's compiled models."""
+    result = {
+        'bytes': get_compiled_size(c),
+        'seconds': 0.0,
+        'predicted': {},
+        'accuracy': {},
+    }
+    for method in METHODS:
+        classify = getattr(c, method)
+        start_time = time.time()
+        predicted = [classify(token_list) for token_list in test_data]
+        result['seconds'] += time.time() - start_time
+        result['predicted'][method] = predicted
+        result['accuracy'][method] = agreement(predicted, actual_class)
+    return result
+
+def agreement(predicted, expected):
+    return float(sum(1 for p, e in zip(predicted, expected) if p == e))/len(expected)
+
+def print_result(name, result, baseline):
+    documents = len(METHODS)*len(baseline['predicted'][METHODS[0]])
+    print "%s: %d bytes (%.1f%%), %.1f docs/sec (%.2fx)" % \
+          (name, result['bytes'], 100.0*result['bytes']/baseline['bytes'],
+           documents/result['seconds'], baseline['seconds']/result['seconds'])
+    for method in METHODS:
+        print "  %s: accuracy %.4f (%+.4f), agrees with exact %.4f" % \
+              (method, result['accuracy'][method], result['accuracy'][method] - baseline['accuracy'][method],
+               agreement(result['predicted'][method], baseline['predicted'][method]))
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option('--model', help="The model to quantize, by default the trained one.")
+    parser.add_option('--held-out', default=VALIDATE_FILE, help="The labeled file agreement is measured on.")
+    parser.add_option('--quantizations', default=','.join(QUANTIZATIONS),
+                      help="Comma separated quantizations to try.")
+    options, args = parser.parse_args()
+    model_file = options.model
+    if model_file is None:
+        model_file = TRAINING_BINARY_OUTPUT if path.exists(TRAINING_BINARY_OUTPUT) else TRAINING_FILE_OUTPUT
+    test_data, actual_class = read_test_data(options.held_out)
+    print "Held-out documents:", len(test_data)
+
+    c = Classifier()
+    c.load_model(model_file)
+    c.compile_models()
+    baseline = measure(c, test_data, actual_class)
+    print_result("Exact", baseline, baseline)
+    for quantization in options.quantizations.split(','):
+        start_time = time.time()
+        c.compile_models(quantization)
+        seconds = time.time() - start_time
+        codebook_size = len(c.compiled_smoothed_model.codebook)
+        print_result("%s (compiled in %.3f s, %d values)" % (quantization, seconds, codebook_size),
+                     measure(c, test_data, actual_class), baseline)
@@ -0,0 +1,204 @@
+# shared_model.py
+# Share one read-only model between worker processes through memory mapped files.
+# e.g. python shared_model.py publish trained.json models # Publish a new version.
+# e.g. python shared_model.py measure trained.json models 4 # Memory and speed per worker of each way to load.
+#
+# A published model is a binary_model.py file, whose count tables are flat arrays
+# read in place, so every worker that maps it shares the same page cache pages.
+# Looking counts up in the map is about ten times slower than in dicts, so a worker
+# compiles the log probabilities of the classify methods it uses into private
+# memory, and only those. Versions are written as model-<n>.bin next to a
+# CURRENT_LINK symlink to the newest one. The file and then the link are renamed into
+# place, so a worker sees either the old version or the whole new one.
+
+import os
+import re
+import sys
+import time
+import os.path as path
+import multiprocessing
+from classifier import Classifier, SCORING_METHODS
+from test_classifier import read_test_data
+from train_classifier import TEST_FILE
+
+CURRENT_LINK = 'current.bin'
+VERSION_PATTERN = re.compile(r'^model-(\d+)\.bin$')
+
+# The classify method the measurement runs. Every way of getting the model compiles
+# the log probabilities it uses, so the speeds compare.
+MEASURE_METHOD = 'classify_prev_prev_token_plus_one'
+
+def get_models(methods):
+    """Return the models the n-gram classify methods look their counts up in."""
+    return set(SCORING_METHODS[method][2] for method in methods)
+
+def get_versions(directory):
+    """Return the published version numbers in the directory, oldest first."""
+    versions = []
+    for file_name in os.listdir(directory):
+        m = VERSION_PATTERN.match(file_name)
+        if m is not None:
+            versions.append(int(m.group(1)))
+    return sorted(versions)
+
+def publish(classifier, directory, keep=None):
+    """Write the classifier as the next version in the directory and point CURRENT_LINK
+    at it. Return the version's file name.
+    keep - Delete all but this many of the newest versions. Workers that still map a
+           deleted version keep using it until they refresh.
+    """
+    if not path.exists(directory):
+        os.makedirs(directory)
+    versions = get_versions(directory)
+    version = versions[-1] + 1 if versions else 1
+    file_name = 'model-%d.bin' % version
+    temp_file = path.join(directory, '.%s.tmp' % file_name)
+    classifier.save_binary_model(temp_file)
+    os.rename(temp_file, path.join(directory, file_name))
+    temp_link = path.join(directory, '.%s.tmp' % CURRENT_LINK)
+    if path.lexists(temp_link):
+        os.remove(temp_link)
+    os.symlink(file_name, temp_link)
+    os.rename(temp_link, path.join(directory, CURRENT_LINK))
+    if keep is not None:
+        for old_version in (versions + [version])[:-keep]:
+            os.remove(path.join(directory, 'model-%d.bin' % old_version))
+    return file_name
+
+class SharedModel(object):
+    """A worker's attachment to the models published in a directory.
+    classifier is the newest version as of the last refresh.
+    methods - The classify methods the worker uses, see SCORING_METHODS. The models
+              they read are compiled on every refresh, by default all of them.
+    """
+
+    def __init__(self, directory, methods=None):
+        self.directory = directory
+        self.models = get_models(methods) if methods is not None else None
+        self.version = None
+        self.classifier = None
+        self.refresh()
+
+    def refresh(self):
+        """Attach to the newest version if it changed and return True if it did.
+        Call between requests: the classifier is replaced, never changed.
+        """
+        version = os.readlink(path.join(self.directory, CURRENT_LINK))
+        if version == self.version:
+            return False
+        c = Classifier()
+        c.load_model(path.join(self.directory, version), compile_models=False)
+        c.compile_models(models=self.models)
+        # The old version's map is closed once nothing uses its classifier any more.
+        self.classifier = c
+        self.version = version
+        return True
+
+def get_memory_usage():
+    """Return {'rss', 'pss', 'private', 'shared'} of this process in KB, or None
+    where /proc/self/smaps isn't available. pss charges each shared page to the
+    processes sharing it in equal parts.
+    """
+    fields = {'Rss': 0, 'Pss': 0, 'Private_Clean': 0, 'Private_Dirty': 0, 'Shared_Clean': 0, 'Shared_Dirty': 0}
+    for file_name in ('/proc/self/smaps_rollup', '/proc/self/smaps'):
+        if path.exists(file_name):
+            break
+    else:
+        return None
+    with open(file_name) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[0][:-1] in fields:
+                fields[parts[0][:-1]] += int(parts[1])
+    return {
+        'rss': fields['Rss'],
+        'pss': fields['Pss'],
+        'private': fields['Private_Clean'] + fields['Private_Dirty'],
+        'shared': fields['Shared_Clean'] + fields['Shared_Dirty'],
+    }
+
+def _measure_worker(mode, model_file, directory, test_data, inherited, ready, done, queue):
+    if mode == 'load':
+        c = Classifier()
+        c.load_model(model_file, compile_models=False)
+        c.compile_models(models=get_models([MEASURE_METHOD]))
+    elif mode == 'attach':
+        c = SharedModel(directory, [MEASURE_METHOD]).classifier
+    else:
+        c = inherited
+    classify = getattr(c, MEASURE_METHOD)
+    start_time = time.time()
+    for token_list in test_data:
+        classify(token_list)
+    seconds = time.time() - start_time
+    ready.release()
+    # Measured while every worker is still alive, so shared pages are shared.
+    done.wait()
+    usage = get_memory_usage()
+    if usage is not None:
+        usage['docs_per_sec'] = len(test_data)/seconds if seconds > 0 else float('inf')
+    queue.put(usage)
+
+def measure(mode, model_file, directory, test_data, number_of_workers):
+    """Return the memory usage and the documents classified per second of each of
+    number_of_workers processes that classified the test data after getting the
+    model one way:
+    'load' - Each worker loads model_file itself.
+    'fork' - The parent loads model_file and the workers inherit it copy-on-write.
+    'attach' - Each worker maps the version published in directory.
+    """
+    inherited = None
+    if mode == 'fork':
+        inherited = Classifier()
+        inherited.load_model(model_file, compile_models=False)
+        inherited.compile_models(models=get_models([MEASURE_METHOD]))
+    ready = multiprocessing.Semaphore(0)
+    done = multiprocessing.Event()
+    queue = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=_measure_worker, args=(mode, model_file, directory, test_data,
+                                                                       inherited, ready, done, queue))
+                 for i in xrange(number_of_workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        ready.acquire()
+    done.set()
+    usages = [queue.get() for process in processes]
+    for process in processes:
+        process.join()
+    return usages
+
+if __name__ == "__main__":
+    command = sys.argv[1]
+    model_file, directory = sys.argv[2:4]
+    c = Classifier()
+    c.load_model(model_file)
+    if command == 'publish':
+        print "Published", publish(c, directory)
+    elif command == 'measure':
+        number_of_workers = int(sys.argv[4]) if len(sys.argv) > 4 else 4
+        test_file = sys.argv[5] if len(sys.argv) > 5 else TEST_FILE
+        test_data, actual_class = read_test_data(test_file)
+        if not path.lexists(path.join(directory, CURRENT_LINK)):
+            publish(c, directory)
+        del c
+        for mode in ('load', 'fork', 'attach'):
+            usages = measure(mode, model_file, directory, test_data, number_of_workers)
+            if usages[0] is None:
+                print "No /proc/self/smaps to measure memory with."
+                break
+            mean = lambda name: sum(usage[name] for usage in usages)/len(usages)
+            print "%s: %d workers, per worker %d KB private, %d KB pss, %d KB rss, %.1f docs/sec" % \
+                  (mode, number_of_workers, mean('private'), mean('pss'), mean('rss'), mean('docs_per_sec'))
+        # A worker attached to the current version picks up a newer one on refresh.
+        worker = SharedModel(directory)
+        old_version = worker.version
+        start_time = time.time()
+        publish(worker.classifier, directory)
+        publish_time = time.time() - start_time
+        start_time = time.time()
+        worker.refresh()
+        print "Swapped %s for %s: publish %.3f s, refresh %.3f s" % \
+              (old_version, worker.version, publish_time, time.time() - start_time)
+    else:
+        raise ValueError("Unknown command %r." % (command,))
@@ -0,0 +1,70 @@
+# test_binary_model.py
+# Check which sections of a binary model file a lazy load reads, and that the
+# layered sections it loads as overlays score the same as an eager load.
+# e.g. python -m unittest test_binary_model
+
+import os
+import shutil
+import tempfile
+import unittest
+from classifier import Classifier
+
+DOCUMENTS = [
+    (u'movie', u'star wars'),
+    (u'movie', u'star trek'),
+    (u'person', u'john smith'),
+    (u'person', u'john doe'),
+]
+UNLABELED = [u'star man', u'john star', u'star john']
+
+class LazyLoadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.json_file = os.path.join(self.directory, 'model.json')
+        self.binary_file = os.path.join(self.directory, 'model.bin')
+        c = Classifier()
+        for class_name, text in DOCUMENTS:
+            c.train(class_name, list(text))
+        c.signal_end_of_training()
+        c.unsupervised_training([list(text) for text in UNLABELED], verbose=False)
+        self.assertTrue(c.semi_supervised_model.layer)
+        c.save_model(self.json_file)
+        c.save_binary_model(self.binary_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load(self, file_name, lazy):
+        c = Classifier()
+        c.load_model(file_name, lazy=lazy)
+        return c
+
+    def test_base_sections_load_on_first_lookup(self):
+        c = self.load(self.binary_file, True)
+        semi_supervised_model = c.semi_supervised_model
+        self.assertEqual(sorted(c.section_load_times), ['semi_supervised_model'])
+        # Only its own counts are read until the first lookup.
+        self.assertFalse('base' in semi_supervised_model.__dict__)
+        token_list = list(u'john wars')
+        expected = self.load(self.binary_file, False).classify_semi_supervised(token_list)
+        self.assertEqual(c.classify_semi_supervised(token_list), expected)
+        self.assertEqual(sorted(c.section_load_times),
+                         ['model', 'semi_supervised_model', 'semi_supervised_types', 'smoothed_model'])
+        # The overlays share the classifier's models rather than reading copies.
+        self.assertTrue(semi_supervised_model.base is c.smoothed_model)
+        self.assertTrue(c.smoothed_model.base is c.model)
+
+    def test_training_after_lazy_load(self):
+        c = self.load(self.binary_file, True)
+        expected = self.load(self.json_file, False)
+        for classifier in (c, expected):
+            classifier.semi_supervised_model
+            classifier.train(u'movie', list(u'john wick'))
+        for token_list in [list(u'john wick'), list(u'star doe')]:
+            for method in ('classify_prev_prev_token_plus_one', 'classify_semi_supervised'):
+                self.assertEqual(getattr(c, method)(token_list), getattr(expected, method)(token_list))
+            self.assertEqual(c.score(token_list), expected.score(token_list))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+# test_caches.py
+# Check that the tables and caches built from the counts follow later training.
+# e.g. python -m unittest test_caches
+
+import unittest
+from classifier import Classifier, SCORING_METHODS, np
+
+def get_classifier():
+    c = Classifier()
+    c.train('a', list('abc'))
+    c.train('b', list('bca'))
+    c.train('b', list('cab'))
+    c.signal_end_of_training()
+    return c
+
+class TrainingAfterUseTest(unittest.TestCase):
+
+    @unittest.skipIf(np is None, "classify_batch needs numpy.")
+    def test_batch_follows_training(self):
+        c = get_classifier()
+        documents = [list('cba'), list('abc')]
+        c.classify_batch(documents, 'classify')
+        for i in xrange(5):
+            c.train('a', list('cba'))
+        predicted, scores, class_names = c.classify_batch(documents, 'classify')
+        self.assertEqual(predicted, [c.classify(token_list) for token_list in documents])
+        for row, token_list in zip(scores, documents):
+            for class_name, total in c.score(token_list, *SCORING_METHODS['classify']):
+                self.assertAlmostEqual(row[class_names.index(class_name)], total)
+
+    def test_top_k_follows_training(self):
+        c = get_classifier()
+        token_list = list('cba')
+        c.classify_top_k(token_list, 2, 'classify')
+        for i in xrange(5):
+            c.train('a', token_list)
+        expected = sorted(c.score(token_list, *SCORING_METHODS['classify']), key=lambda score: -score[1])
+        top_k = c.classify_top_k(token_list, 2, 'classify')
+        self.assertEqual([class_name for class_name, total in top_k], [class_name for class_name, total in expected])
+        for (class_name, total), (expected_name, expected_total) in zip(top_k, expected):
+            self.assertAlmostEqual(total, expected_total)
+
+class ScoreCacheTest(unittest.TestCase):
+
+    def count_nodes(self, node):
+        return 1 + sum(self.count_nodes(child) for child in node[0].itervalues())
+
+    def test_flush_keeps_document(self):
+        c = get_classifier()
+        c.enable_score_cache(max_nodes=6, checkpoint_interval=2)
+        engine = c.get_scoring_engine(*SCORING_METHODS['classify_prev_prev_token_plus_one'])
+        engine.score(list('abca'))
+        # Adding this document's nodes empties the trie first.
+        expected = engine.score(list('cbac'))
+        cache = engine.cache
+        self.assertEqual(cache.stats['flushes'], 1)
+        self.assertEqual(cache.number_of_nodes, self.count_nodes(cache.root))
+        cache.results.clear()
+        self.assertEqual(engine.score(list('cbac')), expected)
+        self.assertEqual(cache.stats['prefix_hits'], 1)
+        self.assertEqual(cache.stats['tokens_reused'], 4)
+
+if __name__ == "__main__":
+    unittest.main()
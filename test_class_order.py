@@ -0,0 +1,40 @@
+# test_class_order.py
+# Check that classes come out in the order of the tables keyed by name that the
+# models used to keep, so ties between classes are broken the same way.
+# e.g. python -m unittest test_class_order
+
+import random
+import unittest
+from classifier import Classifier
+
+def train_classifier(seed):
+    """Return a classifier with one document per class, so the priors tie, and the
+    {class name: True} dict the old tables keyed by name would have built.
+    """
+    rng = random.Random(seed)
+    names = [u''.join(rng.choice(u'abcdefghij') for i in xrange(rng.randint(3, 8))) for j in xrange(5)]
+    c = Classifier()
+    expected = {}
+    for name in names:
+        # Tokens between the classes spread out their symbol ids.
+        c.train(name, [u'%s%d' % (name, i) for i in xrange(rng.randint(0, 12))] + [u'tie'])
+        expected[name] = True
+    c.signal_end_of_training()
+    return c, list(expected)
+
+class ClassOrderTest(unittest.TestCase):
+
+    def test_order_matches_name_keyed_tables(self):
+        for seed in xrange(100):
+            c, expected = train_classifier(seed)
+            self.assertEqual(list(c.model.get_table_iterator('')), expected)
+
+    def test_ties_go_to_the_same_class(self):
+        for seed in xrange(100):
+            c, expected = train_classifier(seed)
+            # Every class scores the same on an empty document and the last one wins.
+            for method in ('classify', 'classify_prev_prev_token', 'classify_prev_prev_token_plus_one'):
+                self.assertEqual(getattr(c, method)([]), expected[-1])
+
+if __name__ == "__main__":
+    unittest.main()
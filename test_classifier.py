@@ -5,9 +5,12 @@ import os.path as path
 import re
 import codecs
 import json
+import sys
+import time
+import multiprocessing
 from classifier import Classifier
 from collections import OrderedDict
-from train_classifier import token_iterator, TOKEN_PATTERN, TEST_FILE, TRAINING_FILE_OUTPUT
+from train_classifier import TOKENIZER, TEST_FILE, TRAINING_FILE_OUTPUT
 
 def confusion_matrix_to_file(conf_matrix, file_name):
     axis = OrderedDict()
@@ -48,23 +51,136 @@ CONFUSED_POSTFIX = '_confused.txt'
 CORRECT_POSTFIX = '_correct.txt'
 CLASSIFIER_DATA_DIRECTORY = 'classifiers_data'
 
-if __name__ == "__main__":
-    c = Classifier()
-    c.load_model(TRAINING_FILE_OUTPUT)
-    test_file = TEST_FILE
-    
-    # Grab all test data from the file.
+# The suite of classifiers, by output name and Classifier method name.
+CLASSIFIERS = [
+    ('random classifier', 'classify_random'),
+    ('greedy', 'classify_greedy'),
+    ('naive classifier no smoothing', 'classify'),
+    ('one word token classifier no smoothing', 'classify_prev_token'),
+    ('two word token classifier no smoothing', 'classify_prev_prev_token'),
+    ('naive classifier with smoothing', 'classify_plus_one'),
+    ('one word token classifier with smoothing', 'classify_prev_token_plus_one'),
+    ('two word token classifier with smoothing', 'classify_prev_prev_token_plus_one'),
+    ('assume_seen', 'classify_assume_seen'),
+    ('assume_seen one prev word token', 'classify_assume_seen_prev'),
+    ('assume_seen two prev word token', 'classify_assume_seen_prev_prev'),
+    ('semisupervised', 'classify_semi_supervised'),
+    ('adhoc', 'classify_add_hoc'),
+]
+
+# Documents per unit of work handed to a worker process.
+SHARD_SIZE = 500
+
+# Set before the worker pool is created so forked workers share them copy-on-write
+# instead of reloading the model.
+_classifier = None
+_test_data = None
+
+def read_test_data(test_file):
+    """Return the token lists and the actual classes of the documents in the file."""
     test_data = []
     actual_class = []
     with codecs.open(test_file, 'r', 'utf-8') as f:
         for line in f:
             class_name, text = line.split('\t', 1)
-            text = text.strip()
-            token_list = []
-            for token in token_iterator(text, TOKEN_PATTERN):
-                token_list.append(token)
-            test_data.append(token_list)
+            test_data.append(TOKENIZER.tokens(text.strip()))
             actual_class.append(class_name)
+    return test_data, actual_class
+
+def classify_shard(work):
+    """Return the predicted classes of a (method name, start, end) slice of the test data."""
+    method_name, start, end = work
+    classifier = getattr(_classifier, method_name)
+    return [classifier(token_list) for token_list in _test_data[start:end]]
+
+def evaluate(classifier_name, predicted, test_data, actual_class, classifier_data_directory):
+    """Write the confusion matrix and the confused and correct documents of one classifier.
+    Return the fraction classified correctly.
+    """
+    confusion_matrix = {}
+    confused_documents = []
+    correct_documents = []
+    success_count = 0
+    for i, token_list in enumerate(test_data):
+        predicted_class = predicted[i]
+        
+        key = (actual_class[i], predicted_class)
+        if actual_class[i] == predicted_class:
+            success_count += 1
+            correct_documents.append([actual_class[i], predicted_class, ''.join(token_list)])
+        else:
+            confused_documents.append([actual_class[i], predicted_class, ''.join(token_list)])
+        confusion_matrix[key] = confusion_matrix.setdefault(key, 0) + 1
+    out_matrix_file = path.join(classifier_data_directory, classifier_name+CONFUSED_MATRIX_POSTFIX)
+    out_confused_file = path.join(classifier_data_directory, classifier_name+CONFUSED_POSTFIX)
+    out_correct_file = path.join(classifier_data_directory, classifier_name+CORRECT_POSTFIX)
+    confusion_matrix_to_file(confusion_matrix, out_matrix_file)
+    confused_docs_to_file(confused_documents, out_confused_file)
+    confused_docs_to_file(correct_documents, out_correct_file)
+    return float(success_count)/float(len(test_data))
+
+def run_classifiers(c, test_data, actual_class, classifier_data_directory, processes=None, shard_size=SHARD_SIZE):
+    """Run every classifier over the test data, spreading shards of documents over a
+    pool of forked worker processes, and write out the results of each.
+    processes - Number of worker processes, defaults to the number of CPUs. 1 runs inline.
+    """
+    global _classifier, _test_data
+    _classifier = c
+    _test_data = test_data
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    pool = None
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+    try:
+        for classifier_name, method_name in CLASSIFIERS:
+            work = [(method_name, start, min(start + shard_size, len(test_data)))
+                    for start in xrange(0, len(test_data), shard_size)]
+            start_time = time.time()
+            if pool is None:
+                shards = map(classify_shard, work)
+            else:
+                shards = pool.map(classify_shard, work)
+            wall_time = time.time() - start_time
+            predicted = []
+            for shard in shards:
+                predicted.extend(shard)
+            success = evaluate(classifier_name, predicted, test_data, actual_class, classifier_data_directory)
+            # Print output
+            print "Percent Success ("+str(classifier_name)+"):", str(success)
+            print "Time ("+str(classifier_name)+"): %.3f s, %.1f docs/sec" % \
+                  (wall_time, len(test_data)/wall_time if wall_time > 0 else float('inf'))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+def report_pruning(c, test_data, method='classify_prev_prev_token_plus_one'):
+    """Time classify_top_k against the exhaustive method and print how much it pruned."""
+    start_time = time.time()
+    expected = [getattr(c, method)(token_list) for token_list in test_data]
+    exhaustive_time = time.time() - start_time
+    c.pruning_stats = {}
+    start_time = time.time()
+    predicted = [c.classify_top_k(token_list, 1, method)[0][0] for token_list in test_data]
+    top_k_time = time.time() - start_time
+    stats = c.pruning_stats
+    assert predicted == expected, "classify_top_k disagrees with " + method
+    print "Top k (%s): %.3f s exhaustive, %.3f s pruned" % (method, exhaustive_time, top_k_time)
+    print "Pruned (%s): %d of %d classes, %d of %d tokens" % \
+          (method, stats['classes_pruned'], stats['classes'], stats['tokens_pruned'], stats['tokens'])
+
+if __name__ == "__main__":
+    # Optional argument: the number of worker processes.
+    processes = None
+    if len(sys.argv) > 1:
+        processes = int(sys.argv[1])
+    c = Classifier()
+    c.load_model(TRAINING_FILE_OUTPUT, compile_models=True)
+    test_file = TEST_FILE
+    
+    # Grab all test data from the file.
+    test_data, actual_class = read_test_data(test_file)
     
     classifier_data_directory = CLASSIFIER_DATA_DIRECTORY
     if not path.exists(classifier_data_directory):
@@ -73,42 +189,5 @@ if __name__ == "__main__":
     
     print "Number of test documents:", len(test_data)
     # Use a suite of classifiers and gather statistics.
-    classifiers = [
-        ('random classifier', c.classify_random),
-        ('greedy', c.classify_greedy),
-        ('naive classifier no smoothing', c.classify),
-        ('one word token classifier no smoothing', c.classify_prev_token),
-        ('two word token classifier no smoothing', c.classify_prev_prev_token),
-        ('naive classifier with smoothing', c.classify_plus_one),
-        ('one word token classifier with smoothing', c.classify_prev_token_plus_one),
-        ('two word token classifier with smoothing', c.classify_prev_prev_token_plus_one),
-        ('assume_seen', c.classify_assume_seen),
-        ('assume_seen one prev word token', c.classify_assume_seen_prev),
-        ('assume_seen two prev word token', c.classify_assume_seen_prev_prev),
-        ('semisupervised', c.classify_semi_supervised),
-        ('adhoc', c.classify_add_hoc),
-    ]
-    for classifier_name, classifier in classifiers:
-        confusion_matrix = {} # TODO save confusion_matrices for write-up
-        confused_documents = [] # TODO save mis-classified text to file
-        correct_documents = []
-        success_count = 0
-        for i, token_list in enumerate(test_data):
-            predicted_class = classifier(token_list)
-            
-            key = (actual_class[i], predicted_class)
-            if actual_class[i] == predicted_class:
-                success_count += 1
-                correct_documents.append([actual_class[i], predicted_class, ''.join(token_list)])
-            else:
-                confused_documents.append([actual_class[i], predicted_class, ''.join(token_list)])
-            confusion_matrix[key] = confusion_matrix.setdefault(key, 0) + 1
-        # Print output
-        print "Percent Success ("+str(classifier_name)+"):", str(float(success_count)/float(len(test_data)))
-        out_matrix_file = path.join(classifier_data_directory, classifier_name+CONFUSED_MATRIX_POSTFIX)
-        out_confused_file = path.join(classifier_data_directory, classifier_name+CONFUSED_POSTFIX)
-        out_correct_file = path.join(classifier_data_directory, classifier_name+CORRECT_POSTFIX)
-        confusion_matrix_to_file(confusion_matrix, out_matrix_file)
-        confused_docs_to_file(confused_documents, out_confused_file)
-        confused_docs_to_file(correct_documents, out_correct_file)
-        #~ print "Confused:", confusion_matrix
+    run_classifiers(c, test_data, actual_class, classifier_data_directory, processes)
+    report_pruning(c, test_data)
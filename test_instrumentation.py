@@ -0,0 +1,36 @@
+# test_instrumentation.py
+# Check that instrumentation counts the calls and lookups of every classifier
+# test_classifier.py evaluates, without changing what they return.
+# e.g. python -m unittest test_instrumentation
+
+import unittest
+from classifier import Classifier
+from test_classifier import CLASSIFIERS
+
+# Picks a class without looking anything up.
+NO_LOOKUPS = ('classify_random',)
+
+def get_classifier():
+    c = Classifier()
+    c.train(u'a', u'x y z x'.split())
+    c.train(u'b', u'y y w'.split())
+    c.signal_end_of_training()
+    return c
+
+class InstrumentationTest(unittest.TestCase):
+
+    def test_every_classifier_reports_counts(self):
+        token_list = u'x y q'.split()
+        for classifier_name, method_name in CLASSIFIERS:
+            c = get_classifier()
+            c.enable_instrumentation()
+            predicted = getattr(c, method_name)(token_list)
+            stats = c.get_instrumentation_stats()
+            c.disable_instrumentation()
+            self.assertEqual(stats['methods'][method_name]['calls'], 1, method_name)
+            if method_name not in NO_LOOKUPS:
+                self.assertTrue(sum(counts['total'] for counts in stats['lookups'].itervalues()), method_name)
+                self.assertEqual(predicted, getattr(c, method_name)(token_list), method_name)
+
+if __name__ == "__main__":
+    unittest.main()
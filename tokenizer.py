@@ -0,0 +1,106 @@
+# tokenizer.py
+# Split documents into the token lists the classifier trains on and scores.
+# e.g. python tokenizer.py assignment2/pnp-test.txt # Benchmark against token_iterator.
+
+import re
+import sys
+import time
+import codecs
+from classifier import UNKNOWN_ID
+
+CHARACTER = 'character'
+WORD = 'word'
+CHARACTER_NGRAM = 'character-ngram'
+
+WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+class Tokenizer(object):
+    """Lowercased tokens of a document.
+    The whole document is lowercased once, rather than once per token.
+    mode - CHARACTER for every character but newlines, the same as the pattern ".",
+           WORD for the matches of pattern, or CHARACTER_NGRAM for every n
+           consecutive characters.
+    pattern - The compiled regular expression WORD mode matches, by default runs of
+              word characters. Matching is done on the original text, so the tokens
+              are the same as lowercasing each match.
+    n - The length of the character n-grams.
+    """
+
+    def __init__(self, mode=CHARACTER, pattern=None, n=3):
+        if mode not in (CHARACTER, WORD, CHARACTER_NGRAM):
+            raise ValueError("Unknown tokenizer mode %r." % (mode,))
+        if n < 1:
+            raise ValueError("The n-gram length must be at least 1, not %r." % (n,))
+        self.mode = mode
+        self.pattern = pattern if pattern is not None else WORD_PATTERN
+        self.n = n
+
+    @classmethod
+    def from_pattern(cls, pattern):
+        """Return a tokenizer with the same output as token_iterator(text, pattern)."""
+        if pattern.pattern == '.' and not pattern.flags & re.DOTALL:
+            return cls(CHARACTER)
+        return cls(WORD, pattern)
+
+    def tokens(self, text):
+        """Return the list of tokens of the text."""
+        lowered = text.lower()
+        if self.mode == WORD:
+            # Lowercasing keeps the length, so the match spans carry over.
+            return [lowered[m.start():m.end()] for m in self.pattern.finditer(text)]
+        if '\n' in lowered:
+            lowered = lowered.replace('\n', '')
+        if self.mode == CHARACTER:
+            return list(lowered)
+        n = self.n
+        return [lowered[i:i + n] for i in xrange(len(lowered) - n + 1)]
+
+    def token_ids(self, text, symbols):
+        """Return the ids of the text's tokens in the symbol table, UNKNOWN_ID for
+        tokens it doesn't have, ready for ScoringEngine.get_ngrams_by_id.
+        """
+        ids = symbols.ids
+        return [ids.get(token, UNKNOWN_ID) for token in self.tokens(text)]
+
+    def __call__(self, text):
+        return self.tokens(text)
+
+if __name__ == "__main__":
+    from classifier import SymbolTable
+    from train_classifier import token_iterator, TOKEN_PATTERN, TEST_FILE
+    file_name = sys.argv[1] if len(sys.argv) > 1 else TEST_FILE
+    texts = []
+    with codecs.open(file_name, 'r', 'utf-8') as f:
+        for line in f:
+            texts.append(line.split('\t', 1)[-1].strip())
+    tokenizer = Tokenizer.from_pattern(TOKEN_PATTERN)
+
+    start_time = time.time()
+    expected = []
+    for text in texts:
+        tokens = []
+        for token in token_iterator(text, TOKEN_PATTERN):
+            tokens.append(token)
+        expected.append(tokens)
+    old_time = time.time() - start_time
+
+    start_time = time.time()
+    actual = [tokenizer.tokens(text) for text in texts]
+    new_time = time.time() - start_time
+    assert actual == expected, "The tokenizer's output differs from token_iterator's."
+
+    symbols = SymbolTable()
+    for tokens in actual:
+        for token in tokens:
+            symbols.intern(token)
+    start_time = time.time()
+    for text in texts:
+        tokenizer.token_ids(text, symbols)
+    ids_time = time.time() - start_time
+
+    number_of_tokens = sum(len(tokens) for tokens in actual)
+    rate = lambda seconds: number_of_tokens/seconds if seconds > 0 else float('inf')
+    print "Documents: %d, tokens: %d" % (len(texts), number_of_tokens)
+    print "token_iterator: %.3f s, %.1f tokens/sec" % (old_time, rate(old_time))
+    print "Tokenizer.tokens: %.3f s, %.1f tokens/sec" % (new_time, rate(new_time))
+    print "Tokenizer.token_ids: %.3f s, %.1f tokens/sec" % (ids_time, rate(ids_time))
@@ -2,18 +2,32 @@
 
 import os
 import re
+import sys
+import time
 import codecs
+import itertools
+import multiprocessing
 from classifier import Classifier
+from tokenizer import Tokenizer
 
 TRAINING_FILE = "assignment2/pnp-train.txt"
 VALIDATE_FILE = "assignment2/pnp-validate.txt"
 TEST_FILE = "assignment2/pnp-test.txt"
 
 TRAINING_FILE_OUTPUT = 'trained.json'
+TRAINING_BINARY_OUTPUT = 'trained.bin'
+# Self-training checkpoints, so a killed run resumes where it left off.
+SELF_TRAINING_CHECKPOINTS = 'self_training.log'
+
+# Lines of training data counted by one worker at a time, see train_files.
+SHARD_SIZE = 2000
 
 TOKEN_REGEX = r"."
 TOKEN_PATTERN = re.compile(TOKEN_REGEX)
 
+# Same tokens as token_iterator(text, TOKEN_PATTERN), but faster.
+TOKENIZER = Tokenizer.from_pattern(TOKEN_PATTERN)
+
 def token_iterator(line, pattern):
     for m in pattern.finditer(line):
         yield m.group().lower()
@@ -21,7 +35,90 @@ def token_iterator(line, pattern):
     #~ for m in pattern.finditer(line):
         #~ yield m.group()
 
+def line_iterator(file_names):
+    """Yield the lines of each file in turn."""
+    for file_name in file_names:
+        with codecs.open(file_name, 'r', 'utf-8') as f:
+            for line in f:
+                yield line
+
+def shard_iterator(lines, shard_size):
+    """Yield consecutive lists of at most shard_size lines."""
+    while True:
+        shard = list(itertools.islice(lines, shard_size))
+        if not shard:
+            return
+        yield shard
+
+def train_shard(lines):
+    """Return a classifier trained on the class-tab-text lines, the number of tokens
+    counted and the seconds it took.
+    """
+    start_time = time.time()
+    c = Classifier()
+    number_of_tokens = 0
+    for line in lines:
+        class_name, text = line.split('\t', 1)
+        tokens = TOKENIZER.tokens(text.strip())
+        c.train(class_name, tokens)
+        number_of_tokens += len(tokens)
+    return c, number_of_tokens, time.time() - start_time
+
+def train_files(c, file_names, processes=None, shard_size=SHARD_SIZE, verbose=True):
+    """Train the classifier on files of class-tab-text lines, counting shards of lines
+    in a pool of worker processes and merging their counts in file order.
+    The counts are identical to calling train on each line in turn. Only a few shards
+    per worker are held in memory at once.
+    processes - Number of worker processes, defaults to the number of CPUs. 1 runs inline.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    pool = None
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+    shards = shard_iterator(line_iterator(file_names), shard_size)
+    read_time = count_time = count_wall_time = merge_time = 0.0
+    number_of_lines = number_of_tokens = 0
+    start_time = time.time()
+    try:
+        while True:
+            t = time.time()
+            window = list(itertools.islice(shards, 2*processes))
+            read_time += time.time() - t
+            if not window:
+                break
+            t = time.time()
+            if pool is None:
+                results = map(train_shard, window)
+            else:
+                results = pool.map(train_shard, window)
+            count_wall_time += time.time() - t
+            t = time.time()
+            for shard, (shard_classifier, shard_tokens, shard_time) in zip(window, results):
+                c.merge(shard_classifier)
+                number_of_lines += len(shard)
+                number_of_tokens += shard_tokens
+                count_time += shard_time
+            merge_time += time.time() - t
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if verbose:
+        rate = lambda n, seconds: n/seconds if seconds > 0 else float('inf')
+        print "Read: %d lines, %.3f s, %.1f lines/sec" % (number_of_lines, read_time, rate(number_of_lines, read_time))
+        print "Count: %d tokens, %.3f s (%.3f s in workers), %.1f tokens/sec" % \
+              (number_of_tokens, count_wall_time, count_time, rate(number_of_tokens, count_wall_time))
+        print "Merge: %d tables, %.3f s, %.1f tables/sec" % \
+              (len(c.model.tables), merge_time, rate(len(c.model.tables), merge_time))
+        total_time = time.time() - start_time
+        print "Training: %.3f s, %.1f lines/sec" % (total_time, rate(number_of_lines, total_time))
+
 if __name__ == "__main__":
+    # Optional argument: the number of worker processes.
+    processes = None
+    if len(sys.argv) > 1:
+        processes = int(sys.argv[1])
     # Train on proper nouns dataset
     c = Classifier()
     
@@ -29,15 +126,7 @@ if __name__ == "__main__":
     train_file = TRAINING_FILE
     validate_file = VALIDATE_FILE
     training_files = [train_file]
-    for file_name in training_files:
-        with codecs.open(file_name, 'r', 'utf-8') as f:
-            for line in f:
-                class_name, text = line.split('\t', 1)
-                text = text.strip()
-                tokens = []
-                for token in token_iterator(text, TOKEN_PATTERN):
-                    tokens.append(token)
-                c.train(class_name, tokens)
+    train_files(c, training_files, processes)
     c.signal_end_of_training()
     
     # Unsupervised learning
@@ -48,15 +137,13 @@ if __name__ == "__main__":
     with codecs.open(TEST_FILE, 'r', 'utf-8') as f:
         for line in f:
             class_name, text = line.split('\t', 1)
-            text = text.strip()
-            tokens = []
-            for token in token_iterator(text, TOKEN_PATTERN):
-                tokens.append(token)
-            batch.append(tokens)
+            batch.append(TOKENIZER.tokens(text.strip()))
     print "Number of unsupervised learning:", len(batch)
-    c.unsupervised_training(batch)
+    c.unsupervised_training(batch, checkpoint_file=SELF_TRAINING_CHECKPOINTS)
     
     assert c.check_model()
     print "Sanity check passed."
     c.print_stats()
     c.save_model(TRAINING_FILE_OUTPUT)
+    c.save_binary_model(TRAINING_BINARY_OUTPUT)
+    os.remove(SELF_TRAINING_CHECKPOINTS)